@@ -0,0 +1,87 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Closures made inside large scopes: how many variable slots each one keeps
+alive through its environment, and the time to call one that uses
+variables from several enclosing lambdas.
+
+    python bench/bench_closures.py [backend ...]
+'''
+
+import os
+import sys
+
+from util import run_file, timed, write_temp
+from lispypy import program, interpreter, lispobj
+
+SOURCE = '''
+(define make (lambda (a b c d e f g h)
+    (begin
+        (define t1 (* a b))
+        (define t2 (* c d))
+        (define t3 (* e f))
+        (lambda (x) (+ x h)))))
+(define nest (lambda (a) (lambda (b) (lambda (c) (lambda (x) (+ x (+ a (+ b c))))))))
+(define inner (((nest 1) 2) 3))
+(define small (make 1 2 3 4 5 6 7 8))
+(do ((i 0 (+ i 1)) (s 0 (+ s (inner i)))) ((= i 20000) s))
+'''
+
+
+def retained_slots(closure):
+    '''
+    The number of variable slots reachable through a closure's
+    environment, short of the globals.
+    '''
+    count = 0
+    env = closure.env
+    while isinstance(env, interpreter.Frame):
+        count += len(env.values)
+        env = env.outer
+    return count
+
+
+def run(backend, path):
+    interp = program.make_interpreter(backend)
+    run_file(interp, path)
+    return interp
+
+
+def main(argv):
+    backends = argv[1:] or ['tree', 'closure', 'bytecode']
+    path = write_temp(SOURCE)
+    print '%-10s %16s %16s %12s' % ('', 'slots (small)', 'slots (inner)',
+                                    'time')
+    for backend in backends:
+        interp, elapsed = timed(run, backend, path)
+        small = interp.root.get(lispobj.intern('small'))
+        inner = interp.root.get(lispobj.intern('inner'))
+        print '%-10s %16d %16d %11.3fs' % (backend, retained_slots(small),
+                                           retained_slots(inner), elapsed)
+    os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,96 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Evaluation speed of each interpreter backend on a few small programs.
+
+    python bench/bench_eval.py [backend ...]
+'''
+
+import os
+import sys
+
+from util import run_file, timed, write_temp
+from lispypy import program
+
+PRELUDE = '''
+(define defmacro (create-macro (name args exp)
+    (define name (create-macro args exp))))
+(defmacro defun (name args exp)
+    (define name (lambda args exp)))
+'''
+
+PROGRAMS = [
+    ('fib', '''
+(defun fib (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+(fib 20)
+'''),
+    ('tail loop', '''
+(defun count (n acc) (if (equal n 0) acc (count (- n 1) (+ acc 1))))
+(count 100000 0)
+'''),
+    ('do loop', '''
+(do ((n 100000 (- n 1)) (acc 0 (+ acc 1))) ((equal n 0) acc))
+'''),
+    ('closures', '''
+(defun make-adder (a) (lambda (b) (+ a b)))
+(defun apply-n (f n x) (if (equal n 0) x (apply-n f (- n 1) (f x))))
+(apply-n (make-adder 3) 50000 0)
+'''),
+    ('macro calls', '''
+(defmacro inc (x) (+ x 1))
+(defun loop (n acc) (if (equal n 0) acc (loop (- n 1) (inc acc))))
+(loop 50000 0)
+'''),
+    ('hand-expanded', '''
+(defun loop (n acc) (if (equal n 0) acc (loop (- n 1) (+ acc 1))))
+(loop 50000 0)
+'''),
+]
+
+
+def run(backend, path):
+    return run_file(program.make_interpreter(backend), path)
+
+
+def main(argv):
+    backends = argv[1:] or ['tree', 'closure', 'bytecode']
+    sys.setrecursionlimit(10000)
+    print '%-16s' % '' + ''.join('%12s' % b for b in backends)
+    for name, source in PROGRAMS:
+        path = write_temp(PRELUDE + source)
+        row = '%-16s' % name
+        results = []
+        for backend in backends:
+            res, elapsed = timed(run, backend, path)
+            results.append(res.repr())
+            row += '%11.3fs' % elapsed
+        if len(set(results)) != 1:
+            row += '  (results differ: %s)' % ', '.join(results)
+        print row
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
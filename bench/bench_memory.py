@@ -0,0 +1,64 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Memory layout of the object model: bytes per cons cell and per boxed int,
+and the time to allocate a 1M-element list.
+
+Sizes are measured on the host Python, counting an instance __dict__ when
+a class has one.
+'''
+
+import sys
+
+from util import timed, report
+from lispypy.lispobj import LispCons, nil
+from lispypy.number import LispInt
+
+
+def instance_size(obj):
+    size = sys.getsizeof(obj)
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+
+def build_list(n):
+    head = nil
+    for i in range(n):
+        head = LispCons(LispInt(i), head)
+    return head
+
+
+def main(argv):
+    n = int(argv[1]) if len(argv) > 1 else 1000000
+    print 'bytes per cons cell: %d' % instance_size(LispCons(None, None))
+    print 'bytes per int:       %d' % instance_size(LispInt(0))
+    lst, elapsed = timed(build_list, n)
+    report('allocate %d-element list' % n, n, 'cells', elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
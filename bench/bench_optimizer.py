@@ -0,0 +1,93 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Evaluation speed of each interpreter backend with and without the
+source optimizer, on programs it has something to do for.
+
+    python bench/bench_optimizer.py [backend ...]
+'''
+
+import os
+import sys
+
+from util import run_file, timed, write_temp
+from bench_eval import PRELUDE
+from lispypy import program
+
+PROGRAMS = [
+    ('inlined helper', '''
+(defun square (x) (* x x))
+(defun sum-squares (n acc)
+    (if (equal n 0) acc (sum-squares (- n 1) (+ acc (square n)))))
+(sum-squares 30000 0)
+'''),
+    ('constant folding', '''
+(define seconds-per-day (* 60 60 24))
+(defun loop (n acc)
+    (if (equal n 0) acc
+        (loop (- n 1) (+ acc (* 2 seconds-per-day) (- 10 (/ 6 2))))))
+(loop 30000 0)
+'''),
+    ('dead branch', '''
+(define debug #f)
+(defun trace (x) (if debug (display "trace" x) x))
+(defun loop (n acc) (if (equal n 0) acc (loop (- n 1) (+ acc (trace n)))))
+(loop 30000 0)
+'''),
+    ('beta reduction', '''
+(defun loop (n acc)
+    (if (equal n 0) acc (loop (- n 1) ((lambda (a b) (+ a b)) acc 2))))
+(loop 30000 0)
+'''),
+]
+
+
+def run(backend, path, optimize):
+    return run_file(program.make_interpreter(backend), path, optimize)
+
+
+def main(argv):
+    backends = argv[1:] or ['tree', 'closure', 'bytecode']
+    sys.setrecursionlimit(10000)
+    print '%-18s%-10s%10s%10s%10s' % ('', '', 'plain', 'optimized',
+                                      'speedup')
+    for name, source in PROGRAMS:
+        path = write_temp(PRELUDE + source)
+        for backend in backends:
+            plain, plain_time = timed(run, backend, path, False)
+            optimized, optimized_time = timed(run, backend, path, True)
+            row = '%-18s%-10s%9.3fs%9.3fs%9.2fx' % (
+                name, backend, plain_time, optimized_time,
+                plain_time / max(optimized_time, 1e-9))
+            if plain.repr() != optimized.repr():
+                row += '  (results differ: %s, %s)' % (plain.repr(),
+                                                       optimized.repr())
+            print row
+            name = ''
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
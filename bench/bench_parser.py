@@ -0,0 +1,61 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Parser scaling: time to parse 10k, 100k and 1M tokens.
+
+Parsing walks the token list with a cursor, so the time per token should
+stay flat as the input grows.
+'''
+
+import sys
+
+from util import timed, report
+from lispypy import parser
+from lispypy.tokenizer import Token
+
+
+def generate_tokens(n_tokens):
+    '''
+    Build a token list of about n_tokens tokens out of small nested forms.
+    '''
+    form = ['(', 'define', 'x', '(', '+', '1', 'y', ')', ')']
+    tokens = []
+    while len(tokens) < n_tokens:
+        for value in form:
+            tokens.append(Token(value, 0))
+    return tokens
+
+
+def main(argv):
+    sizes = [int(a) for a in argv[1:]] or [10000, 100000, 1000000]
+    for size in sizes:
+        tokens = generate_tokens(size)
+        count = len(tokens)
+        forms, elapsed = timed(parser.parse_all, tokens)
+        report('parse %d tokens' % count, count, 'tokens', elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,57 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Deep non-tail recursion on the bytecode backend, whose calls use a heap
+continuation stack instead of the host stack.
+
+    python bench/bench_recursion.py [depth ...]
+'''
+
+import os
+import sys
+
+from util import run_file, timed, write_temp
+from lispypy import program
+
+SOURCE = '''
+(define count (lambda (n) (if (equal n 0) 0 (+ 1 (count (- n 1))))))
+(count %d)
+'''
+
+
+def main(argv):
+    depths = [int(arg) for arg in argv[1:]] or [1000, 10000, 100000]
+    print '%10s %12s %12s %10s' % ('depth', 'result', 'peak frames', 'time')
+    for depth in depths:
+        path = write_temp(SOURCE % depth)
+        interp = program.make_interpreter('bytecode', depth + 10)
+        res, elapsed = timed(run_file, interp, path)
+        print '%10d %12s %12d %9.3fs' % (depth, res.repr(), interp.peak_depth,
+                                         elapsed)
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,69 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Tokenizer throughput: one read() per byte versus block-buffered reads
+versus blocks sliced out of a memory-mapped file.
+
+A buffer size of 1 reproduces the old behaviour of issuing one os.read
+syscall per character.
+'''
+
+import os
+import sys
+
+from util import generate_source, write_temp, timed, report
+from lispypy import tokenizer
+
+
+def run(path, buffer_size):
+    fd = os.open(path, os.O_RDONLY, 0777)
+    try:
+        if buffer_size:
+            reader = tokenizer.SourceReader(fd, path, buffer_size)
+        else:
+            reader = tokenizer.open_reader(fd, path, use_mmap=True)
+        tokens = tokenizer.tokenize_reader(reader)
+        reader.close()
+        return tokens
+    finally:
+        os.close(fd)
+
+
+def main(argv):
+    n_forms = int(argv[1]) if len(argv) > 1 else 20000
+    path = write_temp(generate_source(n_forms))
+    try:
+        print 'source: %d bytes' % os.path.getsize(path)
+        for size in (1, tokenizer.SourceReader.BUFFER_SIZE):
+            tokens, elapsed = timed(run, path, size)
+            report('buffer_size=%d' % size, len(tokens), 'tokens', elapsed)
+        tokens, elapsed = timed(run, path, 0)
+        report('mmap', len(tokens), 'tokens', elapsed)
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
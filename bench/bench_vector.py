@@ -0,0 +1,79 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Indexed access to a list against a vector of the same numbers, summing
+every element by index at a few sizes.
+
+    python bench/bench_vector.py [backend ...]
+'''
+
+import os
+import sys
+
+from util import run_file, timed, write_temp
+from bench_eval import PRELUDE
+from lispypy import program
+
+SIZES = [250, 500, 1000]
+
+SOURCE = '''
+(define items (quote (%(items)s)))
+(define table #(%(items)s))
+(defun nth (l i) (if (equal i 0) (car l) (nth (cdr l) (- i 1))))
+(defun sum-by-index (ref n)
+    (do ((i 0 (+ i 1)) (s 0 (+ s (ref i)))) ((equal i n) s)))
+'''
+
+CASES = [
+    ('list', '(sum-by-index (lambda (i) (nth items i)) %d)'),
+    ('vector', '(sum-by-index (lambda (i) (vector-ref table i)) %d)'),
+]
+
+
+def run(backend, path):
+    return run_file(program.make_interpreter(backend), path)
+
+
+def main(argv):
+    backends = argv[1:] or ['tree', 'closure', 'bytecode']
+    sys.setrecursionlimit(10000)
+    print '%-10s%8s' % ('', 'n') + ''.join('%12s' % b for b in backends)
+    for name, call in CASES:
+        for n in SIZES:
+            items = ' '.join([str(i) for i in range(n)])
+            source = SOURCE % {'items': items} + call % n
+            path = write_temp(PRELUDE + source)
+            row = '%-10s%8d' % (name, n)
+            for backend in backends:
+                res, elapsed = timed(run, backend, path)
+                assert res.repr() == str(n * (n - 1) / 2)
+                row += '%11.3fs' % elapsed
+            print row
+            name = ''
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
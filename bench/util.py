@@ -0,0 +1,94 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Helpers shared by the benchmark scripts in this directory.
+
+Run a benchmark from the repository root, e.g.:
+
+    python bench/bench_tokenizer.py
+'''
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from lispypy import tokenizer, parser, program
+
+
+def generate_source(n_forms):
+    '''
+    Generate a LISP script of roughly n_forms top-level definitions.
+    '''
+    chunks = []
+    for i in range(n_forms):
+        chunks.append('; definition %d\n' % i)
+        chunks.append('(define item-%d (quote (%d %d.5 "str-%d" sym-%d '
+                      '(nested list #t #f))))\n' % (i, i, i, i, i))
+    return ''.join(chunks)
+
+
+def write_temp(source):
+    '''
+    Write source to a temporary file and return its path.
+    '''
+    fd, path = tempfile.mkstemp(suffix='.lisp')
+    os.write(fd, source)
+    os.close(fd)
+    return path
+
+
+def run_file(interp, path, optimize=False):
+    '''
+    Evaluate the LISP script at path with interp, returning the value of its
+    last form.
+    '''
+    fd = os.open(path, os.O_RDONLY, 0777)
+    try:
+        reader = tokenizer.open_reader(fd, path)
+        try:
+            forms = parser.FormStream(tokenizer.TokenStream(reader))
+            return program.evaluate_forms(interp, forms, optimize)
+        finally:
+            reader.close()
+    finally:
+        os.close(fd)
+
+
+def timed(fn, *args):
+    '''
+    Call fn(*args), returning (result, elapsed seconds).
+    '''
+    start = time.time()
+    res = fn(*args)
+    return res, time.time() - start
+
+
+def report(label, count, unit, elapsed):
+    print '%-32s %10d %s in %7.3fs  (%12.0f %s/s)' % (
+        label, count, unit, elapsed, count / max(elapsed, 1e-9), unit)
@@ -0,0 +1,15 @@
+(define squares (make-vector 5 0))
+(define fill (lambda (i)
+    (if (< i (vector-length squares))
+        (begin (vector-set! squares i (* i i)) (fill (+ i 1)))
+        squares)))
+(display "Squares:" (fill 0))
+
+(define v (vector 1 2 3))
+(vector-set! v 0 10)
+(display "A vector made by vector can change:" v)
+
+(define digits (lambda () #(1 2 3)))
+(display "A literal is shared by each evaluation:" (digits))
+(display "so it can't change:")
+(vector-set! (digits) 0 10)
@@ -25,7 +25,8 @@
 from .lispobj import *
 from .number import *
 from .common import *
-from .rpytools import purefunction, rbigint
+from .rpytools import purefunction, ovfcheck
+from . import resolver
 
 
 def define(interp, args, env):
@@ -33,10 +34,10 @@ def define(interp, args, env):
         (name, exp) = args
     except ValueError:
         raise LispError("Wrong number of arguments to define")
-    name_str = interp.check_ref(name)
+    sym = interp.check_ref(name)
     value = interp.evaluate(exp, env)
-    env.set(name_str, value)
-    return LispNil()
+    env.set(sym, value)
+    return nil
 
 
 def quote(interp, args, env):
@@ -50,13 +51,13 @@ def setbang(interp, args, env):
         (name, exp) = args
     except ValueError:
         raise LispError("Wrong number of arguments to set!")
-    name_str = interp.check_ref(name)
+    sym = interp.check_ref(name)
     value = interp.evaluate(exp, env)
-    containing = env.find(name_str)
+    containing = env.find(sym)
     if not containing:
-        raise LispError('Name "%s" undefined' % (name_str,))
-    containing.set(name_str, value)
-    return LispNil()
+        raise LispError('Name "%s" undefined' % (sym.name,))
+    containing.set(sym, value)
+    return nil
 
 
 def lambda_(interp, args, env):
@@ -65,7 +66,9 @@ def lambda_(interp, args, env):
     except ValueError:
         raise LispError("Wrong number of arguments to lambda")
     arg_names = [interp.check_ref(n) for n in interp.check_cons(argrefs)]
-    return LispClosure(parameters=arg_names, expression=exp, env=env)
+    source = LispCons.wrap([LispReference(Symbols.LAMBDA), argrefs, exp])
+    template = resolver.resolve_lambda(arg_names, exp, env.scope, source)
+    return interp.make_closure(template, env)
 
 
 def createmacro(interp, args, env):
@@ -77,127 +80,148 @@ def createmacro(interp, args, env):
     return LispMacro(parameters=arg_names, expression=exp)
 
 
+# Arithmetic operations folded by _fold_arith.
+ARITH_ADD = 0
+ARITH_SUB = 1
+ARITH_MUL = 2
+ARITH_DIV = 3
+
+
+def _fold_arith(interp, args, start, acc, op):
+    '''
+    Fold args[start:] into acc with the generic number operations.
+    '''
+    for i in range(start, len(args)):
+        rh = interp.check_value(args[i], LispNumber)
+        if op == ARITH_ADD:
+            acc = acc.op_add(rh)
+        elif op == ARITH_SUB:
+            acc = acc.op_sub(rh)
+        elif op == ARITH_MUL:
+            acc = acc.op_mul(rh)
+        else:
+            try:
+                acc = acc.op_div(rh)
+            except ZeroDivisionError:
+                raise LispError("Division by zero")
+    return acc
+
+
 @purefunction
 def op_add(interp, args, env):
-    try:
-        (lh, rh) = [interp.check_value(v, LispNumber) for v in args]
-    except ValueError:
-        raise LispError("Wrong number of operands")
-    return lh.op_add(rh)
+    # Sum ints unboxed until something isn't an int or the sum overflows,
+    # then carry on with the generic operations from that operand.
+    acc = 0
+    i = 0
+    while i < len(args):
+        rh = interp.check_value(args[i], LispNumber)
+        if not isinstance(rh, LispInt):
+            break
+        try:
+            acc = ovfcheck(acc + rh.val_int)
+        except OverflowError:
+            break
+        i += 1
+    if i == len(args):
+        return make_int(acc)
+    return _fold_arith(interp, args, i, make_int(acc), ARITH_ADD)
 
 
 @purefunction
-def op_sub(interp, args, env):
-    try:
-        (lh, rh) = [interp.check_value(v, LispNumber) for v in args]
-    except ValueError:
-        raise LispError("Wrong number of operands")
-    return lh.op_sub(rh)
+def op_mul(interp, args, env):
+    acc = 1
+    i = 0
+    while i < len(args):
+        rh = interp.check_value(args[i], LispNumber)
+        if not isinstance(rh, LispInt):
+            break
+        try:
+            acc = ovfcheck(acc * rh.val_int)
+        except OverflowError:
+            break
+        i += 1
+    if i == len(args):
+        return make_int(acc)
+    return _fold_arith(interp, args, i, make_int(acc), ARITH_MUL)
 
 
 @purefunction
-def op_mul(interp, args, env):
-    try:
-        (lh, rh) = [interp.check_value(v, LispNumber) for v in args]
-    except ValueError:
+def op_sub(interp, args, env):
+    if len(args) == 0:
         raise LispError("Wrong number of operands")
-    return lh.op_mul(rh)
+    first = interp.check_value(args[0], LispNumber)
+    if len(args) == 1:
+        # (- x) negates x
+        return make_int(0).op_sub(first)
+    if not isinstance(first, LispInt):
+        return _fold_arith(interp, args, 1, first, ARITH_SUB)
+    acc = first.val_int
+    i = 1
+    while i < len(args):
+        rh = interp.check_value(args[i], LispNumber)
+        if not isinstance(rh, LispInt):
+            break
+        try:
+            acc = ovfcheck(acc - rh.val_int)
+        except OverflowError:
+            break
+        i += 1
+    if i == len(args):
+        return make_int(acc)
+    return _fold_arith(interp, args, i, make_int(acc), ARITH_SUB)
 
 
 @purefunction
 def op_div(interp, args, env):
-    try:
-        (lh, rh) = [interp.check_value(v, LispNumber) for v in args]
-    except ValueError:
+    if len(args) == 0:
         raise LispError("Wrong number of operands")
-    try:
-        return lh.op_div(rh)
-    except ZeroDivisionError:
-        raise LispError("Division by zero")
+    if len(args) == 1:
+        # (/ x) is the reciprocal of x
+        return _fold_arith(interp, args, 0, make_int(1), ARITH_DIV)
+    first = interp.check_value(args[0], LispNumber)
+    return _fold_arith(interp, args, 1, first, ARITH_DIV)
+
+
+def _compare_chain(interp, args, op):
+    '''
+    True if op holds between each pair of neighbouring operands.
+    '''
+    if len(args) == 0:
+        raise LispError("Wrong number of operands")
+    lh = interp.check_value(args[0], LispNumber)
+    res = True
+    for i in range(1, len(args)):
+        rh = interp.check_value(args[i], LispNumber)
+        # Keep checking the remaining operands' types once res is False.
+        if res and not lh.compare(rh, op):
+            res = False
+        lh = rh
+    return make_bool(res)
 
 
 @purefunction
 def op_lt(interp, args, env):
-    try:
-        (lh, rh) = [interp.check_value(v, LispNumber) for v in args]
-    except ValueError:
-        raise LispError("Wrong number of operands")
-
-    typematch = True
-    res = False
-    if isinstance(lh, LispInt):
-        if isinstance(rh, LispInt):
-            res = lh.val_int < rh.val_int
-        elif isinstance(rh, LispFloat):
-            res = float(lh.val_int) < rh.val_float
-        elif isinstance(rh, LispBigint):
-            res = rbigint.fromint(lh.val_int).lt(rh.val_bigint)
-        else:
-            typematch = False
-    elif isinstance(lh, LispFloat):
-        if isinstance(rh, LispInt):
-            res = lh.val_float < float(rh.val_int)
-        elif isinstance(rh, LispFloat):
-            res = lh.val_float < rh.val_float
-        elif isinstance(rh, LispBigint):
-            res = lh.val_float < rh.val_bigint.tofloat()
-        else:
-            typematch = False
-    elif isinstance(lh, LispBigint):
-        if isinstance(rh, LispInt):
-            res = lh.val_bigint.lt(rbigint.fromint(rh.val_int))
-        elif isinstance(rh, LispFloat):
-            res = lh.val_bigint.tofloat() < rh.val_float
-        elif isinstance(rh, LispBigint):
-            res = lh.val_bigint.lt(rh.val_bigint)
-        else:
-            typematch = False
-    if not typematch:
-        raise LispError("Can't compare %s and %s" % (lh.typename(),
-                                                     rh.typename()))
-    return LispBool(res)
+    return _compare_chain(interp, args, CMP_LT)
 
 
 @purefunction
 def op_gt(interp, args, env):
-    try:
-        (lh, rh) = [interp.check_value(v, LispNumber) for v in args]
-    except ValueError:
-        raise LispError("Wrong number of operands")
+    return _compare_chain(interp, args, CMP_GT)
 
-    typematch = True
-    res = False
-    if isinstance(lh, LispInt):
-        if isinstance(rh, LispInt):
-            res = lh.val_int > rh.val_int
-        elif isinstance(rh, LispFloat):
-            res = float(lh.val_int) > rh.val_float
-        elif isinstance(rh, LispBigint):
-            res = rbigint.fromint(lh.val_int).gt(rh.val_bigint)
-        else:
-            typematch = False
-    elif isinstance(lh, LispFloat):
-        if isinstance(rh, LispInt):
-            res = lh.val_float > float(rh.val_int)
-        elif isinstance(rh, LispFloat):
-            res = lh.val_float > rh.val_float
-        elif isinstance(rh, LispBigint):
-            res = lh.val_float > rh.val_bigint.tofloat()
-        else:
-            typematch = False
-    elif isinstance(lh, LispBigint):
-        if isinstance(rh, LispInt):
-            res = lh.val_bigint.gt(rbigint.fromint(rh.val_int))
-        elif isinstance(rh, LispFloat):
-            res = lh.val_bigint.tofloat() > rh.val_float
-        elif isinstance(rh, LispBigint):
-            res = lh.val_bigint.gt(rh.val_bigint)
-        else:
-            typematch = False
-    if not typematch:
-        raise LispError("Can't compare %s and %s" % (lh.typename(),
-                                                     rh.typename()))
-    return LispBool(res)
+
+@purefunction
+def op_le(interp, args, env):
+    return _compare_chain(interp, args, CMP_LE)
+
+
+@purefunction
+def op_ge(interp, args, env):
+    return _compare_chain(interp, args, CMP_GE)
+
+
+@purefunction
+def op_eq(interp, args, env):
+    return _compare_chain(interp, args, CMP_EQ)
 
 
 def _equal(interp, env, lh, rh):
@@ -208,30 +232,10 @@ def _equal(interp, env, lh, rh):
     if isinstance(lh, LispReference):
         if not isinstance(rh, LispReference):
             return False
-        return lh.name == rh.name
+        return lh.symbol is rh.symbol
     elif isinstance(lh, LispNumber):
-        # Numeric comparison. Dear lord.
-        if isinstance(lh, LispInt):
-            if isinstance(rh, LispInt):
-                return lh.val_int == rh.val_int
-            elif isinstance(rh, LispBigint):
-                return rbigint.fromint(lh.val_int).eq(rh.val_bigint)
-            elif isinstance(rh, LispFloat):
-                return float(lh.val_int) == rh.val_float
-        elif isinstance(lh, LispFloat):
-            if isinstance(rh, LispInt):
-                return lh.val_float == float(rh.val_int)
-            elif isinstance(rh, LispBigint):
-                return lh.val_float == rh.val_bigint.tofloat()
-            elif isinstance(rh, LispFloat):
-                return lh.val_float == rh.val_float
-        elif isinstance(lh, LispBigint):
-            if isinstance(rh, LispInt):
-                return lh.val_bigint.eq(rbigint.fromint(rh.val_int))
-            elif isinstance(rh, LispBigint):
-                return lh.val_bigint.eq(rh.val_bigint)
-            elif isinstance(rh, LispFloat):
-                return lh.val_bigint.tofloat() == rh.val_float
+        if isinstance(rh, LispNumber):
+            return lh.compare(rh, CMP_EQ)
     elif isinstance(lh, LispString):
         if not isinstance(rh, LispString):
             return False
@@ -240,13 +244,24 @@ def _equal(interp, env, lh, rh):
         if not isinstance(rh, LispBool):
             return False
         return lh.value == rh.value
-    elif isinstance(lh, LispNil):
-        return isinstance(rh, LispNil)
+    elif lh is nil:
+        return rh is nil
+    elif isinstance(lh, LispVector):
+        if not isinstance(rh, LispVector):
+            return False
+        if len(lh.items) != len(rh.items):
+            return False
+        for i in range(len(lh.items)):
+            if not _equal(interp, env, lh.items[i], rh.items[i]):
+                return False
+        return True
     elif isinstance(lh, LispCons):
         if not isinstance(rh, LispCons):
             return False
         nl, nr = (lh, rh)
         while isinstance(nl, LispCons):
+            if not isinstance(nr, LispCons):
+                return False
             if not _equal(interp, env, nl.car, nr.car):
                 return False
             nl, nr = (nl.cdr, nr.cdr)
@@ -261,7 +276,7 @@ def equal(interp, args, env):
         (lh, rh) = args
     except ValueError:
         raise LispError("Wrong number of operands")
-    return LispBool(_equal(interp, env, lh, rh))
+    return make_bool(_equal(interp, env, lh, rh))
 
 
 def display(interp, args, env):
@@ -271,7 +286,7 @@ def display(interp, args, env):
         else:
             print o.repr(),
     print
-    return LispNil()
+    return nil
 
 
 @purefunction
@@ -288,6 +303,63 @@ def cdr(interp, args, env):
     return interp.check_value(args[0], LispCons).cdr
 
 
+def make_vector(interp, args, env):
+    if not 1 <= len(args) <= 2:
+        raise LispError("Wrong number of arguments to make-vector")
+    length = interp.check_int(args[0])
+    if length < 0:
+        raise LispError("Negative vector length %d" % (length,))
+    fill = nil
+    if len(args) == 2:
+        fill = args[1]
+    return LispVector([fill] * length)
+
+
+def vector(interp, args, env):
+    return LispVector(list(args))
+
+
+def _vector_index(interp, vector, index):
+    i = interp.check_int(index)
+    if not 0 <= i < len(vector.items):
+        raise LispError("Vector index %d out of range" % (i,))
+    return i
+
+
+def vector_ref(interp, args, env):
+    if len(args) != 2:
+        raise LispError("Wrong number of arguments to vector-ref")
+    vector = interp.check_value(args[0], LispVector)
+    return vector.items[_vector_index(interp, vector, args[1])]
+
+
+def vector_set(interp, args, env):
+    if len(args) != 3:
+        raise LispError("Wrong number of arguments to vector-set!")
+    vector = interp.check_value(args[0], LispVector)
+    if vector.literal:
+        raise LispError("Attempt to modify a vector literal")
+    vector.items[_vector_index(interp, vector, args[1])] = args[2]
+    return nil
+
+
+def vector_length(interp, args, env):
+    if len(args) != 1:
+        raise LispError("Wrong number of arguments to vector-length")
+    return make_int(len(interp.check_value(args[0], LispVector).items))
+
+
+def vector_map(interp, args, env):
+    if len(args) != 2:
+        raise LispError("Wrong number of arguments to vector-map")
+    proc = args[0]
+    items = interp.check_value(args[1], LispVector).items
+    res = [None] * len(items)
+    for i in range(len(items)):
+        res[i] = interp.call_procedure(proc, [items[i]], NO_POS)
+    return LispVector(res)
+
+
 @purefunction
 def repr_(interp, args, env):
     if len(args) != 1:
@@ -295,13 +367,28 @@ def repr_(interp, args, env):
     return LispString(args[0].repr())
 
 
+# The builtins every backend calls for a form written with their name, whatever
+# the name is bound to; so like the special forms these names are reserved.
+# See README.md.
+_primitives = [
+    LispNativeProc(func=define, name='define', evaluate_args=False),
+    LispNativeProc(func=quote, name='quote', evaluate_args=False),
+    LispNativeProc(func=setbang, name='set!', evaluate_args=False),
+    LispNativeProc(func=lambda_, name='lambda', evaluate_args=False),
+]
+primitives = {}
+for _proc in _primitives:
+    primitives[intern(_proc.name)] = _proc
+
+
+@purefunction
+def get_primitive(sym):
+    return primitives.get(sym, None)
+
+
 @purefunction
 def get_all():
-    return [
-        LispNativeProc(func=define, name='define', evaluate_args=False),
-        LispNativeProc(func=quote, name='quote', evaluate_args=False),
-        LispNativeProc(func=setbang, name='set!', evaluate_args=False),
-        LispNativeProc(func=lambda_, name='lambda', evaluate_args=False),
+    return _primitives + [
         LispNativeProc(func=createmacro, name='create-macro', evaluate_args=False),
         LispNativeProc(func=op_add, name='+'),
         LispNativeProc(func=op_sub, name='-'),
@@ -313,5 +400,14 @@ def get_all():
         LispNativeProc(func=cdr, name='cdr'),
         LispNativeProc(func=op_lt, name='<'),
         LispNativeProc(func=op_gt, name='>'),
-        LispNativeProc(func=equal, name='equal')
+        LispNativeProc(func=op_le, name='<='),
+        LispNativeProc(func=op_ge, name='>='),
+        LispNativeProc(func=op_eq, name='='),
+        LispNativeProc(func=equal, name='equal'),
+        LispNativeProc(func=make_vector, name='make-vector'),
+        LispNativeProc(func=vector, name='vector'),
+        LispNativeProc(func=vector_ref, name='vector-ref'),
+        LispNativeProc(func=vector_set, name='vector-set!'),
+        LispNativeProc(func=vector_length, name='vector-length'),
+        LispNativeProc(func=vector_map, name='vector-map'),
     ]
@@ -0,0 +1,520 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Bytecode format and the compiler from s-expressions to it.
+
+An instruction is one opcode byte, followed by a two byte little-endian
+argument if the opcode is at least HAVE_ARGUMENT. Code objects are
+immutable once built, so the JIT can treat the bytecode and its tables as
+constants.
+
+Code is compiled for a Scope and runs in a frame laid out by it. Closure
+bodies run in a frame of their own (depth_offset 0). Everything else -- top
+level forms, macro expansions -- runs in a pass-through frame in front of
+the environment it is evaluated in, so that environment's variables are one
+frame further out (depth_offset 1).
+'''
+
+from .lispobj import (LispCons, LispReference, LispString, LispLocalRef,
+                      LispLambda, LispLet, LispDo, LispBool, LispVector,
+                      Symbols, nil)
+from .number import LispNumber
+from .common import LispError
+from . import builtin, resolver, special
+
+# No argument
+POP = 0
+RETURN = 1
+
+HAVE_ARGUMENT = 16
+LOAD_CONST = 16       # consts[arg]
+LOAD_LOCAL = 17       # slot arg of the current frame
+LOAD_DEREF = 18       # refs[arg], a variable of an enclosing frame
+LOAD_NAME = 19        # names[arg], looked up by name
+DEFINE_LOCAL = 20     # pop into slot arg, push nil
+DEFINE_NAME = 21      # pop into names[arg] in the environment, push nil
+SET_NAME = 22         # pop into the binding of names[arg], push nil
+MAKE_CLOSURE = 23     # close consts[arg], a LispLambda, over the environment
+JUMP = 24             # jump to arg
+JUMP_IF_FALSE = 25    # pop a bool, jump to arg if false
+CALL_PREP = 26        # see below
+CALL = 27             # call with sites[arg]
+TAIL_CALL = 28        # call with sites[arg], replacing the current frame
+RAISE = 29            # raise a LispError with message consts[arg]
+LET = 30              # run lets[arg] with the values on the stack
+STORE_LOCAL = 31      # pop into slot arg
+
+# A call is compiled as
+#
+#     <procedure>
+#     CALL_PREP site
+#     <argument> ...
+#     CALL site           (or TAIL_CALL site; RETURN)
+#
+# CALL_PREP looks at the procedure before any argument is evaluated. Macros
+# and builtins taking unevaluated arguments are handled there, and execution
+# continues at site.end with the result on the stack.
+
+opnames = {}
+for _name, _value in globals().items():
+    if (_name.isupper() and _name != 'HAVE_ARGUMENT' and
+            isinstance(_value, int) and 0 <= _value < 256):
+        opnames[_value] = _name
+
+MAX_ARGUMENT = 0xFFFF
+
+
+class CallSite(object):
+    '''
+    Static information about a call, and the compiled expansion of the last
+    macro called there.
+    '''
+    _immutable_fields_ = ['argc', 'expressions', 'tail', 'pos']
+    __slots__ = ('argc', 'expressions', 'tail', 'end', 'pos', 'macro',
+                 'expansion_scope', 'expansion')
+
+    def __init__(self, expressions, tail, pos):
+        self.argc = len(expressions)
+        self.expressions = expressions
+        self.tail = tail
+        self.end = -1
+        self.pos = pos
+        self.macro = None
+        self.expansion_scope = None
+        self.expansion = None
+
+    def compile_expansion(self, sexp, scope):
+        return compile_code(sexp, scope, 1)
+
+
+class LetBlock(object):
+    '''
+    The body of a let form or the iterations of a do loop, run in a frame
+    of its own.
+    '''
+    _immutable_fields_ = ['argc', 'scope', 'code', 'tail']
+    __slots__ = ('argc', 'scope', 'code', 'tail')
+
+    def __init__(self, argc, scope, code, tail):
+        self.argc = argc
+        self.scope = scope
+        self.code = code
+        self.tail = tail
+
+
+class Code(object):
+    '''
+    A compiled expression.
+    '''
+    _immutable_fields_ = ['bytecode', 'positions[*]', 'consts[*]',
+                          'names[*]', 'refs[*]', 'sites[*]', 'lets[*]',
+                          'stack_depth', 'scope', 'depth_offset']
+    __slots__ = ('bytecode', 'positions', 'consts', 'names', 'refs', 'sites',
+                 'lets', 'stack_depth', 'scope', 'depth_offset', 'cells')
+
+    def __init__(self, bytecode, positions, consts, names, refs, sites,
+                 lets, stack_depth, scope, depth_offset):
+        self.bytecode = bytecode
+        self.positions = positions
+        self.consts = consts
+        self.names = names
+        self.refs = refs
+        self.sites = sites
+        self.lets = lets
+        self.stack_depth = stack_depth
+        self.scope = scope
+        self.depth_offset = depth_offset
+        # The global Cell each of names was found in, if it can be cached.
+        self.cells = [None] * len(names)
+
+    def dump(self):
+        '''
+        Return a human-readable listing of the bytecode.
+        '''
+        lines = []
+        pc = 0
+        while pc < len(self.bytecode):
+            op = ord(self.bytecode[pc])
+            if op >= HAVE_ARGUMENT:
+                arg = (ord(self.bytecode[pc + 1]) |
+                       (ord(self.bytecode[pc + 2]) << 8))
+                lines.append('%4d %-14s %d' % (pc, opnames[op], arg))
+                pc += 3
+            else:
+                lines.append('%4d %s' % (pc, opnames[op]))
+                pc += 1
+        return '\n'.join(lines)
+
+
+class Compiler(object):
+    '''
+    Builds one Code object.
+    '''
+    def __init__(self, scope, depth_offset):
+        self.scope = scope
+        self.depth_offset = depth_offset
+        self.bytecode = []
+        self.positions = []
+        self.consts = []
+        self.const_index = {}
+        self.names = []
+        self.name_index = {}
+        self.refs = []
+        self.sites = []
+        self.lets = []
+        self.depth = 0
+        self.max_depth = 0
+
+    def finish(self):
+        # Copies, so that the lists Code keeps immutable were never resized.
+        return Code(''.join(self.bytecode), self.positions[:], self.consts[:],
+                    self.names[:], self.refs[:], self.sites[:], self.lets[:],
+                    self.max_depth,
+                    self.scope, self.depth_offset)
+
+    def pc(self):
+        return len(self.bytecode)
+
+    def adjust(self, delta):
+        self.depth += delta
+        if self.depth > self.max_depth:
+            self.max_depth = self.depth
+
+    def emit(self, op, arg, pos, delta):
+        self.bytecode.append(chr(op))
+        self.positions.append(pos)
+        if op >= HAVE_ARGUMENT:
+            if arg > MAX_ARGUMENT:
+                raise LispError("Expression too large to compile", pos)
+            self.bytecode.append(chr(arg & 0xFF))
+            self.bytecode.append(chr(arg >> 8))
+            self.positions.append(pos)
+            self.positions.append(pos)
+        self.adjust(delta)
+
+    def patch(self, at, arg):
+        '''
+        Set the argument of the instruction at pc at.
+        '''
+        if arg > MAX_ARGUMENT:
+            raise LispError("Expression too large to compile",
+                            self.positions[at])
+        self.bytecode[at + 1] = chr(arg & 0xFF)
+        self.bytecode[at + 2] = chr(arg >> 8)
+
+    def add_const(self, value):
+        index = self.const_index.get(value, -1)
+        if index < 0:
+            index = len(self.consts)
+            self.consts.append(value)
+            self.const_index[value] = index
+        return index
+
+    def add_name(self, sym):
+        index = self.name_index.get(sym, -1)
+        if index < 0:
+            index = len(self.names)
+            self.names.append(sym)
+            self.name_index[sym] = index
+        return index
+
+    def compile_tail(self, sexp):
+        '''
+        Compile sexp in tail position: it returns its value.
+        '''
+        if isinstance(sexp, LispLet):
+            self.compile_let(resolver.let_for(sexp, self.scope), True)
+            return
+        elif isinstance(sexp, LispDo):
+            self.compile_do(resolver.do_for(sexp, self.scope), True)
+            return
+        if isinstance(sexp, LispCons) and isinstance(sexp.car, LispReference):
+            if self.compile_special_form(sexp, True):
+                return
+        if isinstance(sexp, LispCons):
+            if self.compile_call(sexp, True):
+                return
+        self.compile(sexp)
+        self.emit(RETURN, 0, sexp.pos, -1)
+
+    def compile(self, sexp):
+        '''
+        Compile sexp to push its value.
+        '''
+        if isinstance(sexp, LispLocalRef) and sexp.scope is self.scope:
+            depth = sexp.depth + self.depth_offset
+            if depth == 0:
+                self.emit(LOAD_LOCAL, sexp.slot, sexp.pos, 1)
+            else:
+                ref = LispLocalRef(sexp.symbol, depth, sexp.slot, sexp.scope,
+                                   sexp.pos)
+                self.emit(LOAD_DEREF, len(self.refs), sexp.pos, 1)
+                self.refs.append(ref)
+        elif isinstance(sexp, LispReference):
+            # A global, or resolved against some other scope.
+            self.emit(LOAD_NAME, self.add_name(sexp.symbol), sexp.pos,
+                      1)
+        elif (sexp is nil or
+              isinstance(sexp, LispNumber) or
+              isinstance(sexp, LispString) or
+              isinstance(sexp, LispBool) or
+              isinstance(sexp, LispVector)):
+            self.emit(LOAD_CONST, self.add_const(sexp), sexp.pos, 1)
+        elif isinstance(sexp, LispLambda):
+            self.emit(MAKE_CLOSURE, self.add_const(sexp), sexp.pos, 1)
+        elif isinstance(sexp, LispLet):
+            self.compile_let(resolver.let_for(sexp, self.scope), False)
+        elif isinstance(sexp, LispDo):
+            self.compile_do(resolver.do_for(sexp, self.scope), False)
+        elif isinstance(sexp, LispCons):
+            if isinstance(sexp.car, LispReference):
+                if self.compile_special_form(sexp, False):
+                    return
+            self.compile_call(sexp, False)
+        else:
+            self.error("I don't understand %s" % (sexp.typename(),),
+                       sexp.pos)
+
+    def error(self, message, pos):
+        '''
+        Compile a raise of message; an expression that can't be evaluated
+        only fails when reached.
+        '''
+        self.emit(RAISE, self.add_const(LispString(message)), pos, 1)
+
+    def compile_call(self, sexp, tail):
+        '''
+        Compile a call. Returns True if the code returns (tail position).
+        '''
+        if sexp.car is nil and sexp.cdr is nil:
+            self.error("Attempt to call %s" % (nil.typename(),), sexp.pos)
+            return False
+        expressions = resolver.list_items(sexp.cdr)
+        if expressions is None:
+            self.error("Expected list of arguments or nil", sexp.pos)
+            return False
+        site = CallSite(expressions, tail, sexp.pos)
+        index = len(self.sites)
+        self.sites.append(site)
+        head = sexp.car
+        primitive = None
+        if isinstance(head, LispReference):
+            primitive = builtin.get_primitive(head.symbol)
+        if primitive is not None:
+            # Malformed, so it's left to the builtin to report.
+            self.emit(LOAD_CONST, self.add_const(primitive), sexp.pos, 1)
+        else:
+            self.compile(head)
+        self.emit(CALL_PREP, index, sexp.pos, 0)
+        for exp in expressions:
+            self.compile(exp)
+        if tail:
+            self.emit(TAIL_CALL, index, sexp.pos, -len(expressions))
+            site.end = self.pc()
+            self.emit(RETURN, 0, sexp.pos, -1)
+        else:
+            self.emit(CALL, index, sexp.pos, -len(expressions))
+            site.end = self.pc()
+        return tail
+
+    def compile_special_form(self, sexp, tail):
+        '''
+        Compile a well-formed special form. Returns False to have sexp
+        compiled as a call instead.
+        '''
+        car = sexp.car
+        assert isinstance(car, LispReference)
+        sym = car.symbol
+        if not (isinstance(sexp.cdr, LispCons) or sexp.cdr is nil):
+            self.error("Expected list of arguments or nil", sexp.pos)
+            return self.finish_value(sexp, tail)
+        try:
+            form = special.desugar(sexp)
+            if form is None and sym is Symbols.LET:
+                self.compile_let(resolver.resolve_let(sexp, self.scope), tail)
+                return True
+            elif form is None and sym is Symbols.DO:
+                self.compile_do(resolver.resolve_do(sexp, self.scope), tail)
+                return True
+        except LispError, e:
+            self.error(e.message, e.pos)
+            return self.finish_value(sexp, tail)
+        if form is not None:
+            if tail:
+                self.compile_tail(form)
+            else:
+                self.compile(form)
+            return True
+        items = resolver.list_items(sexp.cdr)
+        if sym is Symbols.BEGIN:
+            if not items:
+                self.emit(LOAD_CONST, self.add_const(nil), sexp.pos, 1)
+                return self.finish_value(sexp, tail)
+            for exp in items[:-1]:
+                self.compile(exp)
+                self.emit(POP, 0, exp.pos, -1)
+            if tail:
+                self.compile_tail(items[-1])
+            else:
+                self.compile(items[-1])
+            return True
+        elif sym is Symbols.IF:
+            if sexp.cdr is nil:
+                self.error("Expected list of parameters", sexp.pos)
+                return self.finish_value(sexp, tail)
+            if items is None or len(items) != 3:
+                self.error("Wrong number of arguments to if", sexp.pos)
+                return self.finish_value(sexp, tail)
+            self.compile_if(items[0], items[1], items[2], tail, sexp.pos)
+            return True
+        elif items is None:
+            return False
+        elif sym is Symbols.QUOTE:
+            if len(items) != 1:
+                return False
+            self.emit(LOAD_CONST, self.add_const(items[0]), sexp.pos,
+                      1)
+        elif sym is Symbols.DEFINE or sym is Symbols.SET:
+            if len(items) != 2:
+                return False
+            target = items[0]
+            if not isinstance(target, LispReference):
+                return False
+            name = target.symbol
+            self.compile(items[1])
+            slot = -1
+            if self.scope is not None and self.depth_offset == 0:
+                slot = self.scope.slot_of(name)
+            if sym is Symbols.SET:
+                self.emit(SET_NAME, self.add_name(name), sexp.pos, 0)
+            elif slot >= 0:
+                self.emit(DEFINE_LOCAL, slot, sexp.pos, 0)
+            else:
+                self.emit(DEFINE_NAME, self.add_name(name), sexp.pos,
+                          0)
+        elif sym is Symbols.LAMBDA:
+            if len(items) != 2:
+                return False
+            params = resolver.lambda_parameters(items[0])
+            if params is None:
+                return False
+            template = resolver.resolve_lambda(params, items[1], self.scope,
+                                               sexp)
+            self.emit(MAKE_CLOSURE, self.add_const(template),
+                      sexp.pos, 1)
+        else:
+            return False
+        return self.finish_value(sexp, tail)
+
+    def compile_let(self, let, tail):
+        '''
+        Compile a let. In tail position its body replaces the current frame.
+        '''
+        for value in let.values:
+            self.compile(value)
+        block = LetBlock(len(let.values), let.scope,
+                         compile_code(let.body, let.scope, 0), tail)
+        self.emit(LET, len(self.lets), let.pos, 1 - len(let.values))
+        self.lets.append(block)
+        if tail:
+            self.adjust(-1)
+
+    def compile_do(self, do, tail):
+        '''
+        Compile a do loop, run like a let whose body is the loop.
+        '''
+        for init in do.inits:
+            self.compile(init)
+        compiler = Compiler(do.scope, 0)
+        compiler.compile_loop(do)
+        block = LetBlock(len(do.inits), do.scope, compiler.finish(), tail)
+        self.emit(LET, len(self.lets), do.pos, 1 - len(do.inits))
+        self.lets.append(block)
+        if tail:
+            self.adjust(-1)
+
+    def compile_loop(self, do):
+        '''
+        Compile the iterations of a do loop, which update its variables in
+        place and jump back to the test:
+
+            top:  <test>
+                  JUMP_IF_FALSE body
+                  <result>; RETURN
+            body: <body>; POP
+                  <step> ...
+                  STORE_LOCAL slot ...
+                  JUMP top
+        '''
+        top = self.pc()
+        self.compile(do.test)
+        jump_body = self.pc()
+        self.emit(JUMP_IF_FALSE, 0, do.pos, -1)
+        self.compile_tail(do.result)
+        self.patch(jump_body, self.pc())
+        self.compile(do.body)
+        self.emit(POP, 0, do.pos, -1)
+        slots = []
+        for i in range(len(do.steps)):
+            step = do.steps[i]
+            if step is not None:
+                self.compile(step)
+                slots.append(i)
+        i = len(slots)
+        while i > 0:
+            i -= 1
+            self.emit(STORE_LOCAL, slots[i], do.pos, -1)
+        self.emit(JUMP, top, do.pos, 0)
+
+    def finish_value(self, sexp, tail):
+        if tail:
+            self.emit(RETURN, 0, sexp.pos, -1)
+        return True
+
+    def compile_if(self, cond, then, else_, tail, pos):
+        self.compile(cond)
+        jump_else = self.pc()
+        self.emit(JUMP_IF_FALSE, 0, pos, -1)
+        if tail:
+            self.compile_tail(then)
+            self.patch(jump_else, self.pc())
+            self.compile_tail(else_)
+        else:
+            self.compile(then)
+            jump_end = self.pc()
+            self.emit(JUMP, 0, pos, 0)
+            self.adjust(-1)
+            self.patch(jump_else, self.pc())
+            self.compile(else_)
+            self.patch(jump_end, self.pc())
+
+
+def compile_code(sexp, scope, depth_offset):
+    '''
+    Compile sexp into a Code object returning its value.
+    '''
+    compiler = Compiler(scope, depth_offset)
+    compiler.compile_tail(sexp)
+    return compiler.finish()
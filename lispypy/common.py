@@ -26,11 +26,15 @@
 from .rpytools import ovfcheck, purefunction
 
 
+# Source position of objects that don't come from a source file
+NO_POS = -1
+
+
 # Lisp interpreter error
 class LispError(Exception):
-    def __init__(self, message, location=None):
+    def __init__(self, message, pos=NO_POS):
         self.message = message
-        self.location = location
+        self.pos = pos
 
 
 hexdigits = '0123456789ABCDEF'
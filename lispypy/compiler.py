@@ -0,0 +1,677 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Closure-compilation backend.
+
+Instead of re-examining each s-expression every time it is evaluated, the
+expression is compiled once into a tree of Node objects, each specialised
+for its form: a constant, a local or global variable reference, one of the
+special forms, or a call. Closure bodies are compiled the first time they
+are called and cached on their LispLambda. Two-argument calls to the
+arithmetic and comparison builtins compile to OperatorNodes, which
+specialise themselves on the operand types they see.
+
+As in the tree-walking evaluator, the special form names are assumed not to
+be rebound. Forms that are malformed compile to a plain call of the builtin
+of the same name, so errors are reported exactly as the tree walker reports
+them.
+'''
+
+from .lispobj import (LispObject, LispCons, LispClosure, LispReference,
+                      LispString, LispMacro, LispNativeProc, LispLocalRef,
+                      LispLambda, LispLet, LispDo, LispBool, LispVector,
+                      Symbols, nil, intern, make_bool)
+from .number import (LispNumber, LispInt, LispFloat, make_int, compare_ints,
+                     compare_floats, CMP_LT, CMP_GT, CMP_LE, CMP_GE, CMP_EQ)
+from .common import LispError, NO_POS
+from .interpreter import Interpreter, Frame, frame_values
+from .tokenizer import location_repr
+from .rpytools import JitDriver, StackOverflow, ovfcheck
+from . import builtin, resolver, special
+
+
+class _TailCall(LispObject):
+    '''
+    Returned by Node.execute_tail when it leaves a call to be made by the
+    caller; the closure and arguments are left on the interpreter.
+    '''
+    _typename = 'tail call'
+    __slots__ = ()
+
+tail_call = _TailCall()
+
+
+class Node(object):
+    '''
+    A compiled expression.
+    '''
+    __slots__ = ('pos',)
+
+    def __init__(self, pos):
+        self.pos = pos
+
+    def execute(self, interp, env):
+        raise NotImplementedError
+
+    def execute_tail(self, interp, env):
+        '''
+        Evaluate the node in tail position: calls to closures are not made
+        but handed back to CompilingInterpreter.call_closure.
+        '''
+        return self.execute(interp, env)
+
+
+class ConstNode(Node):
+    __slots__ = ('value',)
+
+    def __init__(self, value, pos):
+        self.value = value
+        self.pos = pos
+
+    def execute(self, interp, env):
+        return self.value
+
+
+class ErrorNode(Node):
+    '''
+    An expression that can't be evaluated; raises when reached, not when
+    compiled.
+    '''
+    __slots__ = ('message',)
+
+    def __init__(self, message, pos):
+        self.message = message
+        self.pos = pos
+
+    def execute(self, interp, env):
+        raise LispError(self.message, self.pos)
+
+
+class NameRefNode(Node):
+    '''
+    A reference looked up by name, caching the global Cell it finds like
+    LispReference does.
+    '''
+    __slots__ = ('symbol', 'cell', 'cell_scope')
+
+    def __init__(self, symbol, pos):
+        self.symbol = symbol
+        self.cell = None
+        self.cell_scope = None
+        self.pos = pos
+
+    def execute(self, interp, env):
+        cell = self.cell
+        if (cell is not None and self.cell_scope is env.scope and
+                not self.symbol.shadowed):
+            return cell.value
+        containing = env.find(self.symbol)
+        if not containing:
+            raise LispError('Name "%s" undefined' % (self.symbol.name,),
+                            self.pos)
+        if containing is interp.root:
+            cell = interp.global_cell(self.symbol, env)
+            if cell is not None:
+                self.cell = cell
+                self.cell_scope = env.scope
+        return containing.get(self.symbol)
+
+
+class LocalRefNode(NameRefNode):
+    __slots__ = ('depth', 'slot', 'scope')
+
+    def __init__(self, symbol, depth, slot, scope, pos):
+        self.symbol = symbol
+        self.cell = None
+        self.cell_scope = None
+        self.depth = depth
+        self.slot = slot
+        self.scope = scope
+        self.pos = pos
+
+    def execute(self, interp, env):
+        if env.scope is self.scope:
+            assert isinstance(env, Frame)
+            if self.depth == 0:
+                value = env.values[self.slot]
+            else:
+                value = env.lookup(self.depth, self.slot)
+            if value is not None:
+                return value
+        return NameRefNode.execute(self, interp, env)
+
+
+class IfNode(Node):
+    __slots__ = ('cond', 'then', 'else_')
+
+    def __init__(self, cond, then, else_, pos):
+        self.cond = cond
+        self.then = then
+        self.else_ = else_
+        self.pos = pos
+
+    def execute(self, interp, env):
+        if interp.check_bool(self.cond.execute(interp, env)):
+            return self.then.execute(interp, env)
+        return self.else_.execute(interp, env)
+
+    def execute_tail(self, interp, env):
+        if interp.check_bool(self.cond.execute(interp, env)):
+            return self.then.execute_tail(interp, env)
+        return self.else_.execute_tail(interp, env)
+
+
+class BeginNode(Node):
+    __slots__ = ('body', 'last')
+
+    def __init__(self, body, last, pos):
+        self.body = body
+        self.last = last
+        self.pos = pos
+
+    def execute(self, interp, env):
+        for node in self.body:
+            node.execute(interp, env)
+        return self.last.execute(interp, env)
+
+    def execute_tail(self, interp, env):
+        for node in self.body:
+            node.execute(interp, env)
+        return self.last.execute_tail(interp, env)
+
+
+class DefineNode(Node):
+    __slots__ = ('symbol', 'value')
+
+    def __init__(self, symbol, value, pos):
+        self.symbol = symbol
+        self.value = value
+        self.pos = pos
+
+    def execute(self, interp, env):
+        env.set(self.symbol, self.value.execute(interp, env))
+        return nil
+
+
+class SetNode(DefineNode):
+    __slots__ = ()
+
+    def execute(self, interp, env):
+        value = self.value.execute(interp, env)
+        containing = env.find(self.symbol)
+        if not containing:
+            raise LispError('Name "%s" undefined' % (self.symbol.name,),
+                            self.pos)
+        containing.set(self.symbol, value)
+        return nil
+
+
+class LambdaNode(Node):
+    __slots__ = ('template',)
+
+    def __init__(self, template, pos):
+        self.template = template
+        self.pos = pos
+
+    def execute(self, interp, env):
+        return interp.make_closure(self.template, env)
+
+
+class LetNode(Node):
+    __slots__ = ('values', 'scope', 'body')
+
+    def __init__(self, values, scope, body, pos):
+        self.values = values
+        self.scope = scope
+        self.body = body
+        self.pos = pos
+
+    def make_frame(self, interp, env):
+        values = [node.execute(interp, env) for node in self.values]
+        return Frame(self.scope, frame_values(self.scope, values), env)
+
+    def execute(self, interp, env):
+        return self.body.execute(interp, self.make_frame(interp, env))
+
+    def execute_tail(self, interp, env):
+        return self.body.execute_tail(interp, self.make_frame(interp, env))
+
+
+def do_location(node):
+    return location_repr(node.pos)
+
+do_driver = JitDriver(greens=['node'], reds=['frame', 'interp'],
+                      get_printable_location=do_location)
+
+
+class DoNode(LetNode):
+    '''
+    A do loop. The loop variables are the frame's first slots, and each
+    iteration updates them in place; steps has a node for each variable,
+    or None if it has no step.
+    '''
+    __slots__ = ('test', 'steps', 'result')
+
+    def __init__(self, values, scope, test, body, steps, result, pos):
+        LetNode.__init__(self, values, scope, body, pos)
+        self.test = test
+        self.steps = steps
+        self.result = result
+
+    def run(self, interp, frame):
+        node = self
+        while True:
+            do_driver.jit_merge_point(node=node, frame=frame, interp=interp)
+            steps = node.steps
+            if interp.check_bool(node.test.execute(interp, frame)):
+                return
+            node.body.execute(interp, frame)
+            new_values = [None] * len(steps)
+            for i in range(len(steps)):
+                step = steps[i]
+                if step is not None:
+                    new_values[i] = step.execute(interp, frame)
+            for i in range(len(steps)):
+                if steps[i] is not None:
+                    frame.values[i] = new_values[i]
+            do_driver.can_enter_jit(node=node, frame=frame, interp=interp)
+
+    def execute(self, interp, env):
+        frame = self.make_frame(interp, env)
+        self.run(interp, frame)
+        return self.result.execute(interp, frame)
+
+    def execute_tail(self, interp, env):
+        frame = self.make_frame(interp, env)
+        self.run(interp, frame)
+        return self.result.execute_tail(interp, frame)
+
+
+class CallNode(Node):
+    '''
+    A procedure or macro call, and the compiled expansion of the last macro
+    called there.
+    '''
+    __slots__ = ('fn', 'args', 'expressions', 'macro', 'expansion',
+                 'expansion_scope')
+
+    def __init__(self, fn, args, expressions, pos):
+        self.fn = fn
+        self.args = args
+        self.expressions = expressions
+        self.macro = None
+        self.expansion = None
+        self.expansion_scope = None
+        self.pos = pos
+
+    def execute(self, interp, env):
+        return self.call(interp, env, False)
+
+    def execute_tail(self, interp, env):
+        return self.call(interp, env, True)
+
+    def evaluate_args(self, interp, env):
+        return [node.execute(interp, env) for node in self.args]
+
+    def call(self, interp, env, tail):
+        proc = self.fn.execute(interp, env)
+        if isinstance(proc, LispClosure):
+            args = self.evaluate_args(interp, env)
+            parameters = proc.template.parameters
+            if len(args) != len(parameters):
+                raise LispError("Expected %d arguments, got %d" % (
+                    len(parameters), len(args)), self.pos)
+            if tail:
+                interp.tail_proc = proc
+                interp.tail_args = args
+                return tail_call
+            return interp.call_closure(proc, args, self.pos)
+        elif isinstance(proc, LispNativeProc):
+            try:
+                if proc.evaluate_args:
+                    args = self.evaluate_args(interp, env)
+                else:
+                    args = self.expressions
+                return proc.func(interp, args, env)
+            except LispError, e:
+                if e.pos == NO_POS:
+                    raise LispError(e.message, self.pos)
+                raise
+        elif isinstance(proc, LispMacro):
+            node = interp.cached_expansion(self, proc, env)
+            if tail:
+                return node.execute_tail(interp, env)
+            return node.execute(interp, env)
+        else:
+            raise LispError("Attempt to call %s" % (proc.typename(),),
+                            proc.pos)
+
+    def compile_expansion(self, sexp, scope):
+        return compile_expr(sexp, scope)
+
+
+# States of an OperatorNode, in the order it moves through them.
+UNINITIALIZED = 0
+INT_INT = 1
+FLOAT_FLOAT = 2
+GENERIC = 3
+
+
+class OperatorNode(CallNode):
+    '''
+    A two-argument call to one of the arithmetic or comparison builtins.
+
+    The node specialises itself on the operands it sees: the first call
+    picks the int or float version if both operands are ints or both
+    floats, and from then on those are handled without going through the
+    builtin. When the operands stop matching the node falls back to the
+    generic path for good. If the name doesn't refer to the builtin at
+    all, it's an ordinary call.
+    '''
+    _immutable_fields_ = ['op', 'func', 'state?', 'native?']
+    __slots__ = ('op', 'func', 'state', 'native')
+
+    def __init__(self, op, func, fn, args, expressions, pos):
+        CallNode.__init__(self, fn, args, expressions, pos)
+        self.op = op
+        self.func = func
+        self.state = UNINITIALIZED
+        self.native = None
+
+    def call(self, interp, env, tail):
+        proc = self.fn.execute(interp, env)
+        if proc is not self.native:
+            if not (isinstance(proc, LispNativeProc) and
+                    proc.func is self.func):
+                return CallNode.call(self, interp, env, tail)
+            self.native = proc
+        lh = self.args[0].execute(interp, env)
+        rh = self.args[1].execute(interp, env)
+        state = self.state
+        if state == UNINITIALIZED:
+            if isinstance(lh, LispInt) and isinstance(rh, LispInt):
+                state = INT_INT
+            elif isinstance(lh, LispFloat) and isinstance(rh, LispFloat):
+                state = FLOAT_FLOAT
+            else:
+                state = GENERIC
+            self.state = state
+        if state == INT_INT:
+            if isinstance(lh, LispInt) and isinstance(rh, LispInt):
+                res = self.int_op(lh.val_int, rh.val_int)
+                if res is not None:
+                    return res
+            else:
+                self.state = GENERIC
+        elif state == FLOAT_FLOAT:
+            if isinstance(lh, LispFloat) and isinstance(rh, LispFloat):
+                res = self.float_op(lh.val_float, rh.val_float)
+                if res is not None:
+                    return res
+            else:
+                self.state = GENERIC
+        try:
+            return self.func(interp, [lh, rh], env)
+        except LispError, e:
+            if e.pos == NO_POS:
+                raise LispError(e.message, self.pos)
+            raise
+
+    def int_op(self, lh, rh):
+        '''
+        The result for two ints, or None to leave it to the builtin.
+        '''
+        raise NotImplementedError
+
+    def float_op(self, lh, rh):
+        raise NotImplementedError
+
+
+class ArithNode(OperatorNode):
+    __slots__ = ()
+
+    def int_op(self, lh, rh):
+        op = self.op
+        try:
+            if op == builtin.ARITH_ADD:
+                return make_int(ovfcheck(lh + rh))
+            elif op == builtin.ARITH_SUB:
+                return make_int(ovfcheck(lh - rh))
+            elif op == builtin.ARITH_MUL:
+                return make_int(ovfcheck(lh * rh))
+            elif rh != 0:
+                return make_int(ovfcheck(lh / rh))
+        except OverflowError:
+            pass
+        # Leave overflow and division by zero to the builtin.
+        return None
+
+    def float_op(self, lh, rh):
+        op = self.op
+        if op == builtin.ARITH_ADD:
+            return LispFloat(lh + rh)
+        elif op == builtin.ARITH_SUB:
+            return LispFloat(lh - rh)
+        elif op == builtin.ARITH_MUL:
+            return LispFloat(lh * rh)
+        elif rh != 0.0:
+            return LispFloat(lh / rh)
+        return None
+
+
+class CompareNode(OperatorNode):
+    __slots__ = ()
+
+    def int_op(self, lh, rh):
+        return make_bool(compare_ints(lh, rh, self.op))
+
+    def float_op(self, lh, rh):
+        return make_bool(compare_floats(lh, rh, self.op))
+
+
+def _operators():
+    ops = {}
+    for name, op, func in [('+', builtin.ARITH_ADD, builtin.op_add),
+                           ('-', builtin.ARITH_SUB, builtin.op_sub),
+                           ('*', builtin.ARITH_MUL, builtin.op_mul),
+                           ('/', builtin.ARITH_DIV, builtin.op_div)]:
+        ops[intern(name)] = (False, op, func)
+    for name, op, func in [('<', CMP_LT, builtin.op_lt),
+                           ('>', CMP_GT, builtin.op_gt),
+                           ('<=', CMP_LE, builtin.op_le),
+                           ('>=', CMP_GE, builtin.op_ge),
+                           ('=', CMP_EQ, builtin.op_eq)]:
+        ops[intern(name)] = (True, op, func)
+    return ops
+
+# The builtins compiled to an OperatorNode: symbol -> (is a comparison,
+# operator, builtin function).
+operators = _operators()
+
+
+def compile_expr(sexp, scope):
+    '''
+    Compile an expression to be evaluated in environments laid out as scope.
+    '''
+    if isinstance(sexp, LispLocalRef):
+        return LocalRefNode(sexp.symbol, sexp.depth, sexp.slot, sexp.scope,
+                            sexp.pos)
+    elif isinstance(sexp, LispReference):
+        return NameRefNode(sexp.symbol, sexp.pos)
+    elif (sexp is nil or
+          isinstance(sexp, LispNumber) or
+          isinstance(sexp, LispString) or
+          isinstance(sexp, LispBool) or
+          isinstance(sexp, LispVector)):
+        return ConstNode(sexp, sexp.pos)
+    elif isinstance(sexp, LispLambda):
+        return LambdaNode(sexp, sexp.pos)
+    elif isinstance(sexp, LispLet):
+        return compile_let(resolver.let_for(sexp, scope), scope)
+    elif isinstance(sexp, LispDo):
+        return compile_do(resolver.do_for(sexp, scope), scope)
+    elif isinstance(sexp, LispCons):
+        return compile_form(sexp, scope)
+    return ErrorNode("I don't understand %s" % (sexp.typename(),), sexp.pos)
+
+
+def compile_form(sexp, scope):
+    head = sexp.car
+    if isinstance(head, LispReference):
+        if not (isinstance(sexp.cdr, LispCons) or sexp.cdr is nil):
+            return ErrorNode("Expected list of arguments or nil", sexp.pos)
+        node = compile_special_form(head.symbol, sexp, scope)
+        if node is not None:
+            return node
+    elif head is nil and sexp.cdr is nil:
+        return ErrorNode("Attempt to call %s" % (nil.typename(),), sexp.pos)
+
+    expressions = resolver.list_items(sexp.cdr)
+    if expressions is None:
+        return ErrorNode("Expected list of arguments or nil", sexp.pos)
+    args = [compile_expr(e, scope) for e in expressions]
+    fn = None
+    if isinstance(head, LispReference):
+        primitive = builtin.get_primitive(head.symbol)
+        if primitive is not None:
+            # Malformed, so it's left to the builtin to report.
+            fn = ConstNode(primitive, sexp.pos)
+    if fn is None:
+        fn = compile_expr(head, scope)
+    if (isinstance(head, LispReference) and len(args) == 2 and
+            head.symbol in operators):
+        compare, op, func = operators[head.symbol]
+        if compare:
+            return CompareNode(op, func, fn, args, expressions, sexp.pos)
+        return ArithNode(op, func, fn, args, expressions, sexp.pos)
+    return CallNode(fn, args, expressions, sexp.pos)
+
+
+def compile_let(let, scope):
+    return LetNode([compile_expr(v, scope) for v in let.values], let.scope,
+                   compile_expr(let.body, let.scope), let.pos)
+
+
+def compile_do(do, scope):
+    steps = []
+    for step in do.steps:
+        if step is None:
+            steps.append(None)
+        else:
+            steps.append(compile_expr(step, do.scope))
+    return DoNode([compile_expr(i, scope) for i in do.inits], do.scope,
+                  compile_expr(do.test, do.scope),
+                  compile_expr(do.body, do.scope), steps,
+                  compile_expr(do.result, do.scope), do.pos)
+
+
+def compile_special_form(sym, sexp, scope):
+    '''
+    Compile a well-formed special form, or return None to compile sexp as a
+    call.
+    '''
+    try:
+        form = special.desugar(sexp)
+        if form is not None:
+            return compile_expr(form, scope)
+        if sym is Symbols.LET:
+            return compile_let(resolver.resolve_let(sexp, scope), scope)
+        elif sym is Symbols.DO:
+            return compile_do(resolver.resolve_do(sexp, scope), scope)
+    except LispError, e:
+        return ErrorNode(e.message, e.pos)
+    items = resolver.list_items(sexp.cdr)
+    if sym is Symbols.BEGIN:
+        if not items:
+            return ConstNode(nil, sexp.pos)
+        body = [compile_expr(e, scope) for e in items]
+        last = body.pop()
+        return BeginNode(body, last, sexp.pos)
+    elif sym is Symbols.IF:
+        if sexp.cdr is nil:
+            return ErrorNode("Expected list of parameters", sexp.pos)
+        if items is None or len(items) != 3:
+            return ErrorNode("Wrong number of arguments to if", sexp.pos)
+        return IfNode(compile_expr(items[0], scope),
+                      compile_expr(items[1], scope),
+                      compile_expr(items[2], scope), sexp.pos)
+    elif items is None:
+        return None
+    elif sym is Symbols.QUOTE:
+        if len(items) == 1:
+            return ConstNode(items[0], sexp.pos)
+    elif sym is Symbols.DEFINE or sym is Symbols.SET:
+        if len(items) == 2:
+            target = items[0]
+            if isinstance(target, LispReference):
+                value = compile_expr(items[1], scope)
+                if sym is Symbols.DEFINE:
+                    return DefineNode(target.symbol, value, sexp.pos)
+                return SetNode(target.symbol, value, sexp.pos)
+    elif sym is Symbols.LAMBDA:
+        if len(items) == 2:
+            params = resolver.lambda_parameters(items[0])
+            if params is not None:
+                template = resolver.resolve_lambda(params, items[1], scope,
+                                                   sexp)
+                return LambdaNode(template, sexp.pos)
+    return None
+
+
+class CompilingInterpreter(Interpreter):
+    '''
+    An Interpreter that compiles expressions to Node trees before running
+    them.
+    '''
+    def __init__(self):
+        Interpreter.__init__(self)
+        self.tail_proc = None
+        self.tail_args = None
+
+    def evaluate(self, sexp, env):
+        node = compile_expr(sexp, env.scope)
+        try:
+            return node.execute(self, env)
+        except StackOverflow:
+            raise LispError("Stack overflow", sexp.pos)
+
+    def call_closure(self, proc, args, pos):
+        try:
+            while True:
+                template = proc.template
+                code = template.code
+                if code is None:
+                    code = compile_expr(template.body, template.scope)
+                    template.code = code
+                env = self.make_frame(template, args, proc.env)
+                res = code.execute_tail(self, env)
+                if res is not tail_call:
+                    return res
+                proc = self.tail_proc
+                args = self.tail_args
+                self.tail_proc = None
+                self.tail_args = None
+        except StackOverflow:
+            raise LispError("Stack overflow", pos)
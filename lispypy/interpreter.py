@@ -23,22 +23,28 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from .lispobj import (LispCons, LispClosure, LispReference, LispString,
-                      LispNil, LispMacro, LispBool, LispNativeProc)
+                      LispMacro, LispBool, LispNativeProc, LispLocalRef,
+                      LispLambda, LispLet, LispDo, LispVector, Symbols,
+                      intern, nil)
 from .number import LispNumber, LispInt
-from .common import LispError
-from .rpytools import JitDriver, purefunction, StackOverflow
-from . import builtin
+from .common import LispError, NO_POS
+from .tokenizer import location_repr
+from .rpytools import JitDriver, purefunction, specialize, StackOverflow
+from . import builtin, resolver, special
 
 
 class Environment(object):
     '''
     Represents a scope in the LISP environment.
     '''
+    __slots__ = ('dict', 'outer', 'scope')
+
     def __init__(self, parms=[], args=[], outer=None):
         self.dict = {}
         for i in range(len(parms)):
             self.dict[parms[i]] = args[i]
         self.outer = outer
+        self.scope = None
 
     def get(self, key):
         return self.dict[key]
@@ -57,122 +63,480 @@ class Environment(object):
         return self.outer.find(var)
 
 
+class Cell(object):
+    '''
+    A global binding.
+    '''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class GlobalEnvironment(Environment):
+    '''
+    The outermost environment. Each binding lives in a Cell, which
+    references can cache.
+    '''
+    __slots__ = ('cells',)
+
+    def __init__(self, names, values):
+        self.dict = None
+        self.outer = None
+        self.scope = resolver.Scope([], None)
+        self.cells = {}
+        for i in range(len(names)):
+            self.cells[names[i]] = Cell(values[i])
+
+    def cell(self, key):
+        return self.cells.get(key, None)
+
+    def get(self, key):
+        return self.cells[key].value
+
+    def set(self, key, value):
+        cell = self.cells.get(key, None)
+        if cell is None:
+            self.cells[key] = Cell(value)
+        else:
+            cell.value = value
+
+    def keys(self):
+        return self.cells.keys()
+
+    def find(self, var):
+        if var in self.cells:
+            return self
+        return None
+
+
+class Frame(Environment):
+    '''
+    The environment of a closure call. Variables laid out by the closure's
+    Scope live in a fixed array of slots; the dict is only created if the
+    body defines a name the resolver didn't see.
+    '''
+    __slots__ = ('values',)
+
+    def __init__(self, scope, values, outer):
+        self.dict = None
+        self.outer = outer
+        self.scope = scope
+        self.values = values
+
+    def lookup(self, depth, slot):
+        frame = self
+        for i in range(depth):
+            frame = frame.outer
+            assert isinstance(frame, Frame)
+        return frame.values[slot]
+
+    def get(self, key):
+        slot = self.scope.slot_of(key)
+        if slot >= 0 and self.values[slot] is not None:
+            return self.values[slot]
+        return self.dict[key]
+
+    def set(self, key, value):
+        slot = self.scope.slot_of(key)
+        if slot >= 0:
+            self.values[slot] = value
+            return
+        if self.dict is None:
+            self.dict = {}
+        if key not in self.dict:
+            key.shadowed = True
+        self.dict[key] = value
+
+    def keys(self):
+        res = [self.scope.symbols[i] for i in range(len(self.values))
+               if self.values[i] is not None]
+        if self.dict is not None:
+            res.extend(self.dict.keys())
+        return res
+
+    def find(self, var):
+        env = self
+        while isinstance(env, Frame):
+            slot = env.scope.slots.get(var, -1)
+            if slot >= 0 and env.values[slot] is not None:
+                return env
+            if env.dict is not None and var in env.dict:
+                return env
+            env = env.outer
+        return env.find(var)
+
+
+def frame_values(scope, args):
+    '''
+    Return the slot list for a frame laid out by scope, starting with args.
+    '''
+    # A new list: the VM's frames are virtualizable, so the slot lists of
+    # all frames must never be resized. Slots past the parameters are for
+    # names the body defines.
+    values = [None] * max(len(scope.symbols), len(args))
+    for i in range(len(args)):
+        values[i] = args[i]
+    return values
+
+
 def location_name(self, sexp):
-    if not sexp.location:
-        return '???'
-    return sexp.location.repr()
+    return location_repr(sexp.pos)
 
 jitdriver = JitDriver(greens=['self_', 'sexp'], reds=['env'],
-                      get_printable_location=location_name)
+                      get_printable_location=location_name,
+                      is_recursive=True)
+
+
+def do_location(do):
+    return location_repr(do.pos)
+
+do_driver = JitDriver(greens=['do'], reds=['frame', 'self_'],
+                      get_printable_location=do_location)
+
+
+class MacroExpansion(object):
+    '''
+    A macro call evaluated by the tree walker, and its last expansion.
+    '''
+    __slots__ = ('expressions', 'pos', 'macro', 'expansion_scope',
+                 'expansion')
+
+    def __init__(self, expressions, pos):
+        self.expressions = expressions
+        self.pos = pos
+        self.macro = None
+        self.expansion_scope = None
+        self.expansion = None
+
+    def compile_expansion(self, sexp, scope):
+        return resolver.resolve(sexp, scope)
 
 
 class Interpreter(object):
     '''
     A LISP interpreter and its associated state.
     '''
+    # The most call sites whose macro expansions are kept, and the most let
+    # and do forms kept resolved outside a lambda body.
+    MAX_EXPANSIONS = 10000
+
     def __init__(self):
         builtins = builtin.get_all()
-        self.root = Environment([b.name for b in builtins], builtins)
-        self.root.set('nil', LispNil())
+        self.root = GlobalEnvironment([intern(b.name) for b in builtins],
+                                      builtins)
+        self.root.set(Symbols.NIL, nil)
+        # Call site -> MacroExpansion
+        self.expansions = {}
+        # let or do form -> its LispLet or LispDo
+        self.resolved_forms = {}
 
     def evaluate_references(self, sexp, env, to_resolve=()):
         if isinstance(sexp, LispReference):
-            if (not to_resolve) or (sexp.name in to_resolve):
+            if (not to_resolve) or (sexp.symbol in to_resolve):
                 return self.evaluate(sexp, env)
-        elif isinstance(sexp, LispCons):
-            car = self.evaluate_references(sexp.car, env, to_resolve)
-            cdr = self.evaluate_references(sexp.cdr, env, to_resolve)
-            return LispCons(car=car, cdr=cdr, location=sexp.location)
-        return sexp
+            return sexp
+        elif not isinstance(sexp, LispCons):
+            return sexp
+        # Copy the spine iteratively; only the cars are recursed into.
+        res = LispCons(self.evaluate_references(sexp.car, env, to_resolve),
+                       nil, sexp.pos)
+        leaf = res
+        node = sexp.cdr
+        while isinstance(node, LispCons):
+            nxt = LispCons(self.evaluate_references(node.car, env, to_resolve),
+                           nil, node.pos)
+            leaf.cdr = nxt
+            leaf = nxt
+            node = node.cdr
+        leaf.cdr = self.evaluate_references(node, env, to_resolve)
+        return res
+
+    def evaluate_list(self, sexp, env):
+        '''
+        Evaluate each item of a list of expressions.
+        '''
+        res = []
+        while isinstance(sexp, LispCons):
+            res.append(self.evaluate(sexp.car, env))
+            sexp = sexp.cdr
+        return res
+
+    def global_cell(self, sym, env):
+        '''
+        Return the global Cell a reference to sym evaluated in env finds, if
+        nothing between env and the global environment can bind sym; else
+        None.
+        '''
+        if sym.shadowed:
+            return None
+        if not (env is self.root or isinstance(env, Frame)):
+            # Some dictionary-backed environment, e.g. a macro's.
+            return None
+        scope = env.scope
+        while scope is not None:
+            if scope.slot_of(sym) >= 0:
+                return None
+            scope = scope.outer
+        return self.root.cell(sym)
+
+    def lookup_reference(self, ref, env):
+        '''
+        Look a reference up by name, caching the global binding it finds.
+        '''
+        containing = env.find(ref.symbol)
+        if not containing:
+            raise LispError('Name "%s" undefined' % (ref.symbol.name,),
+                            ref.pos)
+        if containing is self.root:
+            cell = self.global_cell(ref.symbol, env)
+            if cell is not None:
+                ref.cell = cell
+                ref.cell_scope = env.scope
+        return containing.get(ref.symbol)
+
+    def expand_macro(self, macro, expressions, env, pos):
+        '''
+        Substitute the unevaluated argument expressions into a macro body.
+        '''
+        if len(expressions) != len(macro.parameters):
+            raise LispError("Expected %d arguments, got %d" % (
+                len(macro.parameters), len(expressions)), pos)
+        return self.evaluate_references(
+            macro.expression,
+            Environment(macro.parameters, expressions, env),
+            to_resolve=macro.parameters)
+
+    @specialize.argtype(1)
+    def cached_expansion(self, site, macro, env):
+        '''
+        Return the expansion of a call of macro at site, as compiled by the
+        site's compile_expansion.
+
+        An expansion depends only on the macro and the call's argument
+        expressions, so it is made once per call site and reused for as
+        long as the call is to the same macro, in the same scope.
+        '''
+        if site.macro is macro and site.expansion_scope is env.scope:
+            return site.expansion
+        sexp = self.expand_macro(macro, site.expressions, env, site.pos)
+        expansion = site.compile_expansion(sexp, env.scope)
+        if macro.parameters:
+            # A macro without parameters substitutes every name in its body
+            # with its value at the call, so only these can be reused.
+            site.macro = macro
+            site.expansion_scope = env.scope
+            site.expansion = expansion
+        return expansion
+
+    def expand_call(self, macro, sexp, env):
+        '''
+        Return the expansion of the macro call sexp.
+        '''
+        site = self.expansions.get(sexp, None)
+        if site is None:
+            if len(self.expansions) >= self.MAX_EXPANSIONS:
+                # Don't keep every call site ever evaluated alive, e.g. in
+                # a long REPL session; busy sites are soon expanded again.
+                self.expansions.clear()
+            expressions = resolver.list_items(sexp.cdr)
+            if expressions is None:
+                raise LispError("Expected list of arguments or nil", sexp.pos)
+            site = MacroExpansion(expressions, sexp.pos)
+            self.expansions[sexp] = site
+        return self.cached_expansion(site, macro, env)
+
+    def make_closure(self, template, env):
+        '''
+        Close a LispLambda over env, with a flat frame of its free variables
+        if that can't change what it sees.
+        '''
+        template = resolver.closure_template(template, env.scope)
+        layout = resolver.flat_layout(template)
+        if layout is not None:
+            closure = self.make_flat_closure(layout, env)
+            if closure is not None:
+                return closure
+        return LispClosure(template, env, template.pos)
+
+    def make_flat_closure(self, layout, env):
+        assert isinstance(env, Frame)
+        values = [None] * len(layout.slots)
+        for i in range(len(layout.slots)):
+            value = env.lookup(layout.depths[i], layout.slots[i])
+            if value is None:
+                # Not defined yet.
+                return None
+            values[i] = value
+        for sym in layout.names:
+            if sym.shadowed:
+                return None
+        for sym in layout.heads:
+            if sym.shadowed:
+                return None
+            cell = self.root.cell(sym)
+            if cell is None:
+                if special.get_special_form(sym) is None:
+                    # It could still be defined as a macro.
+                    return None
+            elif isinstance(cell.value, LispMacro):
+                return None
+        return LispClosure(layout.template,
+                           Frame(layout.scope, values, self.root),
+                           layout.template.pos)
+
+    def make_frame(self, template, args, outer):
+        '''
+        Build the call frame for a closure body.
+        '''
+        return Frame(template.scope, frame_values(template.scope, args),
+                     outer)
 
     def evaluate(self, sexp, env):
         try:
             while True:
                 jitdriver.jit_merge_point(self_=self, sexp=sexp, env=env)
                 if isinstance(sexp, LispReference):
+                    if (isinstance(sexp, LispLocalRef) and
+                            sexp.scope is env.scope):
+                        # Lexically addressed local variable.
+                        assert isinstance(env, Frame)
+                        if sexp.depth == 0:
+                            value = env.values[sexp.slot]
+                        else:
+                            value = env.lookup(sexp.depth, sexp.slot)
+                        if value is not None:
+                            return value
+                        # Defined in the body but not bound yet; fall back
+                        # to looking it up by name.
                     # Evaluate a reference.
-                    containing = env.find(sexp.name)
-                    if not containing:
-                        raise LispError('Name "%s" undefined' % (sexp.name),
-                                        sexp.location)
-                    return containing.get(sexp.name)
-                elif (isinstance(sexp, LispNil) or
+                    cell = sexp.cell
+                    if (cell is not None and sexp.cell_scope is env.scope and
+                            not sexp.symbol.shadowed):
+                        return cell.value
+                    return self.lookup_reference(sexp, env)
+                elif (sexp is nil or
                       isinstance(sexp, LispNumber) or
-                      isinstance(sexp, LispString)):
+                      isinstance(sexp, LispString) or
+                      isinstance(sexp, LispBool) or
+                      isinstance(sexp, LispVector)):
                     # Constant literal.
                     return sexp
+                elif isinstance(sexp, LispLambda):
+                    return self.make_closure(sexp, env)
+                elif isinstance(sexp, LispLet):
+                    let = resolver.let_for(sexp, env.scope)
+                    values = [self.evaluate(v, env) for v in let.values]
+                    env = Frame(let.scope, frame_values(let.scope, values),
+                                env)
+                    sexp = let.body
+                    continue
+                elif isinstance(sexp, LispDo):
+                    do = resolver.do_for(sexp, env.scope)
+                    values = [self.evaluate(v, env) for v in do.inits]
+                    env = Frame(do.scope, frame_values(do.scope, values), env)
+                    self.run_do(do, env)
+                    sexp = do.result
+                    continue
                 elif isinstance(sexp, LispCons):
                     # The expression is a cons. What to do?
-                    if isinstance(sexp.car, LispReference):
+                    car = sexp.car
+                    if isinstance(car, LispReference):
                         # Sanity check
-                        if not (isinstance(sexp.cdr, LispCons) or isinstance(sexp.cdr, LispNil)):
-                            raise LispError("Expected list of arguments or nil", sexp.location)
-
-                        if sexp.car.name == 'begin':
-                            if isinstance(sexp.cdr, LispCons):
-                                expressions = sexp.cdr.unwrap()
-                                slice_end = len(expressions)-1
-                                if slice_end > 0:
-                                    for exp in expressions[0:slice_end]:
-                                        self.evaluate(exp, env)
-                                sexp = expressions[-1]
-                            continue
+                        if not (isinstance(sexp.cdr, LispCons) or sexp.cdr is nil):
+                            raise LispError("Expected list of arguments or nil", sexp.pos)
 
-                        elif sexp.car.name == 'if':
-                            if not isinstance(sexp.cdr, LispCons):
-                                raise LispError("Expected list of parameters", sexp.location)
-                            try:
-                                (cond, t, f) = sexp.cdr.unwrap()
-                            except ValueError:
-                                raise LispError("Wrong number of arguments to if",
-                                                sexp.location)
-                            res = self.evaluate(cond, env)
-                            if self.check_bool(res):
-                                sexp = t
-                            else:
-                                sexp = f
+                        form = special.get_special_form(car.symbol)
+                        if form is not None:
+                            sexp = form.evaluate(self, sexp, env)
                             continue
+                        proc = builtin.get_primitive(car.symbol)
+                    else:
+                        proc = None
 
-                    expressions = sexp.unwrap()
-                    proc = self.evaluate(expressions.pop(0), env)
+                    if proc is None:
+                        proc = self.evaluate(sexp.car, env)
                     if isinstance(proc, LispNativeProc):
                         try:
                             if proc.evaluate_args:
-                                args = [self.evaluate(e, env) for e in expressions]
+                                args = self.evaluate_list(sexp.cdr, env)
                             else:
-                                args = expressions
+                                args = resolver.list_items(sexp.cdr)
+                                if args is None:
+                                    raise LispError(
+                                        "Expected list of arguments or nil",
+                                        sexp.pos)
                             return proc.func(self, args, env)
                         except LispError, e:
-                            if e.location is None:
-                                raise LispError(e.message, sexp.location)
+                            if e.pos == NO_POS:
+                                raise LispError(e.message, sexp.pos)
                             raise
                     elif isinstance(proc, LispClosure):
-                        args = [self.evaluate(ex, env) for ex in expressions]
-                        if len(args) != len(proc.parameters):
+                        args = self.evaluate_list(sexp.cdr, env)
+                        template = proc.template
+                        if len(args) != len(template.parameters):
                             raise LispError("Expected %d arguments, got %d" % (
-                                len(proc.parameters), len(args)), sexp.location)
-                        sexp = proc.expression
-                        env = Environment(proc.parameters, args, proc.env)
+                                len(template.parameters), len(args)), sexp.pos)
+                        sexp = template.body
+                        env = self.make_frame(template, args, proc.env)
                         jitdriver.can_enter_jit(self_=self, sexp=sexp, env=env)
                         continue
 
                     elif isinstance(proc, LispMacro):
-                        if len(expressions) != len(proc.parameters):
-                            raise LispError("Expected %d arguments, got %d" % (
-                                len(proc.parameters), len(expressions)), sexp.location)
-                        sexp = self.evaluate_references(
-                            proc.expression,
-                            Environment(proc.parameters, expressions, env),
-                            to_resolve=proc.parameters)
+                        sexp = self.expand_call(proc, sexp, env)
                         jitdriver.can_enter_jit(self_=self, sexp=sexp, env=env)
                         continue
                     else:
                         raise LispError("Attempt to call %s" % (proc.typename(),),
-                                        proc.location)
+                                        proc.pos)
                 else:
-                    raise LispError("I don't understand %s" % (sexp.typename(),), sexp.location)
+                    raise LispError("I don't understand %s" % (sexp.typename(),), sexp.pos)
         except StackOverflow:
-            raise LispError("Stack overflow", sexp.location)
+            raise LispError("Stack overflow", sexp.pos)
+
+    def call_procedure(self, proc, args, pos):
+        '''
+        Call a procedure with evaluated arguments on behalf of a builtin.
+        '''
+        if isinstance(proc, LispClosure):
+            template = proc.template
+            if len(args) != len(template.parameters):
+                raise LispError("Expected %d arguments, got %d" % (
+                    len(template.parameters), len(args)), pos)
+            return self.call_closure(proc, args, pos)
+        elif isinstance(proc, LispNativeProc) and proc.evaluate_args:
+            try:
+                return proc.func(self, args, self.root)
+            except LispError, e:
+                if e.pos == NO_POS:
+                    raise LispError(e.message, pos)
+                raise
+        raise LispError("Attempt to call %s" % (proc.typename(),), pos)
+
+    def call_closure(self, proc, args, pos):
+        return self.evaluate(proc.template.body,
+                             self.make_frame(proc.template, args, proc.env))
+
+    def run_do(self, do, frame):
+        '''
+        Run the iterations of a do loop in frame, updating its variables in
+        place, until the loop's test is true.
+        '''
+        while True:
+            do_driver.jit_merge_point(do=do, frame=frame, self_=self)
+            steps = do.steps
+            if self.check_bool(self.evaluate(do.test, frame)):
+                return
+            self.evaluate(do.body, frame)
+            new_values = [None] * len(steps)
+            for i in range(len(steps)):
+                step = steps[i]
+                if step is not None:
+                    new_values[i] = self.evaluate(step, frame)
+            for i in range(len(steps)):
+                if steps[i] is not None:
+                    frame.values[i] = new_values[i]
+            do_driver.can_enter_jit(do=do, frame=frame, self_=self)
 
     @purefunction
     def check_str(self, s):
@@ -180,7 +544,7 @@ class Interpreter(object):
 
     @purefunction
     def check_ref(self, s):
-        return self.check_value(s, LispReference).name
+        return self.check_value(s, LispReference).symbol
 
     @purefunction
     def check_bool(self, s):
@@ -195,7 +559,8 @@ class Interpreter(object):
         return self.check_value(s, LispCons).unwrap()
 
     @purefunction
+    @specialize.arg(2)
     def check_value(self, v, cls):
         if not isinstance(v, cls):
-            raise LispError('Expected %s, got %s' % (cls._typename, v.typename()), v.location)
+            raise LispError('Expected %s, got %s' % (cls._typename, v.typename()), v.pos)
         return v
@@ -22,21 +22,21 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from .common import bytetohex, shorttohex, hexchartoint
+from .common import bytetohex, shorttohex, hexchartoint, NO_POS
 from rpytools import purefunction
-from parser import parsable
+from parser import parsable, K_SYMBOL, K_STRING, K_HASH
 
 
-@parsable(0)
 class LispObject(object):
     _typename = 'N/A'
+    __slots__ = ('pos',)
 
     @purefunction
     def typename(self):
         return self._typename
 
-    def __init__(self, location=None):
-        self.location = location
+    def __init__(self, pos=NO_POS):
+        self.pos = pos
 
     @staticmethod
     def parse(data):
@@ -51,15 +51,21 @@ class LispObject(object):
 
 class LispNil(LispObject):
     _typename = 'Nil'
+    __slots__ = ()
 
 
-@parsable(6)
+# The one nil. Nothing else creates a LispNil, so nil checks can use 'is'.
+nil = LispNil()
+
+
+@parsable(6, K_HASH)
 class LispBool(LispObject):
     _typename = 'bool'
+    __slots__ = ('value',)
 
-    def __init__(self, value, location=None):
+    def __init__(self, value, pos=NO_POS):
         self.value = value
-        self.location = location
+        self.pos = pos
 
     def repr(self):
         if self.value:
@@ -75,56 +81,236 @@ class LispBool(LispObject):
         raise ValueError("Invalid boolean literal")
 
 
-@parsable(1)
+# Shared results for comparisons. Parsed literals get their own instances,
+# since those carry a source position.
+true = LispBool(True)
+false = LispBool(False)
+
+
+def make_bool(value):
+    if value:
+        return true
+    return false
+
+
+class Symbol(object):
+    '''
+    An interned name. There is exactly one Symbol per name, so symbols are
+    compared by identity.
+
+    shadowed is set once the name is bound in a call frame's dictionary;
+    from then on, global bindings cached for it are not trusted.
+    '''
+    __slots__ = ('name', 'shadowed')
+
+    def __init__(self, name):
+        self.name = name
+        self.shadowed = False
+
+    def repr(self):
+        return self.name
+    __repr__ = repr
+
+
+class SymbolTable(object):
+    '''
+    Maps names to their unique Symbol.
+    '''
+    def __init__(self):
+        self.symbols = {}
+
+    def intern(self, name):
+        sym = self.symbols.get(name, None)
+        if sym is None:
+            sym = Symbol(name)
+            self.symbols[name] = sym
+        return sym
+
+
+symbol_table = SymbolTable()
+
+
+def intern(name):
+    return symbol_table.intern(name)
+
+
+class Symbols(object):
+    '''
+    Symbols the interpreter itself refers to.
+    '''
+    BEGIN = intern('begin')
+    IF = intern('if')
+    QUOTE = intern('quote')
+    NIL = intern('nil')
+    LAMBDA = intern('lambda')
+    DEFINE = intern('define')
+    SET = intern('set!')
+    CREATE_MACRO = intern('create-macro')
+    COND = intern('cond')
+    ELSE = intern('else')
+    AND = intern('and')
+    OR = intern('or')
+    WHEN = intern('when')
+    LET = intern('let')
+    DO = intern('do')
+
+
+@parsable(1, K_SYMBOL)
 class LispReference(LispObject):
+    '''
+    A reference to a variable by name.
+
+    A reference that found a global binding caches its Cell, along with the
+    scope of the environment it was evaluated in.
+    '''
     _typename = 'reference'
+    __slots__ = ('symbol', 'cell', 'cell_scope')
 
-    def __init__(self, name, location=None):
-        self.name = name
-        self.location = location
+    def __init__(self, symbol, pos=NO_POS):
+        self.symbol = symbol
+        self.cell = None
+        self.cell_scope = None
+        self.pos = pos
 
     @staticmethod
     def parse(data):
-        return LispReference(data)
+        return LispReference(intern(data))
 
     def repr(self):
-        return self.name
+        return self.symbol.name
+
+
+class LispLocalRef(LispReference):
+    '''
+    A reference resolved to a slot of an enclosing call frame.
+
+    depth counts frames outward from the one described by scope, which is
+    the frame the reference is evaluated in.
+    '''
+    __slots__ = ('depth', 'slot', 'scope')
+
+    def __init__(self, symbol, depth, slot, scope, pos=NO_POS):
+        self.symbol = symbol
+        self.cell = None
+        self.cell_scope = None
+        self.depth = depth
+        self.slot = slot
+        self.scope = scope
+        self.pos = pos
+
+
+class LispLambda(LispObject):
+    '''
+    A lambda form whose body has been resolved against its scope. Evaluating
+    it creates a closure.
+
+    code and bytecode cache the body as compiled by the closure-compilation
+    and bytecode backends, and layout the resolver's FlatLayout for its
+    closures.
+    '''
+    _typename = 'lambda'
+    __slots__ = ('parameters', 'body', 'scope', 'source', 'code', 'bytecode',
+                 'layout')
+
+    def __init__(self, parameters, body, scope, source, pos=NO_POS):
+        self.parameters = parameters
+        self.body = body
+        self.scope = scope
+        self.source = source
+        self.code = None
+        self.bytecode = None
+        self.layout = None
+        self.pos = pos
+
+    def repr(self):
+        return self.source.repr()
+
+
+class LispLet(LispObject):
+    '''
+    A let form resolved like a lambda: the values are resolved against the
+    enclosing scope and the body against the let's own, which starts with
+    the bound names.
+    '''
+    _typename = 'let'
+    __slots__ = ('values', 'body', 'scope', 'source')
+
+    def __init__(self, values, body, scope, source, pos=NO_POS):
+        self.values = values
+        self.body = body
+        self.scope = scope
+        self.source = source
+        self.pos = pos
+
+    def repr(self):
+        return self.source.repr()
+
+
+class LispDo(LispObject):
+    '''
+    A do loop resolved like a let: the initial values are resolved against
+    the enclosing scope, and the test, body, steps and result against the
+    loop's own, which starts with the loop variables. steps has an entry
+    for each variable, None for those without a step.
+    '''
+    _typename = 'do'
+    __slots__ = ('inits', 'steps', 'test', 'body', 'result', 'scope',
+                 'source')
+
+    def __init__(self, inits, steps, test, body, result, scope, source,
+                 pos=NO_POS):
+        self.inits = inits
+        self.steps = steps
+        self.test = test
+        self.body = body
+        self.result = result
+        self.scope = scope
+        self.source = source
+        self.pos = pos
+
+    def repr(self):
+        return self.source.repr()
 
 
 class LispNativeProc(LispObject):
     _typename = 'NativeProc'
+    __slots__ = ('func', 'name', 'evaluate_args')
 
-    def __init__(self, func, name, evaluate_args=True, location=None):
+    def __init__(self, func, name, evaluate_args=True, pos=NO_POS):
         self.func = func
         self.name = name
         self.evaluate_args = evaluate_args
-        self.location = location
+        self.pos = pos
 
     def repr(self):
         return self.name
 
 
 class LispClosure(LispObject):
+    '''
+    A LispLambda closed over the environment it was evaluated in.
+    '''
     _typename = 'closure'
+    __slots__ = ('template', 'env')
 
-    def __init__(self, parameters, expression, env, location=None):
-        self.parameters = parameters
-        self.expression = expression
-        self.location = location
+    def __init__(self, template, env, pos=NO_POS):
+        self.template = template
         self.env = env
+        self.pos = pos
 
     def repr(self):
-        return '(lambda %s %s)' % (LispCons.wrap([LispReference(s) for s in self.parameters]).repr(),
-                                   self.expression.repr())
+        return '(lambda %s %s)' % (LispCons.wrap([LispReference(s) for s in self.template.parameters]).repr(),
+                                   self.template.body.repr())
 
 
 class LispMacro(LispObject):
     _typename = 'macro'
+    __slots__ = ('parameters', 'expression')
 
-    def __init__(self, parameters, expression, location=None):
+    def __init__(self, parameters, expression, pos=NO_POS):
         self.parameters = parameters
         self.expression = expression
-        self.location = location
+        self.pos = pos
 
     def repr(self):
         return '(create-macro %s %s)' % (LispCons.wrap([LispReference(s) for s in self.parameters]).repr(),
@@ -133,49 +319,71 @@ class LispMacro(LispObject):
 
 class LispCons(LispObject):
     _typename = 'cons'
+    __slots__ = ('car', 'cdr')
 
-    def __init__(self, car, cdr, location=None):
+    def __init__(self, car, cdr, pos=NO_POS):
         self.car = car
         self.cdr = cdr
-        self.location = location
+        self.pos = pos
 
     @staticmethod
     def wrap(l):
         if not l:
-            return LispCons(LispNil(), LispNil())
-        head = LispCons(None, None)
-        node = head
-        while l:
-            node.car = l.pop(0)
-            if l:
-                node.cdr = LispCons(None, None)
-                node = node.cdr
-        node.cdr = LispNil()
-        return head
+            return LispCons(nil, nil)
+        res = nil
+        i = len(l)
+        while i > 0:
+            i -= 1
+            res = LispCons(l[i], res)
+        return res
 
     def unwrap(self):
-        if isinstance(self.car, LispNil):
-            return []
-        elif isinstance(self.cdr, LispNil):
-            return [self.car]
-        assert isinstance(self.cdr, LispCons)
-        return [self.car] + self.cdr.unwrap()
+        res = []
+        node = self
+        while node.car is not nil:
+            res.append(node.car)
+            if node.cdr is nil:
+                break
+            node = node.cdr
+            assert isinstance(node, LispCons)
+        return res
 
     def repr(self):
-        if isinstance(self.cdr, LispCons) or isinstance(self.cdr, LispNil):
+        if isinstance(self.cdr, LispCons) or self.cdr is nil:
             items = self.unwrap()
             return '(' + ' '.join([o.repr() for o in items]) + ')'
         else:
             return '(%s . %s)' % (self.car.repr(), self.cdr.repr())
 
 
-@parsable(5)
+class LispVector(LispObject):
+    '''
+    A fixed-length array of objects, indexed in constant time.
+
+    A vector written as a #(...) literal is a constant shared by every
+    evaluation of it, so it can't be modified.
+    '''
+    _typename = 'vector'
+    _immutable_fields_ = ['literal']
+    __slots__ = ('items', 'literal')
+
+    def __init__(self, items, pos=NO_POS, literal=False):
+        self.items = items
+        self.pos = pos
+        self.literal = literal
+
+    def repr(self):
+        return '#(' + ' '.join([o.repr() for o in self.items]) + ')'
+
+
+@parsable(5, K_STRING)
 class LispString(LispObject):
     _typename = 'string'
+    __slots__ = ('val_str',)
 
-    def __init__(self, val, location=None):
+    def __init__(self, val, pos=NO_POS):
         self.val_str = val
-        self.location = location
+        self.pos = pos
 
     @staticmethod
     def parse(data):
@@ -22,111 +22,69 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+'''
+Numeric types.
+
+Each number class has a small type tag, and arithmetic and comparison
+dispatch through tables indexed by the tags of both operands, so a mixed
+operation costs two lookups instead of a chain of isinstance checks.
+Tags are ordered by width: a float operand makes the result a float,
+otherwise a bigint operand makes it a bigint.
+'''
+
 from .lispobj import LispObject
 from .rpytools import rbigint, ovfcheck
-from .parser import parsable
-from .common import strtod
+from .parser import parsable, K_INTEGER, K_DECIMAL
+from .common import strtod, NO_POS
+
+TAG_INT = 0
+TAG_BIGINT = 1
+TAG_FLOAT = 2
+
+# Comparison operators for LispNumber.compare.
+CMP_LT = 0
+CMP_GT = 1
+CMP_LE = 2
+CMP_GE = 3
+CMP_EQ = 4
+
+# The operator that gives the same answer with the operands swapped.
+cmp_mirror = [CMP_GT, CMP_LT, CMP_GE, CMP_LE, CMP_EQ]
 
 
 class LispNumber(LispObject):
     _typename = 'number'
+    __slots__ = ()
+    tag = -1
 
     def op_add(self, rhs):
-        raise NotImplementedError("operation on base LispNumber")
+        return add_table[self.tag][rhs.tag](self, rhs)
 
     def op_sub(self, rhs):
-        raise NotImplementedError("operation on base LispNumber")
+        return sub_table[self.tag][rhs.tag](self, rhs)
 
     def op_mul(self, rhs):
-        raise NotImplementedError("operation on base LispNumber")
+        return mul_table[self.tag][rhs.tag](self, rhs)
 
     def op_div(self, rhs):
-        raise NotImplementedError("operation on base LispNumber")
+        return div_table[self.tag][rhs.tag](self, rhs)
+
+    def compare(self, rhs, op):
+        '''
+        Return whether self op rhs holds, for one of the CMP_* operators.
+        '''
+        return compare_table[self.tag][rhs.tag](self, rhs, op)
 
 
-@parsable(4)
+@parsable(4, K_INTEGER)
 class LispInt(LispNumber):
     _typename = 'int'
+    __slots__ = ('val_int',)
+    tag = TAG_INT
 
-    def __init__(self, val, location=None):
+    def __init__(self, val, pos=NO_POS):
         self.val_int = val
-        self.location = location
-
-    def op_add(self, rhs):
-        if isinstance(rhs, LispInt):
-            # int + int
-            try:
-                # regular addition
-                return LispInt(ovfcheck(self.val_int + rhs.val_int))
-            except OverflowError:
-                # overflow - return as a bigint
-                return LispBigint(rbigint.fromint(self.val_int).add(
-                                  rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # int + bigint
-            return LispBigint(
-                rbigint.fromint(self.val_int).add(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # int + float
-            return LispFloat(float(self.val_int) + rhs.val_float)
-        raise TypeError(rhs)
-
-    def op_sub(self, rhs):
-        if isinstance(rhs, LispInt):
-            # int - int
-            try:
-                # regular subtraction
-                return LispInt(ovfcheck(self.val_int - rhs.val_int))
-            except OverflowError:
-                # overflow - return as a bigint
-                return LispBigint(rbigint.fromint(self.val_int).sub(
-                                  rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # int - bigint
-            return LispBigint(
-                rbigint.fromint(self.val_int).sub(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # int - float
-            return LispFloat(float(self.val_int) - rhs.val_float)
-        raise TypeError(rhs)
-
-    def op_mul(self, rhs):
-        if isinstance(rhs, LispInt):
-            # int * int
-            try:
-                # regular multiplication
-                return LispInt(ovfcheck(self.val_int * rhs.val_int))
-            except OverflowError:
-                # overflow - return as a bigint
-                return LispBigint(rbigint.fromint(self.val_int).mul(
-                                  rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # int * bigint
-            return LispBigint(
-                rbigint.fromint(self.val_int).mul(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # int * float
-            return LispFloat(float(self.val_int) * rhs.val_float)
-        raise TypeError(rhs)
-
-    def op_div(self, rhs):
-        if isinstance(rhs, LispInt):
-            # int / int
-            try:
-                # regular division
-                return LispInt(ovfcheck(self.val_int / rhs.val_int))
-            except OverflowError:
-                # overflow - return as a bigint
-                return LispBigint(rbigint.fromint(self.val_int).div(
-                                  rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # int / bigint
-            return LispBigint(
-                rbigint.fromint(self.val_int).div(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # int / float
-            return LispFloat(float(self.val_int) / rhs.val_float)
-        raise TypeError(rhs)
+        self.pos = pos
 
     @staticmethod
     def parse(data):
@@ -136,69 +94,39 @@ class LispInt(LispNumber):
         return '%s' % self.val_int
 
 
-@parsable(3)
-class LispBigint(LispNumber):
-    _typename = 'bigint'
+# Preallocated LispInts for common small values.
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1024
+small_ints = [LispInt(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
 
-    def __init__(self, val, location=None):
-        self.val_bigint = val
-        self.location = location
 
-    def op_add(self, rhs):
-        if isinstance(rhs, LispInt):
-            # bigint + int
-            return LispBigint(
-                self.val_bigint.add(rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # bigint + bigint
-            return LispBigint(self.val_bigint.add(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # bigint + float
-            return LispFloat(self.val_bigint.tofloat() + rhs.val_float)
-        raise TypeError(rhs)
+def make_int(value):
+    '''
+    Box an int result, sharing the cached instance for small values.
+    '''
+    if SMALL_INT_MIN <= value <= SMALL_INT_MAX:
+        return small_ints[value - SMALL_INT_MIN]
+    return LispInt(value)
 
-    def op_sub(self, rhs):
-        if isinstance(rhs, LispInt):
-            # bigint - int
-            return LispBigint(
-                self.val_bigint.sub(rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # bigint - bigint
-            return LispBigint(self.val_bigint.sub(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # bigint - float
-            return LispFloat(self.val_bigint.tofloat() - rhs.val_float)
-        raise TypeError(rhs)
 
-    def op_mul(self, rhs):
-        if isinstance(rhs, LispInt):
-            # bigint * int
-            return LispBigint(
-                self.val_bigint.mul(rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # bigint * bigint
-            return LispBigint(self.val_bigint.mul(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # bigint * float
-            return LispFloat(self.val_bigint.tofloat() * rhs.val_float)
-        raise TypeError(rhs)
+@parsable(3, K_INTEGER)
+class LispBigint(LispNumber):
+    _typename = 'bigint'
+    __slots__ = ('val_bigint',)
+    tag = TAG_BIGINT
 
-    def op_div(self, rhs):
-        if isinstance(rhs, LispInt):
-            # bigint / int
-            return LispBigint(
-                self.val_bigint.div(rbigint.fromint(rhs.val_int)))
-        elif isinstance(rhs, LispBigint):
-            # bigint / bigint
-            return LispBigint(self.val_bigint.div(rhs.val_bigint))
-        elif isinstance(rhs, LispFloat):
-            # bigint / float
-            return LispFloat(self.val_bigint.tofloat() / rhs.val_float)
-        raise TypeError(rhs)
+    def __init__(self, val, pos=NO_POS):
+        self.val_bigint = val
+        self.pos = pos
 
     @staticmethod
     def parse(data):
-        for c in data:
+        digits = data
+        if digits.startswith('-'):
+            digits = digits[1:]
+        if not digits:
+            raise ValueError('Invalid bigint literal')
+        for c in digits:
             if c not in '0123456789':
                 raise ValueError('Invalid bigint literal')
         return LispBigint(rbigint.fromdecimalstr(data))
@@ -207,61 +135,15 @@ class LispBigint(LispNumber):
         return self.val_bigint.repr()
 
 
-@parsable(2)
+@parsable(2, K_DECIMAL)
 class LispFloat(LispNumber):
     _typename = 'float'
+    __slots__ = ('val_float',)
+    tag = TAG_FLOAT
 
-    def __init__(self, val, location=None):
+    def __init__(self, val, pos=NO_POS):
         self.val_float = val
-        self.location = location
-
-    def op_add(self, rhs):
-        if isinstance(rhs, LispInt):
-            # float + int
-            return LispFloat(self.val_float + float(rhs.val_int))
-        elif isinstance(rhs, LispBigint):
-            # float + bigint
-            return LispFloat(self.val_float + rhs.val_bigint.tofloat())
-        elif isinstance(rhs, LispFloat):
-            # float + float
-            return LispFloat(self.val_float + rhs.val_float)
-        raise TypeError(rhs)
-
-    def op_sub(self, rhs):
-        if isinstance(rhs, LispInt):
-            # float - int
-            return LispFloat(self.val_float - float(rhs.val_int))
-        elif isinstance(rhs, LispBigint):
-            # float - bigint
-            return LispFloat(self.val_float - rhs.val_bigint.tofloat())
-        elif isinstance(rhs, LispFloat):
-            # float - float
-            return LispFloat(self.val_float - rhs.val_float)
-        raise TypeError(rhs)
-
-    def op_mul(self, rhs):
-        if isinstance(rhs, LispInt):
-            # float * int
-            return LispFloat(self.val_float * float(rhs.val_int))
-        elif isinstance(rhs, LispBigint):
-            # float * bigint
-            return LispFloat(self.val_float * rhs.val_bigint.tofloat())
-        elif isinstance(rhs, LispFloat):
-            # float * float
-            return LispFloat(self.val_float * rhs.val_float)
-        raise TypeError(rhs)
-
-    def op_div(self, rhs):
-        if isinstance(rhs, LispInt):
-            # float / int
-            return LispFloat(self.val_float / float(rhs.val_int))
-        elif isinstance(rhs, LispBigint):
-            # float / bigint
-            return LispFloat(self.val_float / rhs.val_bigint.tofloat())
-        elif isinstance(rhs, LispFloat):
-            # float / float
-            return LispFloat(self.val_float / rhs.val_float)
-        raise TypeError(rhs)
+        self.pos = pos
 
     @staticmethod
     def parse(data):
@@ -269,3 +151,219 @@ class LispFloat(LispNumber):
 
     def repr(self):
         return '%f' % self.val_float
+
+
+def int_value(num):
+    assert isinstance(num, LispInt)
+    return num.val_int
+
+
+def bigint_value(num):
+    assert isinstance(num, LispBigint)
+    return num.val_bigint
+
+
+def float_value(num):
+    '''
+    Any number as a float.
+    '''
+    if isinstance(num, LispInt):
+        return float(num.val_int)
+    elif isinstance(num, LispBigint):
+        return num.val_bigint.tofloat()
+    assert isinstance(num, LispFloat)
+    return num.val_float
+
+
+# int op int: stay unboxed unless the result overflows.
+
+def add_int_int(lh, rh):
+    a, b = int_value(lh), int_value(rh)
+    try:
+        return make_int(ovfcheck(a + b))
+    except OverflowError:
+        return LispBigint(rbigint.fromint(a).add(rbigint.fromint(b)))
+
+
+def sub_int_int(lh, rh):
+    a, b = int_value(lh), int_value(rh)
+    try:
+        return make_int(ovfcheck(a - b))
+    except OverflowError:
+        return LispBigint(rbigint.fromint(a).sub(rbigint.fromint(b)))
+
+
+def mul_int_int(lh, rh):
+    a, b = int_value(lh), int_value(rh)
+    try:
+        return make_int(ovfcheck(a * b))
+    except OverflowError:
+        return LispBigint(rbigint.fromint(a).mul(rbigint.fromint(b)))
+
+
+def div_int_int(lh, rh):
+    a, b = int_value(lh), int_value(rh)
+    try:
+        return make_int(ovfcheck(a / b))
+    except OverflowError:
+        return LispBigint(rbigint.fromint(a).div(rbigint.fromint(b)))
+
+
+# Mixes of int and bigint add, subtract, multiply and compare with
+# rbigint's int_* operations, which take the int operand as it is. Division
+# has no such operation, so it converts the int to a bigint first.
+
+def add_int_bigint(lh, rh):
+    return LispBigint(bigint_value(rh).int_add(int_value(lh)))
+
+
+def sub_int_bigint(lh, rh):
+    return LispBigint(bigint_value(rh).int_sub(int_value(lh)).neg())
+
+
+def mul_int_bigint(lh, rh):
+    return LispBigint(bigint_value(rh).int_mul(int_value(lh)))
+
+
+def div_int_bigint(lh, rh):
+    return LispBigint(rbigint.fromint(int_value(lh)).div(bigint_value(rh)))
+
+
+def add_bigint_int(lh, rh):
+    return LispBigint(bigint_value(lh).int_add(int_value(rh)))
+
+
+def sub_bigint_int(lh, rh):
+    return LispBigint(bigint_value(lh).int_sub(int_value(rh)))
+
+
+def mul_bigint_int(lh, rh):
+    return LispBigint(bigint_value(lh).int_mul(int_value(rh)))
+
+
+def div_bigint_int(lh, rh):
+    return LispBigint(bigint_value(lh).div(rbigint.fromint(int_value(rh))))
+
+
+def add_bigint_bigint(lh, rh):
+    return LispBigint(bigint_value(lh).add(bigint_value(rh)))
+
+
+def sub_bigint_bigint(lh, rh):
+    return LispBigint(bigint_value(lh).sub(bigint_value(rh)))
+
+
+def mul_bigint_bigint(lh, rh):
+    return LispBigint(bigint_value(lh).mul(bigint_value(rh)))
+
+
+def div_bigint_bigint(lh, rh):
+    return LispBigint(bigint_value(lh).div(bigint_value(rh)))
+
+
+# Anything involving a float is done in floats.
+
+def add_float(lh, rh):
+    return LispFloat(float_value(lh) + float_value(rh))
+
+
+def sub_float(lh, rh):
+    return LispFloat(float_value(lh) - float_value(rh))
+
+
+def mul_float(lh, rh):
+    return LispFloat(float_value(lh) * float_value(rh))
+
+
+def div_float(lh, rh):
+    return LispFloat(float_value(lh) / float_value(rh))
+
+
+# Tables indexed by [lh.tag][rh.tag].
+
+add_table = [[add_int_int, add_int_bigint, add_float],
+             [add_bigint_int, add_bigint_bigint, add_float],
+             [add_float, add_float, add_float]]
+
+sub_table = [[sub_int_int, sub_int_bigint, sub_float],
+             [sub_bigint_int, sub_bigint_bigint, sub_float],
+             [sub_float, sub_float, sub_float]]
+
+mul_table = [[mul_int_int, mul_int_bigint, mul_float],
+             [mul_bigint_int, mul_bigint_bigint, mul_float],
+             [mul_float, mul_float, mul_float]]
+
+div_table = [[div_int_int, div_int_bigint, div_float],
+             [div_bigint_int, div_bigint_bigint, div_float],
+             [div_float, div_float, div_float]]
+
+
+def compare_ints(a, b, op):
+    if op == CMP_LT:
+        return a < b
+    elif op == CMP_GT:
+        return a > b
+    elif op == CMP_LE:
+        return a <= b
+    elif op == CMP_GE:
+        return a >= b
+    return a == b
+
+
+def compare_floats(a, b, op):
+    if op == CMP_LT:
+        return a < b
+    elif op == CMP_GT:
+        return a > b
+    elif op == CMP_LE:
+        return a <= b
+    elif op == CMP_GE:
+        return a >= b
+    return a == b
+
+
+def compare_bigint_to_int(a, b, op):
+    if op == CMP_LT:
+        return a.int_lt(b)
+    elif op == CMP_GT:
+        return a.int_gt(b)
+    elif op == CMP_LE:
+        return a.int_le(b)
+    elif op == CMP_GE:
+        return a.int_ge(b)
+    return a.int_eq(b)
+
+
+def compare_int_int(lh, rh, op):
+    return compare_ints(int_value(lh), int_value(rh), op)
+
+
+def compare_int_bigint(lh, rh, op):
+    return compare_bigint_to_int(bigint_value(rh), int_value(lh),
+                                 cmp_mirror[op])
+
+
+def compare_bigint_int(lh, rh, op):
+    return compare_bigint_to_int(bigint_value(lh), int_value(rh), op)
+
+
+def compare_bigint_bigint(lh, rh, op):
+    a, b = bigint_value(lh), bigint_value(rh)
+    if op == CMP_LT:
+        return a.lt(b)
+    elif op == CMP_GT:
+        return a.gt(b)
+    elif op == CMP_LE:
+        return a.le(b)
+    elif op == CMP_GE:
+        return a.ge(b)
+    return a.eq(b)
+
+
+def compare_float(lh, rh, op):
+    return compare_floats(float_value(lh), float_value(rh), op)
+
+
+compare_table = [[compare_int_int, compare_int_bigint, compare_float],
+                 [compare_bigint_int, compare_bigint_bigint, compare_float],
+                 [compare_float, compare_float, compare_float]]
@@ -0,0 +1,731 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+'''
+Source-level optimization.
+
+With --optimize, each top-level form of a program is rewritten just before
+it is evaluated:
+
+- arithmetic and comparisons applied to literal numbers are folded;
+- an if whose test is a literal boolean becomes the branch it takes, and
+  cond clauses whose test is #f are dropped;
+- globals defined once, at top level, as a literal are replaced by it;
+- calls of small non-recursive procedures defined at top level are inlined,
+  and lambdas applied directly become lets;
+- the literal bindings of a let, and those naming a variable nothing
+  assigns, are substituted into its body.
+
+All of this relies on names keeping their bindings, which set!, a second
+define or a local binding of the same name would break. So before anything
+runs, scan_program looks through the whole program, expanding calls of the
+macros it defines, and records every name it binds locally or assigns;
+those are never folded or inlined through. A program that uses macros in a
+way the scan can't follow is run as it is.
+'''
+
+from .lispobj import (LispCons, LispReference, LispString, LispBool,
+                      LispMacro, LispNativeProc, Symbols, intern, nil)
+from .number import LispNumber
+from .common import LispError
+from .resolver import (list_items, make_list, lambda_parameters, let_parts,
+                       do_parts, head_symbol)
+from . import builtin, special
+
+
+# Largest body, in atoms, of a procedure that is inlined.
+INLINE_SIZE = 16
+
+# How deeply macro calls are expanded while scanning, and inlined bodies
+# inlined into.
+MAX_EXPANSION_DEPTH = 32
+MAX_INLINE_DEPTH = 4
+
+# The builtins folded when applied to literal numbers.
+_foldable = {}
+for _name in ['+', '-', '*', '/', '<', '>', '<=', '>=', '=', 'equal']:
+    _foldable[intern(_name)] = True
+
+# Builtins whose meaning the scan and rewriting take for granted.
+_core = [Symbols.DEFINE, Symbols.SET, Symbols.LAMBDA, Symbols.QUOTE,
+         Symbols.CREATE_MACRO]
+
+
+def _binds(head):
+    '''
+    Whether a form with this head binds or assigns a name.
+    '''
+    return (head is Symbols.LAMBDA or head is Symbols.LET or
+            head is Symbols.DO or head is Symbols.DEFINE or
+            head is Symbols.SET or head is Symbols.CREATE_MACRO)
+
+
+def _is_literal(sexp):
+    return (isinstance(sexp, LispNumber) or isinstance(sexp, LispString) or
+            isinstance(sexp, LispBool))
+
+
+def _is_fixed(sym):
+    '''
+    Whether sym is recognised by name wherever it appears, whatever it is
+    bound to.
+    '''
+    return (sym is Symbols.ELSE or special.get_special_form(sym) is not None
+            or builtin.get_primitive(sym) is not None)
+
+
+def _has_duplicates(symbols):
+    seen = {}
+    for sym in symbols:
+        if sym in seen:
+            return True
+        seen[sym] = True
+    return False
+
+
+def _let_form(names, values, body, pos):
+    if names:
+        bindings = make_list([make_list([LispReference(names[i], pos),
+                                         values[i]], pos)
+                              for i in range(len(names))], pos)
+    else:
+        bindings = LispCons(nil, nil, pos)
+    return make_list([LispReference(Symbols.LET, pos), bindings, body], pos)
+
+
+def _replace(sexp, subst):
+    '''
+    Return a copy of sexp with the references to the symbols in subst
+    replaced by their expressions.
+    '''
+    if isinstance(sexp, LispReference):
+        return subst.get(sexp.symbol, sexp)
+    elif not isinstance(sexp, LispCons):
+        return sexp
+    res = LispCons(_replace(sexp.car, subst), nil, sexp.pos)
+    leaf = res
+    node = sexp.cdr
+    while isinstance(node, LispCons):
+        nxt = LispCons(_replace(node.car, subst), nil, node.pos)
+        leaf.cdr = nxt
+        leaf = nxt
+        node = node.cdr
+    leaf.cdr = _replace(node, subst)
+    return res
+
+
+def expand(macro, args):
+    '''
+    Substitute the argument expressions of a call into a macro's body, as
+    Interpreter.expand_macro does.
+    '''
+    subst = {}
+    for i in range(len(macro.parameters)):
+        subst[macro.parameters[i]] = args[i]
+    return _replace(macro.expression, subst)
+
+
+def _copy(sexp):
+    '''
+    Copy an expression, with fresh references so that the copy's caches
+    aren't shared.
+    '''
+    if isinstance(sexp, LispReference):
+        return LispReference(sexp.symbol, sexp.pos)
+    elif not isinstance(sexp, LispCons) or head_symbol(sexp) is Symbols.QUOTE:
+        return sexp
+    items = list_items(sexp)
+    if items is None:
+        return sexp
+    return make_list([_copy(item) for item in items], sexp.pos)
+
+
+def _size(sexp):
+    '''
+    Count the atoms of an expression, quoted data counting as one.
+    '''
+    if not isinstance(sexp, LispCons) or head_symbol(sexp) is Symbols.QUOTE:
+        return 1
+    res = 0
+    while isinstance(sexp, LispCons):
+        res += _size(sexp.car)
+        sexp = sexp.cdr
+    return res
+
+
+def _define_parts(sexp):
+    '''
+    Return the name and value expression of a define form, or None.
+    '''
+    if head_symbol(sexp) is not Symbols.DEFINE:
+        return None
+    items = list_items(sexp)
+    if (items is None or len(items) != 3 or
+            not isinstance(items[1], LispReference)):
+        return None
+    return items
+
+
+class ProgramInfo(object):
+    '''
+    What a whole program does with its names.
+
+    bound holds every name bound by a lambda, let or do, or by a define
+    that isn't at top level; assigned every name a set!, a do step or such
+    a define can change, and those defined at top level more than once.
+    defines counts the top-level defines of each name, and macros maps the
+    names of the program's macros to them. opaque is set if the program
+    uses macros in any other way.
+    '''
+    def __init__(self):
+        self.bound = {}
+        self.assigned = {}
+        self.defines = {}
+        self.macros = {}
+        self.opaque = False
+
+    def is_stable(self, sym):
+        '''
+        Whether sym only ever names its global binding, and that is only
+        defined once.
+        '''
+        return sym not in self.bound and sym not in self.assigned
+
+    def is_macro_call(self, head):
+        return (head is not None and head in self.macros and
+                special.get_special_form(head) is None)
+
+    def expand_toplevel(self, form):
+        '''
+        Expand a top-level call of a macro defined by an earlier form.
+        '''
+        for i in range(MAX_EXPANSION_DEPTH):
+            head = head_symbol(form)
+            if not self.is_macro_call(head):
+                break
+            assert isinstance(form, LispCons)
+            macro = self.macros[head]
+            args = list_items(form.cdr)
+            if args is None or len(args) != len(macro.parameters):
+                break
+            form = expand(macro, args)
+        return form
+
+    def note_macro(self, form):
+        '''
+        Record the macro a top-level form defines, if any.
+        '''
+        items = _define_parts(form)
+        if (items is None or
+                head_symbol(items[2]) is not Symbols.CREATE_MACRO):
+            return
+        parts = list_items(items[2])
+        params = None
+        if parts is not None and len(parts) == 3:
+            params = lambda_parameters(parts[1])
+        target = items[1]
+        assert isinstance(target, LispReference)
+        sym = target.symbol
+        if not params or sym in self.macros:
+            # Malformed, redefined, or without parameters: a macro without
+            # parameters looks every name in its body up where it's called.
+            self.opaque = True
+            return
+        self.macros[sym] = LispMacro(params, parts[2])
+
+    def bind(self, symbols):
+        for sym in symbols:
+            self.bound[sym] = True
+
+    def assign(self, symbols):
+        for sym in symbols:
+            self.assigned[sym] = True
+
+    def scan_toplevel(self, form):
+        items = _define_parts(form)
+        if items is None:
+            self.scan(form, 0)
+            return
+        target = items[1]
+        assert isinstance(target, LispReference)
+        sym = target.symbol
+        count = self.defines.get(sym, 0) + 1
+        self.defines[sym] = count
+        if count > 1:
+            self.assign([sym])
+        if (sym in self.macros and
+                head_symbol(items[2]) is Symbols.CREATE_MACRO):
+            # Recorded by note_macro; its body is scanned where it's used.
+            return
+        self.scan(items[2], 0)
+
+    def scan(self, sexp, depth):
+        if isinstance(sexp, LispReference):
+            if sexp.symbol in self.macros:
+                # A macro used as a value.
+                self.opaque = True
+            return
+        elif not isinstance(sexp, LispCons):
+            return
+        head = head_symbol(sexp)
+        if head is Symbols.QUOTE:
+            return
+        elif head is Symbols.CREATE_MACRO:
+            self.opaque = True
+            return
+        elif self.is_macro_call(head):
+            macro = self.macros[head]
+            args = list_items(sexp.cdr)
+            if args is not None and len(args) == len(macro.parameters):
+                if depth >= MAX_EXPANSION_DEPTH:
+                    self.opaque = True
+                    return
+                self.scan(expand(macro, args), depth + 1)
+            return
+        elif head is Symbols.DEFINE or head is Symbols.SET:
+            items = list_items(sexp)
+            target = None
+            if items is not None and len(items) == 3:
+                target = items[1]
+            if isinstance(target, LispReference):
+                if head is Symbols.DEFINE:
+                    self.bind([target.symbol])
+                self.assign([target.symbol])
+                self.scan(items[2], depth)
+                return
+        elif head is Symbols.LAMBDA:
+            items = list_items(sexp)
+            if items is not None and len(items) == 3:
+                params = lambda_parameters(items[1])
+                if params is not None:
+                    self.bind(params)
+                    self.scan(items[2], depth)
+                    return
+        elif head is Symbols.LET:
+            try:
+                names, values, body = let_parts(sexp)
+            except LispError:
+                pass
+            else:
+                self.bind(names)
+                for value in values:
+                    self.scan(value, depth)
+                self.scan(body, depth)
+                return
+        elif head is Symbols.DO:
+            try:
+                names, inits, steps, test, result, body = do_parts(sexp)
+            except LispError:
+                pass
+            else:
+                self.bind(names)
+                self.assign(names)
+                for init in inits:
+                    self.scan(init, depth)
+                for step in steps:
+                    if step is not None:
+                        self.scan(step, depth)
+                self.scan(test, depth)
+                self.scan(result, depth)
+                self.scan(body, depth)
+                return
+        node = sexp
+        while isinstance(node, LispCons):
+            self.scan(node.car, depth)
+            node = node.cdr
+
+
+def scan_program(forms):
+    '''
+    Return the ProgramInfo for a program's top-level forms.
+    '''
+    info = ProgramInfo()
+    expanded = []
+    for form in forms:
+        form = info.expand_toplevel(form)
+        info.note_macro(form)
+        expanded.append(form)
+    for form in expanded:
+        info.scan_toplevel(form)
+    for sym in _core:
+        if not info.is_stable(sym) or sym in info.defines:
+            info.opaque = True
+    for sym in info.macros.keys():
+        if not info.is_stable(sym):
+            info.opaque = True
+    return info
+
+
+class InlineProcedure(object):
+    __slots__ = ('parameters', 'body')
+
+    def __init__(self, parameters, body):
+        self.parameters = parameters
+        self.body = body
+
+
+class Optimizer(object):
+    '''
+    Rewrites the top-level forms of a program scanned by scan_program, in
+    the order they are evaluated.
+
+    procedures maps the names of procedures that can be inlined to them,
+    and constants the names of globals defined as literals to their values.
+    Both only hold names the program never binds again. defined holds the
+    names defined by the forms rewritten so far.
+    '''
+    def __init__(self, interp, info):
+        self.interp = interp
+        self.info = info
+        self.procedures = {}
+        self.constants = {}
+        self.defined = {}
+        self.inline_depth = 0
+
+    def optimize_toplevel(self, form):
+        '''
+        Return form rewritten. Called just before it is evaluated in the
+        global environment.
+        '''
+        if self.info.opaque:
+            return form
+        form = self.expand_toplevel(form)
+        form = self.optimize(form, [])
+        self.note_definition(form)
+        return form
+
+    def expand_toplevel(self, form):
+        '''
+        Expand a top-level macro call, as evaluating it would.
+        '''
+        for i in range(MAX_EXPANSION_DEPTH):
+            head = head_symbol(form)
+            if head is None or special.get_special_form(head) is not None:
+                break
+            cell = self.interp.root.cell(head)
+            if cell is None:
+                break
+            macro = cell.value
+            if not isinstance(macro, LispMacro):
+                break
+            assert isinstance(form, LispCons)
+            args = list_items(form.cdr)
+            if (args is None or not macro.parameters or
+                    len(args) != len(macro.parameters)):
+                break
+            form = expand(macro, args)
+        return form
+
+    def note_definition(self, form):
+        '''
+        Remember a top-level define of a literal or of a procedure that can
+        be inlined into later forms.
+        '''
+        items = _define_parts(form)
+        if items is None:
+            return
+        target = items[1]
+        assert isinstance(target, LispReference)
+        sym = target.symbol
+        self.defined[sym] = True
+        if not self.info.is_stable(sym) or _is_fixed(sym):
+            return
+        value = items[2]
+        if _is_literal(value):
+            self.constants[sym] = value
+        elif head_symbol(value) is Symbols.LAMBDA:
+            parts = list_items(value)
+            if parts is None or len(parts) != 3:
+                return
+            params = lambda_parameters(parts[1])
+            if (params is not None and not _has_duplicates(params) and
+                    _size(parts[2]) <= INLINE_SIZE and
+                    self.can_inline(parts[2], sym, params)):
+                self.procedures[sym] = InlineProcedure(params, parts[2])
+
+    def can_inline(self, sexp, name, params):
+        '''
+        Whether sexp can be copied into any scope: it binds nothing, calls
+        no macros, and refers only to params and to globals other than
+        name that are never bound anywhere else.
+        '''
+        if isinstance(sexp, LispReference):
+            sym = sexp.symbol
+            if sym is name:
+                return False
+            return sym in params or self.info.is_stable(sym)
+        elif not isinstance(sexp, LispCons):
+            return True
+        head = head_symbol(sexp)
+        if head is Symbols.QUOTE:
+            return True
+        elif _binds(head) or self.info.is_macro_call(head):
+            return False
+        node = sexp
+        while isinstance(node, LispCons):
+            if not self.can_inline(node.car, name, params):
+                return False
+            node = node.cdr
+        return node is nil
+
+    def optimize(self, sexp, lexical):
+        '''
+        Return sexp rewritten. lexical lists the lambda parameters and let
+        variables in scope.
+        '''
+        if isinstance(sexp, LispReference):
+            value = self.constants.get(sexp.symbol, None)
+            if value is not None:
+                return value
+            return sexp
+        elif not isinstance(sexp, LispCons):
+            return sexp
+        items = list_items(sexp)
+        if items is None:
+            return sexp
+        head = head_symbol(sexp)
+        if (head is Symbols.QUOTE or head is Symbols.CREATE_MACRO or
+                self.info.is_macro_call(head)):
+            # Their arguments are data.
+            return sexp
+        elif head is Symbols.DEFINE or head is Symbols.SET:
+            if len(items) != 3:
+                return sexp
+            return make_list([items[0], items[1],
+                              self.optimize(items[2], lexical)], sexp.pos)
+        elif head is Symbols.LAMBDA:
+            return self.optimize_lambda(sexp, items, lexical)
+        elif head is Symbols.LET:
+            return self.optimize_let(sexp, lexical)
+        elif head is Symbols.DO:
+            return self.optimize_do(sexp, lexical)
+        elif head is Symbols.COND:
+            return self.optimize_cond(sexp, items, lexical)
+        items = [self.optimize(item, lexical) for item in items]
+        if head is Symbols.IF and len(items) == 4:
+            test = items[1]
+            if isinstance(test, LispBool):
+                if test.value:
+                    return items[2]
+                return items[3]
+        res = self.optimize_call(items, sexp.pos, lexical)
+        if res is not None:
+            return res
+        return make_list(items, sexp.pos)
+
+    def optimize_lambda(self, sexp, items, lexical):
+        if len(items) != 3:
+            return sexp
+        params = lambda_parameters(items[1])
+        if params is None:
+            return sexp
+        return make_list([items[0], items[1],
+                          self.optimize(items[2], lexical + params)], sexp.pos)
+
+    def optimize_let(self, sexp, lexical):
+        try:
+            names, values, body = let_parts(sexp)
+        except LispError:
+            # Malformed; reported when evaluated.
+            return sexp
+        values = [self.optimize(value, lexical) for value in values]
+        return self.reduce_let(names, values, body, sexp.pos, lexical)
+
+    def optimize_do(self, sexp, lexical):
+        try:
+            names, inits, steps, test, result, body = do_parts(sexp)
+        except LispError:
+            return sexp
+        pos = sexp.pos
+        # Loop variables are assigned, so nothing is substituted for them
+        # and they needn't be in lexical.
+        bindings = []
+        for i in range(len(names)):
+            binding = [LispReference(names[i], pos),
+                       self.optimize(inits[i], lexical)]
+            if steps[i] is not None:
+                binding.append(self.optimize(steps[i], lexical))
+            bindings.append(make_list(binding, pos))
+        if bindings:
+            binding_list = make_list(bindings, pos)
+        else:
+            binding_list = LispCons(nil, nil, pos)
+        clause = [self.optimize(test, lexical)]
+        if result is not nil:
+            clause.append(self.optimize(result, lexical))
+        items = [sexp.car, binding_list, make_list(clause, pos)]
+        if body is not nil:
+            items.append(self.optimize(body, lexical))
+        return make_list(items, pos)
+
+    def optimize_cond(self, sexp, items, lexical):
+        clauses = []
+        for clause in items[1:]:
+            parts = list_items(clause)
+            if parts is None:
+                return sexp
+            parts = [self.optimize(part, lexical) for part in parts]
+            test = parts[0]
+            if isinstance(test, LispBool) and not test.value:
+                continue
+            clauses.append(make_list(parts, clause.pos))
+        return make_list([items[0]] + clauses, sexp.pos)
+
+    def optimize_call(self, items, pos, lexical):
+        '''
+        Return a replacement for a call whose items have been optimized, or
+        None.
+        '''
+        head = items[0]
+        args = items[1:]
+        if head_symbol(head) is Symbols.LAMBDA:
+            parts = list_items(head)
+            if parts is not None and len(parts) == 3:
+                params = lambda_parameters(parts[1])
+                if params is not None and len(params) == len(args):
+                    # ((lambda (p ...) body) a ...) is (let ((p a) ...) body)
+                    return self.reduce_let(params, args, parts[2], pos,
+                                           lexical)
+            return None
+        elif not isinstance(head, LispReference):
+            return None
+        sym = head.symbol
+        proc = self.procedures.get(sym, None)
+        if (proc is not None and len(proc.parameters) == len(args) and
+                self.inline_depth < MAX_INLINE_DEPTH):
+            self.inline_depth += 1
+            try:
+                return self.reduce_let(proc.parameters, args,
+                                       _copy(proc.body), pos, lexical)
+            finally:
+                self.inline_depth -= 1
+        if (sym in _foldable and self.info.is_stable(sym) and
+                sym not in self.info.defines):
+            return self.fold(sym, args)
+        return None
+
+    def fold(self, sym, args):
+        '''
+        Apply the builtin sym to literal numbers now, or return None.
+        '''
+        for arg in args:
+            if not isinstance(arg, LispNumber):
+                return None
+        cell = self.interp.root.cell(sym)
+        if cell is None:
+            return None
+        proc = cell.value
+        if not isinstance(proc, LispNativeProc):
+            return None
+        try:
+            res = proc.func(self.interp, args, self.interp.root)
+        except LispError:
+            # Left for the call to report, if it is ever made.
+            return None
+        if isinstance(res, LispNumber) or isinstance(res, LispBool):
+            return res
+        return None
+
+    def reduce_let(self, names, values, body, pos, lexical):
+        '''
+        Return an expression for (let ((name value) ...) body), with the
+        values already optimized, substituting the values that allow it.
+        '''
+        body = self.optimize(body, lexical + names)
+        if _has_duplicates(names):
+            return _let_form(names, values, body, pos)
+        kept_names = []
+        kept_values = []
+        changed = False
+        for i in range(len(names)):
+            if self.can_substitute(names[i], values[i], names, lexical):
+                res = self.substitute(body, names[i], values[i])
+                if res is not None:
+                    body = res
+                    changed = True
+                    continue
+            kept_names.append(names[i])
+            kept_values.append(values[i])
+        if changed:
+            body = self.optimize(body, lexical + kept_names)
+        if not kept_names and self.substitute(body, None, None) is not None:
+            # Nothing left to bind, and the body defines nothing.
+            return body
+        return _let_form(kept_names, kept_values, body, pos)
+
+    def can_substitute(self, sym, value, names, lexical):
+        '''
+        Whether a let variable sym bound to value can be replaced by value
+        in the let's body.
+        '''
+        if sym in self.info.assigned or sym is Symbols.ELSE:
+            return False
+        elif _is_literal(value):
+            return True
+        elif not isinstance(value, LispReference):
+            return False
+        ref = value.symbol
+        if ref in self.info.assigned or (ref is not sym and ref in names):
+            return False
+        # It has to be bound already, or the let would have failed.
+        return ref in lexical or self.is_final(ref)
+
+    def is_final(self, sym):
+        '''
+        Whether the global sym is bound, and to the value it will keep.
+        '''
+        if not self.info.is_stable(sym) or self.interp.root.cell(sym) is None:
+            return False
+        # A builtin the program defines later is about to change.
+        return sym not in self.info.defines or sym in self.defined
+
+    def substitute(self, sexp, sym, value):
+        '''
+        Return a copy of sexp with references to sym replaced by value, or
+        None if sexp binds a name or calls a macro.
+        '''
+        if isinstance(sexp, LispReference):
+            if sexp.symbol is not sym:
+                return sexp
+            elif isinstance(value, LispReference):
+                return LispReference(value.symbol, sexp.pos)
+            return value
+        elif not isinstance(sexp, LispCons):
+            return sexp
+        head = head_symbol(sexp)
+        if head is Symbols.QUOTE:
+            return sexp
+        elif _binds(head) or self.info.is_macro_call(head):
+            return None
+        items = list_items(sexp)
+        if items is None:
+            return None
+        res = []
+        for item in items:
+            item = self.substitute(item, sym, value)
+            if item is None:
+                return None
+            res.append(item)
+        return make_list(res, sexp.pos)
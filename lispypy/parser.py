@@ -26,77 +26,282 @@ from .tokenizer import Characters
 from .rpytools import purefunction
 from .common import LispError
 
+# Kinds of literal token, as determined by classify().
+K_SYMBOL, K_STRING, K_HASH, K_INTEGER, K_DECIMAL = range(5)
+N_KINDS = 5
+
+# Internal: first characters that may begin a number.
+_K_NUMERIC = -1
+
+first_char_kinds = {'"': K_STRING, '#': K_HASH,
+                    '-': _K_NUMERIC, '+': _K_NUMERIC, '.': _K_NUMERIC}
+for _c in '0123456789':
+    first_char_kinds[_c] = _K_NUMERIC
+
 parse_list = []
+parsers_by_kind = [[] for _i in range(N_KINDS)]
 
 
-def parsable(priority):
+def parsable(priority, *kinds):
+    '''
+    Register a class whose static parse() handles tokens of the given kinds.
+    Within a kind, parsers are tried in order of decreasing priority.
+    '''
     def decorator(fn):
         parse_list.append((priority, fn))
         parse_list.sort(key=lambda t: -t[0])
+        for kind in kinds:
+            parsers_by_kind[kind].append((priority, fn))
+            parsers_by_kind[kind].sort(key=lambda t: -t[0])
         return fn
     return decorator
 
 
-def parse_object(token):
-    for (p, cls) in parse_list:
+@purefunction
+def numeric_kind(value):
+    '''
+    Check whether value is shaped like an integer or a decimal number.
+    '''
+    digits = 0
+    integral = True
+    for i in range(len(value)):
+        c = value[i]
+        if c in '0123456789':
+            digits += 1
+        elif c == '-' and i == 0:
+            pass
+        elif c in '+-.eE':
+            integral = False
+        else:
+            return K_SYMBOL
+    if digits == 0:
+        return K_SYMBOL
+    if integral:
+        return K_INTEGER
+    return K_DECIMAL
+
+
+@purefunction
+def classify(value):
+    '''
+    Determine the kind of literal a token represents.
+    '''
+    if not value:
+        return K_SYMBOL
+    kind = first_char_kinds.get(value[0], K_SYMBOL)
+    if kind == _K_NUMERIC:
+        return numeric_kind(value)
+    return kind
+
+
+def _parse_kind(token, kind):
+    for (p, cls) in parsers_by_kind[kind]:
         try:
             res = cls.parse(token.value)
-            res.location = token.location
-            return res
-        except:
+        except (ValueError, SyntaxError, OverflowError):
             continue
-    raise SyntaxError(token)
+        res.pos = token.pos
+        return res
+    return None
+
+
+def parse_object(token):
+    kind = classify(token.value)
+    res = _parse_kind(token, kind)
+    if res is None and kind != K_SYMBOL:
+        # Malformed literals are read as symbols.
+        res = _parse_kind(token, K_SYMBOL)
+    if res is None:
+        raise SyntaxError(token)
+    return res
 
 
 from . import lispobj
 
 
+class TokenCursor(object):
+    '''
+    Walks a list of tokens without consuming it.
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def at_end(self):
+        return self.pos >= len(self.tokens)
+
+    def peek(self):
+        '''
+        Return the current token, or None if there are no tokens left.
+        '''
+        if self.pos >= len(self.tokens):
+            return None
+        return self.tokens[self.pos]
+
+    def next(self):
+        '''
+        Consume and return the current token, or None if there are none left.
+        '''
+        if self.pos >= len(self.tokens):
+            return None
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+
+class _PendingList(object):
+    '''
+    A list, vector or quote form whose contents are still being parsed.
+    A vector's items are collected as a list first.
+    '''
+    def __init__(self, pos, head=None, vector=False):
+        self.pos = pos
+        self.head = head
+        self.leaf = head
+        self.last_pos = pos
+        self.vector = vector
+
+    def is_quote(self):
+        return self.head is None
+
+    def value(self):
+        '''
+        Return the finished datum.
+        '''
+        if not self.vector:
+            return self.head
+        items = []
+        node = self.head
+        while isinstance(node, lispobj.LispCons):
+            items.append(node.car)
+            node = node.cdr
+        return lispobj.LispVector(items, self.pos, literal=True)
+
+
+def _quote(datum, pos):
+    tail = lispobj.LispCons(car=datum, cdr=lispobj.nil,
+                            pos=pos)
+    return lispobj.LispCons(car=lispobj.LispReference(lispobj.Symbols.QUOTE,
+                                                      pos),
+                            cdr=tail, pos=pos)
+
+
 @purefunction
-def parse(tokens):
+def parse(cursor):
     '''
-    Transform a list of tokens into a S-expression.
+    Transform the tokens at a TokenCursor into a S-expression.
+
+    Nesting is tracked on an explicit stack rather than by recursion, so the
+    depth of the input is not limited by the host stack.
     '''
-    if not tokens:
-        raise EOFError()
-    token = tokens.pop(0)
-    if token.value == Characters.SEXP_OPEN:
-        res = lispobj.LispCons(car=lispobj.LispNil(),
-                               cdr=lispobj.LispNil(),
-                               location=token.location)
-        leaf = res
-        last_loc = leaf.location
-        try:
-            while tokens[0].value != Characters.SEXP_CLOSE:
-                try:
-                    leaf.car = parse(tokens)
-                except EOFError:
-                    raise LispError("Unexpected EOF while parsing", last_loc)
-                if tokens[0].value != Characters.SEXP_CLOSE:
-                    leaf.cdr = lispobj.LispCons(car=lispobj.LispNil(),
-                                                cdr=lispobj.LispNil(),
-                                                location=tokens[0].location)
-                else:
-                    leaf.cdr = lispobj.LispNil()
-                leaf = leaf.cdr
-                if not isinstance(leaf, lispobj.LispNil) and leaf.cdr:
-                    last_loc = leaf.location
-        except IndexError:
-            raise LispError("Unclosed parentheses", last_loc)
-        tokens.pop(0)
-        return res
-    elif token.value == Characters.SEXP_CLOSE:
-        raise LispError("Unexpected %s" % Characters.SEXP_CLOSE, token.location)
-    elif token.value == Characters.QUOTE:
-        tail = lispobj.LispCons(car=parse(tokens), cdr=lispobj.LispNil(),
-                                location=token.location)
-        return lispobj.LispCons(car=lispobj.LispReference('quote',
-                                                          token.location),
-                                cdr=tail, location=token.location)
-    return parse_object(token)
+    stack = []
+    while True:
+        # Read the start of a datum.
+        token = cursor.next()
+        if token is None:
+            # Only a quote can leave us expecting a datum at the end.
+            i = len(stack) - 1
+            while i >= 0:
+                if not stack[i].is_quote():
+                    raise LispError("Unexpected EOF while parsing",
+                                    stack[i].last_pos)
+                i -= 1
+            raise EOFError()
+        if (token.value == Characters.SEXP_OPEN or
+                token.value == Characters.VECTOR_OPEN):
+            pending = _PendingList(token.pos,
+                                   lispobj.LispCons(car=lispobj.nil,
+                                                    cdr=lispobj.nil,
+                                                    pos=token.pos),
+                                   token.value == Characters.VECTOR_OPEN)
+            nxt = cursor.peek()
+            if nxt is None:
+                raise LispError("Unclosed parentheses", pending.last_pos)
+            if nxt.value != Characters.SEXP_CLOSE:
+                stack.append(pending)
+                continue
+            cursor.next()
+            if pending.vector:
+                value = lispobj.LispVector([], token.pos, literal=True)
+            else:
+                value = pending.head
+        elif token.value == Characters.SEXP_CLOSE:
+            raise LispError("Unexpected %s" % Characters.SEXP_CLOSE,
+                            token.pos)
+        elif token.value == Characters.QUOTE:
+            stack.append(_PendingList(token.pos))
+            continue
+        else:
+            value = parse_object(token)
+
+        # Hand the finished datum to the enclosing forms, closing any that
+        # are now complete.
+        while True:
+            if not stack:
+                return value
+            pending = stack[-1]
+            if pending.is_quote():
+                stack.pop()
+                value = _quote(value, pending.pos)
+                continue
+            leaf = pending.leaf
+            assert isinstance(leaf, lispobj.LispCons)
+            leaf.car = value
+            nxt = cursor.peek()
+            if nxt is None:
+                raise LispError("Unclosed parentheses", pending.last_pos)
+            if nxt.value != Characters.SEXP_CLOSE:
+                leaf.cdr = lispobj.LispCons(car=lispobj.nil,
+                                            cdr=lispobj.nil,
+                                            pos=nxt.pos)
+                pending.leaf = leaf.cdr
+                pending.last_pos = nxt.pos
+                break
+            leaf.cdr = lispobj.nil
+            cursor.next()
+            stack.pop()
+            value = pending.value()
 
 
 def parse_all(tokens):
+    cursor = TokenCursor(tokens)
     res = []
-    while tokens:
-        res.append(parse(tokens))
+    while not cursor.at_end():
+        res.append(parse(cursor))
     return res
+
+
+class FormStream(object):
+    '''
+    Parses top-level forms from a TokenStream one at a time.
+
+    Only the tokens of the form being parsed are held in memory, so each
+    form can be evaluated before the rest of the input has been read.
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def next_form(self):
+        '''
+        Return the next complete top-level form, or None at end of input.
+        '''
+        pending = []
+        depth = 0
+        while True:
+            token = self.tokens.next_token()
+            if token is None:
+                if not pending:
+                    return None
+                break
+            pending.append(token)
+            if (token.value == Characters.SEXP_OPEN or
+                    token.value == Characters.VECTOR_OPEN):
+                depth += 1
+            elif token.value == Characters.SEXP_CLOSE:
+                depth -= 1
+            elif token.value == Characters.QUOTE:
+                # The quoted datum follows.
+                continue
+            if depth <= 0:
+                break
+        return parse(TokenCursor(pending))
@@ -23,42 +23,124 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 import os
-from . import tokenizer, parser, interpreter, common, lispobj
+from . import (tokenizer, parser, interpreter, compiler, vm, common,
+               lispobj, optimizer)
 
 
-def main(argv):
+def make_interpreter(backend, max_depth=vm.VMInterpreter.DEFAULT_MAX_DEPTH):
+    '''
+    Return an interpreter for the named evaluation backend, or None.
+    max_depth limits call depth in the bytecode backend.
+    '''
+    if backend == 'tree':
+        return interpreter.Interpreter()
+    elif backend == 'closure':
+        return compiler.CompilingInterpreter()
+    elif backend == 'bytecode':
+        return vm.VMInterpreter(max_depth)
+    return None
+
+
+def evaluate_forms(interp, forms, optimize=False):
+    '''
+    Evaluate the forms of a FormStream in the global environment, returning
+    the value of the last.
+
+    With optimize, the whole program is read first for the optimizer to
+    scan; an error reading it is raised once the forms before it have run.
+    '''
+    res = lispobj.nil
+    if not optimize:
+        while True:
+            form = forms.next_form()
+            if form is None:
+                break
+            res = interp.evaluate(form, interp.root)
+        return res
+    program = []
+    error = None
     try:
-        if argv[1] == '-':
-            fd = 0
+        while True:
+            form = forms.next_form()
+            if form is None:
+                break
+            program.append(form)
+    except common.LispError, e:
+        error = e
+    opt = optimizer.Optimizer(interp, optimizer.scan_program(program))
+    for form in program:
+        res = interp.evaluate(opt.optimize_toplevel(form), interp.root)
+    if error is not None:
+        raise error
+    return res
+
+
+def main(argv):
+    use_mmap = False
+    optimize = False
+    backend = 'tree'
+    max_depth = vm.VMInterpreter.DEFAULT_MAX_DEPTH
+    path = None
+    for arg in argv[1:]:
+        if arg == '--mmap':
+            use_mmap = True
+        elif arg == '--optimize':
+            optimize = True
+        elif arg.startswith('--backend='):
+            backend = arg[len('--backend='):]
+        elif arg.startswith('--max-depth='):
+            try:
+                max_depth = int(arg[len('--max-depth='):])
+            except ValueError:
+                path = None
+                break
+        elif path is None:
+            path = arg
         else:
-            fd = os.open(argv[1], os.O_RDONLY, 0777)
-    except IndexError:
-        print "Usage: %s file" % argv[0]
+            path = None
+            break
+    interp = make_interpreter(backend, max_depth)
+    if path is None or interp is None:
+        print ("Usage: %s [--mmap] [--optimize] "
+               "[--backend=tree|closure|bytecode] [--max-depth=N] file"
+               % argv[0])
         return 1
+    if path == '-':
+        fd = 0
     else:
-        interp = interpreter.Interpreter()
-        if fd == 0:
-            try:
-                while True:
-                    os.write(1, '> ')
-                    try:
-                        tokens = tokenizer.tokenize(fd, 'stdin', eof=False)
-                        exps = parser.parse_all(tokens)
-                        for exp in exps:
-                            res = interp.evaluate(exp, interp.root)
-                            if not isinstance(res, lispobj.LispNil):
-                                print res.repr()
-                    except common.LispError, e:
-                        print '!! At %s:\n\t%s' % (e.location.repr(),
-                                                   e.message)
-            except KeyboardInterrupt:
-                pass
-        else:
-            try:
-                tokens = tokenizer.tokenize(fd, argv[1])
-                for o in parser.parse_all(tokens):
-                    interp.evaluate(o, interp.root)
-            except common.LispError, e:
-                print '!! At %s:\n\t%s' % (e.location.repr(),
-                                           e.message)
+        fd = os.open(path, os.O_RDONLY, 0777)
+
+    if fd == 0:
+        # The optimizer needs the whole program, so the REPL never uses it.
+        reader = tokenizer.SourceReader(fd, 'stdin', interactive=True)
+        try:
+            while not reader.at_eof:
+                os.write(1, '> ')
+                line = tokenizer.TokenStream(reader, eof=False)
+                forms = parser.FormStream(line)
+                try:
+                    while True:
+                        exp = forms.next_form()
+                        if exp is None:
+                            break
+                        res = interp.evaluate(exp, interp.root)
+                        if res is not lispobj.nil:
+                            print res.repr()
+                except common.LispError, e:
+                    print '!! At %s:\n\t%s' % (
+                        tokenizer.location_repr(e.pos), e.message)
+                    # Discard the rest of the line.
+                    while line.next_token() is not None:
+                        pass
+        except KeyboardInterrupt:
+            pass
+    else:
+        reader = tokenizer.open_reader(fd, path, use_mmap)
+        try:
+            forms = parser.FormStream(tokenizer.TokenStream(reader))
+            evaluate_forms(interp, forms, optimize)
+        except common.LispError, e:
+            print '!! At %s:\n\t%s' % (tokenizer.location_repr(e.pos),
+                                       e.message)
+        reader.close()
     return 0
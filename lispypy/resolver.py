@@ -0,0 +1,658 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Lexical addressing.
+
+When a lambda is created, its body is resolved against the parameters of
+the lambda and of every enclosing lambda. References to those variables
+become LispLocalRefs holding a (depth, slot) address into the chain of call
+frames; anything else (globals, names created by macro-expanded defines) is
+left as a LispReference and looked up by name.
+'''
+
+from .lispobj import (LispCons, LispReference, LispLocalRef, LispLambda,
+                      LispLet, LispDo, Symbols, nil)
+from .common import LispError
+
+
+class Scope(object):
+    '''
+    The static layout of a call frame: the symbol bound in each slot.
+
+    Slots hold the lambda's parameters, followed by any names the body
+    defines. The first bound slots are filled when the frame is made;
+    owner is the LispLambda, LispLet or LispDo whose frames these are, if
+    any, and info caches the ScopeInfo of its body.
+    '''
+    __slots__ = ('symbols', 'slots', 'outer', 'bound', 'owner', 'info')
+
+    def __init__(self, symbols, outer, bound=-1):
+        self.symbols = symbols
+        self.slots = {}
+        for i in range(len(symbols)):
+            self.slots[symbols[i]] = i
+        self.outer = outer
+        if bound < 0:
+            bound = len(symbols)
+        self.bound = bound
+        self.owner = None
+        self.info = None
+
+    def slot_of(self, sym):
+        return self.slots.get(sym, -1)
+
+
+def list_items(sexp):
+    '''
+    Return the items of a proper list, or None if sexp isn't one.
+    '''
+    items = []
+    while isinstance(sexp, LispCons):
+        items.append(sexp.car)
+        sexp = sexp.cdr
+    if sexp is not nil:
+        return None
+    return items
+
+
+def make_list(items, pos):
+    '''
+    Return a proper list of items, each cons at pos.
+    '''
+    res = nil
+    i = len(items)
+    while i > 0:
+        i -= 1
+        res = LispCons(items[i], res, pos)
+    return res
+
+
+def _form_items(sexp, n):
+    '''
+    Return the n items of a proper list, or None if sexp isn't one.
+    '''
+    items = list_items(sexp)
+    if items is None or len(items) != n:
+        return None
+    return items
+
+
+def lambda_parameters(params):
+    '''
+    Return the parameter symbols of a lambda form, or None if malformed.
+    '''
+    res = []
+    if isinstance(params, LispCons) and params.car is nil:
+        # ()
+        return res
+    node = params
+    while isinstance(node, LispCons):
+        car = node.car
+        if not isinstance(car, LispReference):
+            return None
+        res.append(car.symbol)
+        node = node.cdr
+    if node is not nil:
+        return None
+    return res
+
+
+def let_parts(sexp):
+    '''
+    Split a let form into its bound names, value expressions and body, or
+    raise LispError if it is malformed. A body of several expressions is
+    wrapped in a begin.
+    '''
+    args = sexp.cdr
+    items = list_items(args)
+    if items is None or len(items) < 2:
+        raise LispError("Malformed let", sexp.pos)
+    assert isinstance(args, LispCons)
+    names = []
+    values = []
+    bindings = items[0]
+    if not (isinstance(bindings, LispCons) and bindings.car is nil and
+            bindings.cdr is nil):
+        binding_items = list_items(bindings)
+        if binding_items is None:
+            raise LispError("Malformed let", sexp.pos)
+        for binding in binding_items:
+            pair = _form_items(binding, 2)
+            if pair is None:
+                raise LispError("Malformed let binding", binding.pos)
+            name = pair[0]
+            if not isinstance(name, LispReference):
+                raise LispError("Malformed let binding", binding.pos)
+            names.append(name.symbol)
+            values.append(pair[1])
+    if len(items) == 2:
+        body = items[1]
+    else:
+        body = LispCons(LispReference(Symbols.BEGIN, sexp.pos), args.cdr,
+                        sexp.pos)
+    return names, values, body
+
+
+def body_form(body, pos):
+    '''
+    Return an expression for the list of expressions body: nil if it is
+    empty, and a begin if it has several.
+    '''
+    if not isinstance(body, LispCons):
+        return nil
+    if body.cdr is nil:
+        return body.car
+    return LispCons(LispReference(Symbols.BEGIN, pos), body, pos)
+
+
+def do_parts(sexp):
+    '''
+    Split a do form into its variables, initial values, steps, test,
+    result and body, or raise LispError if it is malformed.
+
+        (do ((var init [step]) ...) (test result ...) body ...)
+    '''
+    args = sexp.cdr
+    items = list_items(args)
+    if items is None or len(items) < 2:
+        raise LispError("Malformed do", sexp.pos)
+    assert isinstance(args, LispCons)
+    names = []
+    inits = []
+    steps = []
+    bindings = items[0]
+    if not (isinstance(bindings, LispCons) and bindings.car is nil and
+            bindings.cdr is nil):
+        binding_items = list_items(bindings)
+        if binding_items is None:
+            raise LispError("Malformed do", sexp.pos)
+        for binding in binding_items:
+            parts = list_items(binding)
+            if parts is None or not 2 <= len(parts) <= 3:
+                raise LispError("Malformed do binding", binding.pos)
+            name = parts[0]
+            if not isinstance(name, LispReference):
+                raise LispError("Malformed do binding", binding.pos)
+            names.append(name.symbol)
+            inits.append(parts[1])
+            if len(parts) == 3:
+                steps.append(parts[2])
+            else:
+                steps.append(None)
+    clause = items[1]
+    if not (isinstance(clause, LispCons) and clause.car is not nil and
+            list_items(clause) is not None):
+        raise LispError("Malformed do test", clause.pos)
+    rest = args.cdr
+    assert isinstance(rest, LispCons)
+    body = body_form(rest.cdr, sexp.pos)
+    return (names, inits, steps, clause.car, body_form(clause.cdr, sexp.pos),
+            body)
+
+
+def head_symbol(sexp):
+    if isinstance(sexp, LispCons):
+        car = sexp.car
+        if isinstance(car, LispReference):
+            return car.symbol
+    return None
+
+
+def collect_defines(sexp, symbols):
+    '''
+    Append to symbols every name the expression defines in its own frame.
+    '''
+    if isinstance(sexp, LispLet):
+        for value in sexp.values:
+            collect_defines(value, symbols)
+        return
+    elif isinstance(sexp, LispDo):
+        for init in sexp.inits:
+            collect_defines(init, symbols)
+        return
+    if isinstance(sexp, LispLambda) or not isinstance(sexp, LispCons):
+        return
+    head = head_symbol(sexp)
+    if (head is Symbols.QUOTE or head is Symbols.LAMBDA or
+            head is Symbols.CREATE_MACRO):
+        return
+    elif head is Symbols.LET:
+        # The body defines into the let's own frame.
+        try:
+            names, values, body = let_parts(sexp)
+        except LispError:
+            return
+        for value in values:
+            collect_defines(value, symbols)
+        return
+    elif head is Symbols.DO:
+        try:
+            names, inits, steps, test, result, body = do_parts(sexp)
+        except LispError:
+            return
+        for init in inits:
+            collect_defines(init, symbols)
+        return
+    if head is Symbols.DEFINE:
+        items = _form_items(sexp, 3)
+        if items is not None:
+            target = items[1]
+            if (isinstance(target, LispReference) and
+                    target.symbol not in symbols):
+                symbols.append(target.symbol)
+    node = sexp
+    while isinstance(node, LispCons):
+        collect_defines(node.car, symbols)
+        node = node.cdr
+
+
+def resolve_ref(ref, scope):
+    depth = 0
+    s = scope
+    while s is not None:
+        slot = s.slot_of(ref.symbol)
+        if slot >= 0:
+            return LispLocalRef(ref.symbol, depth, slot, scope, ref.pos)
+        s = s.outer
+        depth += 1
+    if isinstance(ref, LispLocalRef):
+        # Resolved against some other scope; go back to a name lookup.
+        return LispReference(ref.symbol, ref.pos)
+    return ref
+
+
+def resolve(sexp, scope):
+    '''
+    Return a copy of sexp with local references resolved against scope.
+    '''
+    if isinstance(sexp, LispReference):
+        return resolve_ref(sexp, scope)
+    elif isinstance(sexp, LispLambda):
+        return closure_template(sexp, scope)
+    elif isinstance(sexp, LispLet):
+        return let_for(sexp, scope)
+    elif isinstance(sexp, LispDo):
+        return do_for(sexp, scope)
+    elif not isinstance(sexp, LispCons):
+        return sexp
+
+    head = head_symbol(sexp)
+    if head is Symbols.QUOTE or head is Symbols.CREATE_MACRO:
+        return sexp
+    elif head is Symbols.LAMBDA:
+        items = _form_items(sexp, 3)
+        if items is not None:
+            params = lambda_parameters(items[1])
+            if params is not None:
+                return resolve_lambda(params, items[2], scope, sexp)
+        # Malformed; let the lambda builtin report it.
+        return sexp
+    elif head is Symbols.LET:
+        try:
+            return resolve_let(sexp, scope)
+        except LispError:
+            # Malformed; reported when evaluated.
+            return sexp
+    elif head is Symbols.DO:
+        try:
+            return resolve_do(sexp, scope)
+        except LispError:
+            return sexp
+
+    res = LispCons(resolve(sexp.car, scope), nil, sexp.pos)
+    leaf = res
+    node = sexp.cdr
+    while isinstance(node, LispCons):
+        nxt = LispCons(resolve(node.car, scope), nil, node.pos)
+        leaf.cdr = nxt
+        leaf = nxt
+        node = node.cdr
+    leaf.cdr = resolve(node, scope)
+    return res
+
+
+def resolve_lambda(parameters, body, outer, source):
+    '''
+    Build the LispLambda for a lambda form appearing in scope outer.
+    '''
+    symbols = list(parameters)
+    collect_defines(body, symbols)
+    scope = Scope(symbols, outer, len(parameters))
+    template = LispLambda(parameters, resolve(body, scope), scope, source,
+                          source.pos)
+    scope.owner = template
+    return template
+
+
+def resolve_let(sexp, outer):
+    '''
+    Build the LispLet for a let form appearing in scope outer.
+    '''
+    names, values, body = let_parts(sexp)
+    symbols = list(names)
+    collect_defines(body, symbols)
+    scope = Scope(symbols, outer, len(names))
+    let = LispLet([resolve(v, outer) for v in values], resolve(body, scope),
+                  scope, sexp, sexp.pos)
+    scope.owner = let
+    return let
+
+
+def let_for(let, scope):
+    '''
+    Return let, resolved again if it was resolved for some other scope.
+    '''
+    if let.scope.outer is not scope:
+        let = resolve(let.source, scope)
+        assert isinstance(let, LispLet)
+    return let
+
+
+def resolve_do(sexp, outer):
+    '''
+    Build the LispDo for a do form appearing in scope outer.
+    '''
+    names, inits, steps, test, result, body = do_parts(sexp)
+    symbols = list(names)
+    for step in steps:
+        if step is not None:
+            collect_defines(step, symbols)
+    collect_defines(test, symbols)
+    collect_defines(body, symbols)
+    collect_defines(result, symbols)
+    scope = Scope(symbols, outer, len(names))
+    resolved_steps = []
+    for step in steps:
+        if step is not None:
+            step = resolve(step, scope)
+        resolved_steps.append(step)
+    do = LispDo([resolve(i, outer) for i in inits], resolved_steps,
+                resolve(test, scope), resolve(body, scope),
+                resolve(result, scope), scope, sexp, sexp.pos)
+    scope.owner = do
+    return do
+
+
+def do_for(do, scope):
+    '''
+    Return do, resolved again if it was resolved for some other scope.
+    '''
+    if do.scope.outer is not scope:
+        do = resolve(do.source, scope)
+        assert isinstance(do, LispDo)
+    return do
+
+
+def closure_template(template, scope):
+    '''
+    Return the LispLambda to close over a frame laid out by scope.
+    '''
+    if template.scope.outer is not scope:
+        # The template was resolved for some other frame layout, e.g. it was
+        # moved there by a macro. Resolve it again for this one.
+        template = resolve(template.source, scope)
+        assert isinstance(template, LispLambda)
+    return template
+
+
+# Flat closures
+#
+# A closure normally keeps the whole chain of frames it was made in. If its
+# body can't reach those frames except through its free variables, it can
+# instead get a frame of its own holding copies of just those, directly in
+# front of the global environment. That is only safe if:
+#
+#  - no free variable can change once the closure has copied it: it is not
+#    the target of a set!, nor defined more than once (or at all, if it is
+#    a parameter), nor a do loop variable;
+#  - no name the body looks up by name is bound in the dropped frames, which
+#    the resolver can see except for names defined by macro expansions;
+#  - no macro is expanded in the dropped frames or the body, since it could
+#    define or set names there or refer to them by name. Every name called
+#    by name has to be bound to something other than a macro already: an
+#    unbound one could still be defined as a macro before the call.
+#
+# The first is decided here when the lambda is resolved. The others depend
+# on what is bound when the closure is made, so FlatLayout lists the names
+# to check then.
+
+
+class ScopeInfo(object):
+    '''
+    What the body of a scope's owner refers to, calls and assigns,
+    including in nested lambdas, lets and do loops.
+    '''
+    __slots__ = ('refs', 'names', 'heads', 'assigned')
+
+    def __init__(self):
+        self.refs = []
+        self.names = {}
+        self.heads = {}
+        self.assigned = {}
+
+    def walk(self, sexp):
+        if isinstance(sexp, LispLocalRef):
+            self.refs.append(sexp)
+        elif isinstance(sexp, LispReference):
+            self.names[sexp.symbol] = True
+        elif isinstance(sexp, LispLambda):
+            self.walk(sexp.body)
+        elif isinstance(sexp, LispLet):
+            for value in sexp.values:
+                self.walk(value)
+            self.walk(sexp.body)
+        elif isinstance(sexp, LispDo):
+            for init in sexp.inits:
+                self.walk(init)
+            for step in sexp.steps:
+                if step is not None:
+                    self.walk(step)
+            self.walk(sexp.test)
+            self.walk(sexp.body)
+            self.walk(sexp.result)
+        elif isinstance(sexp, LispCons):
+            head = sexp.car
+            if (isinstance(head, LispReference) and
+                    not isinstance(head, LispLocalRef)):
+                sym = head.symbol
+                if sym is Symbols.QUOTE or sym is Symbols.CREATE_MACRO:
+                    return
+                self.heads[sym] = True
+                if sym is Symbols.SET:
+                    items = _form_items(sexp, 3)
+                    if items is not None:
+                        target = items[1]
+                        if isinstance(target, LispReference):
+                            self.assigned[target.symbol] = True
+            node = sexp
+            while isinstance(node, LispCons):
+                self.walk(node.car)
+                node = node.cdr
+
+
+def _count_defines(sexp, counts):
+    '''
+    Count the defines of each name evaluated in the frame sexp runs in.
+    '''
+    if isinstance(sexp, LispLet):
+        for value in sexp.values:
+            _count_defines(value, counts)
+        return
+    elif isinstance(sexp, LispDo):
+        for init in sexp.inits:
+            _count_defines(init, counts)
+        return
+    elif not isinstance(sexp, LispCons):
+        return
+    head = head_symbol(sexp)
+    if head is Symbols.QUOTE or head is Symbols.CREATE_MACRO:
+        return
+    elif head is Symbols.DEFINE:
+        items = _form_items(sexp, 3)
+        if items is not None:
+            target = items[1]
+            if isinstance(target, LispReference):
+                sym = target.symbol
+                counts[sym] = counts.get(sym, 0) + 1
+    node = sexp
+    while isinstance(node, LispCons):
+        _count_defines(node.car, counts)
+        node = node.cdr
+
+
+def scope_info(scope):
+    '''
+    Return the ScopeInfo for the body of scope's owner, which must have
+    one.
+    '''
+    if scope.info is not None:
+        return scope.info
+    info = ScopeInfo()
+    owner = scope.owner
+    counts = {}
+    if isinstance(owner, LispLambda):
+        info.walk(owner.body)
+        _count_defines(owner.body, counts)
+    elif isinstance(owner, LispLet):
+        info.walk(owner.body)
+        _count_defines(owner.body, counts)
+    elif isinstance(owner, LispDo):
+        info.walk(owner)
+        # Every name in a do loop's frame may change each iteration.
+        for sym in scope.symbols:
+            info.assigned[sym] = True
+    for sym, count in counts.items():
+        if count > 1 or scope.slot_of(sym) < scope.bound:
+            info.assigned[sym] = True
+    scope.info = info
+    return info
+
+
+class FlatLayout(object):
+    '''
+    How to make a flat closure of a LispLambda: template is the lambda
+    resolved against scope, which holds just its free variables, and
+    free variable i is found depths[i] frames out from the closure's
+    environment, in slot slots[i]. It can only be made if none of names
+    is bound in a frame's dict and every one of heads is a special form or
+    a global bound to something other than a macro.
+    '''
+    __slots__ = ('template', 'scope', 'depths', 'slots', 'names', 'heads')
+
+    def __init__(self, template, scope, depths, slots, names, heads):
+        self.template = template
+        self.scope = scope
+        self.depths = depths
+        self.slots = slots
+        self.names = names
+        self.heads = heads
+
+no_layout = FlatLayout(None, None, [], [], [], [])
+
+
+def _target_scope(ref):
+    scope = ref.scope
+    for i in range(ref.depth):
+        if scope is None:
+            return None
+        scope = scope.outer
+    return scope
+
+
+def _flat_layout(template):
+    chain = []
+    dropped = False
+    scope = template.scope.outer
+    while scope is not None:
+        chain.append(scope)
+        if scope.owner is not None:
+            dropped = True
+        scope = scope.outer
+    if not dropped:
+        # Made in the global environment or a frame that holds only copies.
+        return no_layout
+    outer_names = {}
+    for scope in chain:
+        for sym in scope.symbols:
+            outer_names[sym] = True
+
+    info = scope_info(template.scope)
+    free = []
+    depths = []
+    slots = []
+    for ref in info.refs:
+        target = _target_scope(ref)
+        if target is None:
+            return no_layout
+        depth = -1
+        for i in range(len(chain)):
+            if chain[i] is target:
+                depth = i
+        if depth < 0:
+            # A variable of the lambda's own frames. If it may be looked up
+            # by name before it is defined, that lookup would see the
+            # dropped frames.
+            if ref.slot >= target.bound and ref.symbol in outer_names:
+                return no_layout
+            continue
+        if ref.symbol in scope_info(target).assigned:
+            return no_layout
+        if ref.symbol not in free:
+            free.append(ref.symbol)
+            depths.append(depth)
+            slots.append(ref.slot)
+
+    heads = {}
+    for sym in info.heads:
+        heads[sym] = True
+    for scope in chain:
+        for sym in scope_info(scope).heads:
+            heads[sym] = True
+    names = []
+    for sym in info.names:
+        if sym in outer_names:
+            return no_layout
+        names.append(sym)
+
+    # In front of the global environment, like the frame.
+    scope = Scope(free, chain[-1])
+    flat = resolve(template.source, scope)
+    if not isinstance(flat, LispLambda):
+        return no_layout
+    return FlatLayout(flat, scope, depths, slots, names, heads.keys())
+
+
+def flat_layout(template):
+    '''
+    Return the FlatLayout for closures of template, or None if they can't
+    be flat.
+    '''
+    layout = template.layout
+    if layout is None:
+        layout = _flat_layout(template)
+        template.layout = layout
+    if layout is no_layout:
+        return None
+    return layout
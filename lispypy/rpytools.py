@@ -47,6 +47,23 @@ except ImportError:
         return lambda f: f
 debug_info(import_success, 'rpython.rlib.objectmodel.enforceargs')
 
+import_success = True
+try:
+    from rpython.rlib.objectmodel import specialize
+except ImportError:
+    import_success = False
+
+    # Dummy decorators
+    class specialize(object):
+        @staticmethod
+        def arg(*a):
+            return lambda f: f
+
+        @staticmethod
+        def argtype(*a):
+            return lambda f: f
+debug_info(import_success, 'rpython.rlib.objectmodel.specialize')
+
 # JitDriver
 import_success = True
 try:
@@ -66,6 +83,7 @@ except ImportError:
             pass
 debug_info(import_success, 'rpython.rlib.jit.JitDriver')
 
+
 # purefunction
 import_success = True
 try:
@@ -108,9 +126,54 @@ except ImportError:
         def fromint(i):
             return rbigint(i)
 
+        @staticmethod
         def fromdecimalstr(s):
             return rbigint(s)
 
+        def add(self, other):
+            return rbigint(long(self) + other)
+
+        def sub(self, other):
+            return rbigint(long(self) - other)
+
+        def mul(self, other):
+            return rbigint(long(self) * other)
+
+        def div(self, other):
+            return rbigint(long(self) // other)
+
+        def neg(self):
+            return rbigint(-long(self))
+
+        int_add = add
+        int_sub = sub
+        int_mul = mul
+        int_floordiv = div
+
+        def lt(self, other):
+            return long(self) < other
+
+        def gt(self, other):
+            return long(self) > other
+
+        def le(self, other):
+            return long(self) <= other
+
+        def ge(self, other):
+            return long(self) >= other
+
+        def eq(self, other):
+            return long(self) == other
+
+        int_lt = lt
+        int_gt = gt
+        int_le = le
+        int_ge = ge
+        int_eq = eq
+
+        def tofloat(self):
+            return float(self)
+
         def repr(self):
             return repr(self)
 debug_info(import_success, 'rpython.rlib.rbigint.rbigint')
@@ -123,3 +186,35 @@ except ImportError:
     import_success = False
     StackOverflow = ((RuntimeError, RuntimeError),)
 debug_info(import_success, 'rpython.rlib.rstackovf.StackOverflow')
+
+# mmap
+import_success = True
+try:
+    from rpython.rlib import rmmap
+
+    def mmap_readonly(fd, length):
+        return rmmap.mmap(fd, length, flags=rmmap.MAP_SHARED,
+                          prot=rmmap.PROT_READ)
+except ImportError:
+    import_success = False
+    import mmap as _mmap
+
+    # Mimic the getitem/getslice interface of rmmap.MMap
+    class _MappedFile(object):
+        def __init__(self, fd, length):
+            self.data = _mmap.mmap(fd, length, _mmap.MAP_SHARED,
+                                   _mmap.PROT_READ)
+            self.size = length
+
+        def getitem(self, index):
+            return self.data[index]
+
+        def getslice(self, start, length):
+            return self.data[start:start + length]
+
+        def close(self):
+            self.data.close()
+
+    def mmap_readonly(fd, length):
+        return _MappedFile(fd, length)
+debug_info(import_success, 'rpython.rlib.rmmap')
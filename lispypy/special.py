@@ -0,0 +1,273 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Special forms.
+
+The tree-walking interpreter looks the head symbol of a form up in
+special_forms and has the SpecialForm evaluate it. The compiling backends
+rewrite cond, and, or and when into if and begin forms with desugar
+instead, and compile let and do from the LispLet and LispDo the resolver
+builds.
+'''
+
+from .lispobj import (LispCons, LispReference, Symbols, nil, true, false,
+                      make_bool)
+from .common import LispError
+from .rpytools import purefunction
+from . import resolver
+
+
+def _is_list(sexp):
+    while isinstance(sexp, LispCons):
+        sexp = sexp.cdr
+    return sexp is nil
+
+
+def check_clause(clause):
+    '''
+    Check a cond clause is a list of a test and any number of expressions,
+    and return it as a LispCons.
+    '''
+    if not (isinstance(clause, LispCons) and clause.car is not nil and
+            _is_list(clause)):
+        raise LispError("Malformed cond clause", clause.pos)
+    return clause
+
+
+def is_else(test):
+    return isinstance(test, LispReference) and test.symbol is Symbols.ELSE
+
+
+class SpecialForm(object):
+    '''
+    A form the tree walker evaluates itself rather than by calling a
+    procedure.
+    '''
+    def evaluate(self, interp, sexp, env):
+        '''
+        Evaluate everything but the expression in tail position, and return
+        that expression for the caller to evaluate.
+        '''
+        raise NotImplementedError
+
+
+def _begin(interp, body, env):
+    '''
+    Evaluate all but the last expression of a non-empty body; return the
+    last.
+    '''
+    assert isinstance(body, LispCons)
+    while True:
+        rest = body.cdr
+        if not isinstance(rest, LispCons):
+            return body.car
+        interp.evaluate(body.car, env)
+        body = rest
+
+
+class Begin(SpecialForm):
+    def evaluate(self, interp, sexp, env):
+        if not isinstance(sexp.cdr, LispCons):
+            return nil
+        return _begin(interp, sexp.cdr, env)
+
+
+class If(SpecialForm):
+    def evaluate(self, interp, sexp, env):
+        args = sexp.cdr
+        if not isinstance(args, LispCons):
+            raise LispError("Expected list of parameters", sexp.pos)
+        branches = args.cdr
+        if not isinstance(branches, LispCons):
+            raise LispError("Wrong number of arguments to if", sexp.pos)
+        alternative = branches.cdr
+        if not (isinstance(alternative, LispCons) and
+                alternative.cdr is nil):
+            raise LispError("Wrong number of arguments to if", sexp.pos)
+        if interp.check_bool(interp.evaluate(args.car, env)):
+            return branches.car
+        return alternative.car
+
+
+class Cond(SpecialForm):
+    def evaluate(self, interp, sexp, env):
+        clauses = sexp.cdr
+        while isinstance(clauses, LispCons):
+            clause = check_clause(clauses.car)
+            if (is_else(clause.car) or
+                    interp.check_bool(interp.evaluate(clause.car, env))):
+                if not isinstance(clause.cdr, LispCons):
+                    return true
+                return _begin(interp, clause.cdr, env)
+            clauses = clauses.cdr
+        return nil
+
+
+class And(SpecialForm):
+    def evaluate(self, interp, sexp, env):
+        args = sexp.cdr
+        if not isinstance(args, LispCons):
+            return true
+        while True:
+            rest = args.cdr
+            if not isinstance(rest, LispCons):
+                return args.car
+            if not interp.check_bool(interp.evaluate(args.car, env)):
+                return false
+            args = rest
+
+
+class Or(SpecialForm):
+    def evaluate(self, interp, sexp, env):
+        args = sexp.cdr
+        if not isinstance(args, LispCons):
+            return false
+        while True:
+            rest = args.cdr
+            if not isinstance(rest, LispCons):
+                return args.car
+            if interp.check_bool(interp.evaluate(args.car, env)):
+                return true
+            args = rest
+
+
+class When(SpecialForm):
+    def evaluate(self, interp, sexp, env):
+        args = sexp.cdr
+        if not isinstance(args, LispCons):
+            raise LispError("Wrong number of arguments to when", sexp.pos)
+        body = args.cdr
+        if (interp.check_bool(interp.evaluate(args.car, env)) and
+                isinstance(body, LispCons)):
+            return _begin(interp, body, env)
+        return nil
+
+
+class ResolvedForm(SpecialForm):
+    '''
+    A form the resolver builds an object for, which the tree walker then
+    evaluates. Outside a lambda body nothing has resolved the form yet, so
+    it is resolved the first time it is evaluated and kept.
+    '''
+    def resolve(self, sexp, scope):
+        raise NotImplementedError
+
+    def evaluate(self, interp, sexp, env):
+        res = interp.resolved_forms.get(sexp, None)
+        if res is None:
+            res = self.resolve(sexp, env.scope)
+            if len(interp.resolved_forms) >= interp.MAX_EXPANSIONS:
+                interp.resolved_forms.clear()
+            interp.resolved_forms[sexp] = res
+        return res
+
+
+class Let(ResolvedForm):
+    def resolve(self, sexp, scope):
+        return resolver.resolve_let(sexp, scope)
+
+
+class Do(ResolvedForm):
+    def resolve(self, sexp, scope):
+        return resolver.resolve_do(sexp, scope)
+
+
+# Recognised by name before any lookup, so these names are reserved; see
+# README.md.
+special_forms = {
+    Symbols.BEGIN: Begin(),
+    Symbols.IF: If(),
+    Symbols.COND: Cond(),
+    Symbols.AND: And(),
+    Symbols.OR: Or(),
+    Symbols.WHEN: When(),
+    Symbols.LET: Let(),
+    Symbols.DO: Do(),
+}
+
+
+@purefunction
+def get_special_form(sym):
+    return special_forms.get(sym, None)
+
+
+def _if_form(test, then, else_, pos):
+    return resolver.make_list([LispReference(Symbols.IF, pos), test, then,
+                              else_], pos)
+
+
+def desugar(sexp):
+    '''
+    Rewrite a cond, and, or or when form (with a proper argument list) into
+    if and begin forms, or return None if sexp is none of them. Raises
+    LispError if the form is malformed.
+    '''
+    car = sexp.car
+    assert isinstance(car, LispReference)
+    sym = car.symbol
+    if not (sym is Symbols.COND or sym is Symbols.AND or sym is Symbols.OR or
+            sym is Symbols.WHEN):
+        return None
+    pos = sexp.pos
+    items = resolver.list_items(sexp.cdr)
+    if items is None:
+        raise LispError("Expected list of arguments or nil", pos)
+    if sym is Symbols.COND:
+        res = nil
+        i = len(items)
+        while i > 0:
+            i -= 1
+            clause = check_clause(items[i])
+            body = clause.cdr
+            if isinstance(body, LispCons):
+                value = resolver.body_form(body, pos)
+            else:
+                value = true
+            if is_else(clause.car):
+                res = value
+            else:
+                res = _if_form(clause.car, value, res, pos)
+        return res
+    elif sym is Symbols.AND or sym is Symbols.OR:
+        if not items:
+            return make_bool(sym is Symbols.AND)
+        res = items[-1]
+        i = len(items) - 1
+        while i > 0:
+            i -= 1
+            if sym is Symbols.AND:
+                res = _if_form(items[i], res, false, pos)
+            else:
+                res = _if_form(items[i], true, res, pos)
+        return res
+    elif sym is Symbols.WHEN:
+        if not items:
+            raise LispError("Wrong number of arguments to when", pos)
+        args = sexp.cdr
+        assert isinstance(args, LispCons)
+        body = args.cdr
+        if isinstance(body, LispCons):
+            return _if_form(items[0], resolver.body_form(body, pos), nil, pos)
+        return _if_form(items[0], nil, nil, pos)
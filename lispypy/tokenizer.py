@@ -24,7 +24,7 @@
 
 import os
 
-from .rpytools import enforceargs, r_uint
+from .rpytools import enforceargs, r_uint, mmap_readonly
 
 
 class Characters(object):
@@ -38,6 +38,8 @@ class Characters(object):
     PACKAGE_MARKER = ':'
     SEXP_OPEN = '('
     SEXP_CLOSE = ')'
+    VECTOR_MARKER = '#'
+    VECTOR_OPEN = '#('
     COMMENT = ';'
     STRING_MARKER = '"'
     QUOTE = "'"
@@ -46,8 +48,10 @@ class Characters(object):
 
 class Location(object):
     '''
-    Represents the location of a parsed token.
+    A line and column in a named file, built from a position on demand.
     '''
+    __slots__ = ('filename', 'line', 'character')
+
     @enforceargs(None, str, r_uint, r_uint)
     def __init__(self, filename, line, character):
         self.filename = filename
@@ -60,77 +64,340 @@ class Location(object):
     __repr__ = repr
 
 
+class SourceFile(object):
+    '''
+    Line table for one source file.
+
+    Positions within the file are offsets from its base in the SourceMap;
+    the table only records the offset at which each line starts. Each line
+    of interactive input is numbered as line 1.
+    '''
+    def __init__(self, filename, base, interactive=False):
+        self.filename = filename
+        self.base = base
+        self.size = 0
+        self.line_starts = [0]
+        self.interactive = interactive
+
+    def add_line(self, offset):
+        self.line_starts.append(offset)
+
+    def location(self, offset):
+        # Find the last line starting at or before offset.
+        lo = 0
+        hi = len(self.line_starts)
+        while hi - lo > 1:
+            mid = (lo + hi) / 2
+            if self.line_starts[mid] <= offset:
+                lo = mid
+            else:
+                hi = mid
+        line = lo + 1
+        if self.interactive:
+            line = 1
+        return Location(self.filename, r_uint(line),
+                        r_uint(offset - self.line_starts[lo] + 1))
+
+
+class SourceMap(object):
+    '''
+    All source files read so far, laid out end to end in one position space.
+
+    Tokens and objects carry a single integer position; Location objects
+    are only created when a position has to be shown to the user.
+    '''
+    def __init__(self):
+        self.files = []
+
+    def add_file(self, filename, interactive=False):
+        base = 0
+        if self.files:
+            last = self.files[-1]
+            base = last.base + last.size + 1
+        f = SourceFile(filename, base, interactive)
+        self.files.append(f)
+        return f
+
+    def location(self, pos):
+        '''
+        Return the Location of pos, or None if it is not a source position.
+        '''
+        if pos < 0 or not self.files:
+            return None
+        lo = 0
+        hi = len(self.files)
+        while hi - lo > 1:
+            mid = (lo + hi) / 2
+            if self.files[mid].base <= pos:
+                lo = mid
+            else:
+                hi = mid
+        f = self.files[lo]
+        return f.location(pos - f.base)
+
+
+source_map = SourceMap()
+
+
+def location_repr(pos):
+    loc = source_map.location(pos)
+    if loc is None:
+        return '???'
+    return loc.repr()
+
+
 class Token(object):
     '''
-    Represents a parsed token, encoding its value and location.
+    Represents a parsed token, encoding its value and source position.
     '''
-    def __init__(self, value, location):
+    __slots__ = ('value', 'pos')
+
+    def __init__(self, value, pos):
         self.value = value
-        self.location = location
+        self.pos = pos
 
     def repr(self):
-        return "Token('%s', %s)" % (self.value, self.location.repr())
+        return "Token('%s', %s)" % (self.value, location_repr(self.pos))
     __repr__ = repr
 
 
+class SourceReader(object):
+    '''
+    Buffered character source over a file descriptor.
+
+    Reads the input in large blocks rather than one byte per syscall, and
+    records line starts in a SourceFile as it goes.
+    '''
+    BUFFER_SIZE = 65536
+
+    def __init__(self, fd, filename, buffer_size=BUFFER_SIZE,
+                 interactive=False):
+        assert buffer_size > 0
+        self.fd = fd
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.buf = ''
+        self.pos = 0
+        self.file = source_map.add_file(filename, interactive)
+        self.offset = 0
+        self.at_eof = False
+        # Start of the token being read, and any part of it that was
+        # already evicted from the buffer by fill().
+        self.mark_pos = -1
+        self.pending = []
+
+    def fill(self):
+        '''
+        Read the next block of input. Returns False at end of file.
+        '''
+        if self.at_eof:
+            return False
+        data = self.read_block()
+        if not data:
+            self.at_eof = True
+            return False
+        if self.mark_pos >= 0:
+            start = self.mark_pos
+            assert start >= 0
+            self.pending.append(self.buf[start:])
+            self.mark_pos = 0
+        self.buf = data
+        self.pos = 0
+        return True
+
+    def read_block(self):
+        '''
+        Return up to buffer_size more characters of input, or '' at EOF.
+        '''
+        return os.read(self.fd, self.buffer_size)
+
+    def advance(self, c):
+        self.offset += 1
+        self.file.size = self.offset
+        if c == '\n':
+            self.file.add_line(self.offset)
+
+    def peek(self):
+        '''
+        Return the next character without consuming it, or '' at EOF.
+        '''
+        if self.pos >= len(self.buf) and not self.fill():
+            return ''
+        return self.buf[self.pos]
+
+    def next_char(self):
+        '''
+        Consume and return the next character, or '' at EOF.
+        '''
+        if self.pos >= len(self.buf) and not self.fill():
+            return ''
+        c = self.buf[self.pos]
+        self.pos += 1
+        self.advance(c)
+        return c
+
+    def mark(self):
+        '''
+        Start recording a token at the current position.
+        '''
+        self.mark_pos = self.pos
+        if self.pending:
+            self.pending = []
+
+    def take(self):
+        '''
+        Return the text consumed since the last mark().
+        '''
+        start = self.mark_pos
+        assert start >= 0
+        self.mark_pos = -1
+        end = self.pos
+        assert end >= start
+        if not self.pending:
+            return self.buf[start:end]
+        self.pending.append(self.buf[start:end])
+        res = ''.join(self.pending)
+        self.pending = []
+        return res
+
+    def close(self):
+        pass
+
+    def position(self):
+        return self.file.base + self.offset
+
+
+class MappedReader(SourceReader):
+    '''
+    Character source over a memory-mapped file.
+
+    Blocks are sliced out of the mapping instead of read(), and scanned as
+    SourceReader scans them. That saves the system calls but not the copy,
+    so --mmap is no faster than reading the file.
+    '''
+    def __init__(self, fd, filename, size):
+        SourceReader.__init__(self, fd, filename)
+        self.map = mmap_readonly(fd, size)
+        self.size = size
+        self.map_pos = 0
+
+    def read_block(self):
+        start = self.map_pos
+        length = min(self.buffer_size, self.size - start)
+        if length <= 0:
+            return ''
+        self.map_pos = start + length
+        return self.map.getslice(start, length)
+
+    def close(self):
+        self.map.close()
+
+
+def open_reader(fd, filename, use_mmap=False):
+    '''
+    Create a reader for fd, memory-mapping it if requested and possible.
+    '''
+    if use_mmap:
+        size = os.fstat(fd).st_size
+        if size > 0:
+            return MappedReader(fd, filename, size)
+    return SourceReader(fd, filename)
+
+
+class TokenStream(object):
+    '''
+    Lazily tokenizes a SourceReader, producing one token per call.
+
+    If eof is False, the stream ends at the end of the current line and the
+    rest of the input is left buffered in the reader.
+    '''
+    def __init__(self, reader, eof=True):
+        self.reader = reader
+        self.eof = eof
+        self.done = False
+
+    def next_token(self):
+        '''
+        Return the next token, or None at the end of the input.
+        '''
+        S_DEFAULT, S_COMMENT, S_TOKEN, S_STRING = (0, 1, 2, 3)
+
+        if self.done:
+            return None
+        reader = self.reader
+        state = S_DEFAULT
+        token_start = reader.position()
+        while True:
+            if state == S_TOKEN:
+                # We are in the midst of processing a token.
+                c = reader.peek()
+                if len(c) == 0 or c not in Characters.TOKEN_VALID:
+                    # The token has ended. Don't consume the character -
+                    # it is processed again by the next call.
+                    return Token(reader.take(), token_start)
+                reader.next_char()
+                continue
+
+            if state == S_DEFAULT:
+                token_start = reader.position()
+                reader.mark()
+            c = reader.next_char()
+            if len(c) == 0:
+                self.done = True
+                return None
+            if state == S_COMMENT:
+                # We're in a comment. Do nothing.
+                if c in Characters.ENDLINE:
+                    # The line ended.
+                    # We are no longer in a comment.
+                    state = S_DEFAULT
+            elif state == S_STRING:
+                # We are processing a string literal.
+                if c == Characters.ESCAPE:
+                    # Take the next character verbatim
+                    reader.next_char()
+                elif c == Characters.STRING_MARKER:
+                    return Token(reader.take(), token_start)
+            else:
+                # We are floating in a void.
+                if c in Characters.COMMENT:
+                    state = S_COMMENT
+                elif c in Characters.STRING_MARKER:
+                    state = S_STRING
+                elif (c == Characters.VECTOR_MARKER and
+                      reader.peek() == Characters.SEXP_OPEN):
+                    reader.next_char()
+                    return Token(Characters.VECTOR_OPEN, token_start)
+                elif c in Characters.TOKEN_VALID:
+                    state = S_TOKEN
+                elif c == Characters.SEXP_OPEN:
+                    return Token(Characters.SEXP_OPEN, token_start)
+                elif c == Characters.SEXP_CLOSE:
+                    return Token(Characters.SEXP_CLOSE, token_start)
+                elif c not in Characters.IGNORE:
+                    return Token(c, token_start)
+            if c == '\n' and not self.eof and state != S_STRING:
+                self.done = True
+                return None
+
+
 def tokenize(fp, filename, eof=True):
     '''
     Tokenize a LISP script from a file descriptor.
     '''
-    S_DEFAULT, S_COMMENT, S_TOKEN, S_STRING = (0, 1, 2, 3)
+    return tokenize_reader(SourceReader(fp, filename, interactive=not eof),
+                           eof)
 
-    cur_line = r_uint(1)
-    cur_char = r_uint(1)
 
+def tokenize_reader(reader, eof=True):
+    '''
+    Tokenize a LISP script from a SourceReader into a list.
+    '''
+    stream = TokenStream(reader, eof)
     tokens = []
-    state = S_DEFAULT
-    current_token = []
-    token_start = Location(filename, cur_line, cur_char)
-    c = os.read(fp, 1)
-    while len(c) > 0:
-        if state == S_COMMENT:
-            # We're in a comment. Do nothing.
-            if c in Characters.ENDLINE:
-                # The line ended.
-                # We are no longer in a comment.
-                state = S_DEFAULT
-        elif state == S_TOKEN:
-            # We are in the midst of processing a token.
-            if c not in Characters.TOKEN_VALID:
-                # The token has ended. Add it to the list.
-                state = S_DEFAULT
-                tokens.append(Token(''.join(current_token), token_start))
-                # Don't skip the character - process it again.
-                continue
-            current_token.append(c)
-        elif state == S_STRING:
-            # We are processing a string literal.
-            if c in Characters.ESCAPE:
-                # Take the next character
-                current_token.append(c)
-                current_token.append(os.read(fp, 1))
-            current_token.append(c)
-            if c in Characters.STRING_MARKER:
-                tokens.append(Token(''.join(current_token), token_start))
-                state = S_DEFAULT
-        else:
-            # We are floating in a void.
-            token_start = Location(filename, cur_line, cur_char)
-            if c in Characters.COMMENT:
-                state = S_COMMENT
-            elif c in Characters.STRING_MARKER:
-                state = S_STRING
-                current_token = [c]
-            elif c in Characters.TOKEN_VALID:
-                state = S_TOKEN
-                current_token = [c]
-            elif c not in Characters.IGNORE:
-                tokens.append(Token(c, token_start))
-        cur_char = cur_char + 1
-        if c == '\n':
-            cur_char = r_uint(1)
-            cur_line = cur_line + 1
-            if not eof:
-                break
-        c = os.read(fp, 1)
+    while True:
+        token = stream.next_token()
+        if token is None:
+            break
+        tokens.append(token)
     return tokens
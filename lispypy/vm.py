@@ -0,0 +1,363 @@
+# Copyright (c) 2013, Charles O. Goddard
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+The bytecode virtual machine.
+
+The interpreter loop's merge point is keyed on the Code object and the
+program counter, and each call runs in a VMFrame holding the closure's
+variables and the operand stack, which the JIT keeps virtual.
+
+Calls don't recurse on the host stack. A VMFrame records its caller and
+where to resume it, and the chain of callers is the continuation stack;
+its depth is limited by VMInterpreter.max_depth rather than by the host.
+'''
+
+from .lispobj import (LispClosure, LispLambda, LispMacro, LispNativeProc,
+                      LispString, nil)
+from .common import LispError, NO_POS
+from .interpreter import Interpreter, Frame, frame_values
+from .tokenizer import location_repr
+from .rpytools import JitDriver, StackOverflow
+from .bytecode import (POP, RETURN, HAVE_ARGUMENT, LOAD_CONST, LOAD_LOCAL,
+                       LOAD_DEREF, LOAD_NAME, DEFINE_LOCAL, DEFINE_NAME,
+                       SET_NAME, MAKE_CLOSURE, JUMP, JUMP_IF_FALSE, CALL_PREP,
+                       CALL, TAIL_CALL, RAISE, LET, STORE_LOCAL, opnames,
+                       compile_code)
+
+
+class VMFrame(Frame):
+    '''
+    A Frame that also holds the operand stack of the code running in it.
+
+    env is the environment the code's definitions, closures and name
+    lookups use: the frame itself for a closure call, or the environment
+    a pass-through frame sits in front of.
+
+    caller is the frame to return to, which resumes at its pc; None ends
+    the current VMInterpreter.execute.
+    '''
+    __slots__ = ('stack', 'sp', 'env', 'code', 'pc', 'caller')
+
+    def __init__(self, scope, values, outer, code, env=None):
+        Frame.__init__(self, scope, values, outer)
+        self.stack = [None] * code.stack_depth
+        self.sp = 0
+        if env is None:
+            env = self
+        self.env = env
+        self.code = code
+        self.pc = 0
+        self.caller = None
+
+    def push(self, value):
+        sp = self.sp
+        assert sp >= 0
+        self.stack[sp] = value
+        self.sp = sp + 1
+
+    def pop(self):
+        sp = self.sp - 1
+        assert sp >= 0
+        value = self.stack[sp]
+        self.stack[sp] = None
+        self.sp = sp
+        return value
+
+    def peek(self):
+        sp = self.sp - 1
+        assert sp >= 0
+        return self.stack[sp]
+
+    def pop_args(self, n):
+        '''
+        Pop the top n values as a list, in the order they were pushed.
+        '''
+        args = [None] * n
+        while n > 0:
+            n -= 1
+            args[n] = self.pop()
+        return args
+
+
+def pass_through_frame(code, env):
+    '''
+    Return a frame to run code compiled with depth_offset 1 in env.
+    '''
+    return VMFrame(None, [], env, code, env)
+
+
+def get_location(pc, code):
+    return '%s %s' % (location_repr(code.positions[pc]),
+                      opnames[ord(code.bytecode[pc])])
+
+vm_driver = JitDriver(greens=['pc', 'code'],
+                      reds=['opc', 'base_depth', 'frame', 'self_'],
+                      get_printable_location=get_location,
+                      is_recursive=True)
+
+
+class VMInterpreter(Interpreter):
+    '''
+    An Interpreter that compiles expressions to bytecode and runs them on
+    the virtual machine.
+
+    depth is the number of frames currently waiting for a call to return,
+    and peak_depth the most there have been.
+    '''
+    DEFAULT_MAX_DEPTH = 50000
+
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH):
+        Interpreter.__init__(self)
+        self.max_depth = max_depth
+        self.depth = 0
+        self.peak_depth = 0
+
+    def evaluate(self, sexp, env):
+        code = compile_code(sexp, env.scope, 1)
+        return self.execute(code, pass_through_frame(code, env))
+
+    def closure_code(self, template):
+        code = template.bytecode
+        if code is None:
+            code = compile_code(template.body, template.scope, 0)
+            template.bytecode = code
+        return code
+
+    def closure_frame(self, proc, args, code, pos):
+        template = proc.template
+        if len(args) != len(template.parameters):
+            raise LispError("Expected %d arguments, got %d" % (
+                len(template.parameters), len(args)), pos)
+        return VMFrame(template.scope, frame_values(template.scope, args),
+                       proc.env, code)
+
+    def call_closure(self, proc, args, pos):
+        code = self.closure_code(proc.template)
+        return self.execute(code, self.closure_frame(proc, args, code, pos))
+
+    def push_frame(self, callee, caller, pc, pos):
+        '''
+        Make caller resume at pc when callee returns.
+        '''
+        depth = self.depth + 1
+        if depth > self.max_depth:
+            raise LispError("Stack overflow", pos)
+        self.depth = depth
+        if depth > self.peak_depth:
+            self.peak_depth = depth
+        caller.pc = pc
+        callee.caller = caller
+
+    def call_native(self, proc, args, env, pos):
+        try:
+            return proc.func(self, args, env)
+        except LispError, e:
+            if e.pos == NO_POS:
+                raise LispError(e.message, pos)
+            raise
+
+    def lookup_name(self, env, sym, pos):
+        containing = env.find(sym)
+        if not containing:
+            raise LispError('Name "%s" undefined' % (sym.name,), pos)
+        return containing.get(sym)
+
+    def load_name(self, code, index, env, pos):
+        '''
+        Look up code.names[index], caching the global Cell it is found in.
+        Code always runs in environments laid out by code.scope.
+        '''
+        sym = code.names[index]
+        cell = code.cells[index]
+        if cell is not None and not sym.shadowed:
+            return cell.value
+        containing = env.find(sym)
+        if not containing:
+            raise LispError('Name "%s" undefined' % (sym.name,), pos)
+        if containing is self.root and env.scope is code.scope:
+            code.cells[index] = self.global_cell(sym, env)
+        return containing.get(sym)
+
+    def execute(self, code, frame):
+        pc = 0
+        opc = 0
+        base_depth = self.depth
+        try:
+            while True:
+                vm_driver.jit_merge_point(pc=pc, code=code, opc=opc,
+                                          base_depth=base_depth, frame=frame,
+                                          self_=self)
+                opc = pc
+                op = ord(code.bytecode[pc])
+                if op >= HAVE_ARGUMENT:
+                    arg = (ord(code.bytecode[pc + 1]) |
+                           (ord(code.bytecode[pc + 2]) << 8))
+                    pc += 3
+                else:
+                    arg = 0
+                    pc += 1
+
+                if op == LOAD_LOCAL:
+                    value = frame.values[arg]
+                    if value is None:
+                        # Defined in the body but not bound yet.
+                        value = self.lookup_name(frame.env,
+                                                 code.scope.symbols[arg],
+                                                 code.positions[opc])
+                    frame.push(value)
+                elif op == LOAD_DEREF:
+                    ref = code.refs[arg]
+                    value = frame.lookup(ref.depth, ref.slot)
+                    if value is None:
+                        value = self.lookup_name(frame.env, ref.symbol,
+                                                 ref.pos)
+                    frame.push(value)
+                elif op == LOAD_NAME:
+                    frame.push(self.load_name(code, arg, frame.env,
+                                              code.positions[opc]))
+                elif op == LOAD_CONST:
+                    frame.push(code.consts[arg])
+                elif op == CALL_PREP:
+                    proc = frame.peek()
+                    site = code.sites[arg]
+                    if isinstance(proc, LispClosure):
+                        pass
+                    elif isinstance(proc, LispNativeProc):
+                        if not proc.evaluate_args:
+                            frame.pop()
+                            frame.push(self.call_native(
+                                proc, site.expressions, frame.env, site.pos))
+                            pc = site.end
+                    elif isinstance(proc, LispMacro):
+                        frame.pop()
+                        expansion = self.cached_expansion(site, proc,
+                                                          frame.env)
+                        callee = pass_through_frame(expansion, frame.env)
+                        if site.tail:
+                            # Nothing is left to do in this frame; run the
+                            # expansion in its place.
+                            callee.caller = frame.caller
+                        else:
+                            self.push_frame(callee, frame, site.end,
+                                            site.pos)
+                        code = expansion
+                        frame = callee
+                        pc = 0
+                    else:
+                        raise LispError("Attempt to call %s" % (
+                            proc.typename(),), proc.pos)
+                elif op == CALL or op == TAIL_CALL:
+                    site = code.sites[arg]
+                    args = frame.pop_args(site.argc)
+                    proc = frame.pop()
+                    if isinstance(proc, LispClosure):
+                        callee_code = self.closure_code(proc.template)
+                        callee = self.closure_frame(proc, args, callee_code,
+                                                    site.pos)
+                        if op == TAIL_CALL:
+                            callee.caller = frame.caller
+                        else:
+                            self.push_frame(callee, frame, pc, site.pos)
+                        code = callee_code
+                        frame = callee
+                        pc = 0
+                        if op == TAIL_CALL:
+                            vm_driver.can_enter_jit(pc=pc, code=code, opc=opc,
+                                                    base_depth=base_depth,
+                                                    frame=frame, self_=self)
+                    else:
+                        assert isinstance(proc, LispNativeProc)
+                        frame.push(self.call_native(proc, args, frame.env,
+                                                    site.pos))
+                elif op == POP:
+                    frame.pop()
+                elif op == RETURN:
+                    value = frame.pop()
+                    caller = frame.caller
+                    if caller is None:
+                        return value
+                    self.depth -= 1
+                    frame = caller
+                    code = frame.code
+                    pc = frame.pc
+                    frame.push(value)
+                elif op == JUMP:
+                    pc = arg
+                    if pc < opc:
+                        # A loop; only do compiles to a backward jump.
+                        vm_driver.can_enter_jit(pc=pc, code=code, opc=opc,
+                                                base_depth=base_depth,
+                                                frame=frame, self_=self)
+                elif op == JUMP_IF_FALSE:
+                    if not self.check_bool(frame.pop()):
+                        pc = arg
+                elif op == DEFINE_LOCAL:
+                    frame.values[arg] = frame.pop()
+                    frame.push(nil)
+                elif op == STORE_LOCAL:
+                    frame.values[arg] = frame.pop()
+                elif op == DEFINE_NAME:
+                    frame.env.set(code.names[arg], frame.pop())
+                    frame.push(nil)
+                elif op == SET_NAME:
+                    value = frame.pop()
+                    sym = code.names[arg]
+                    containing = frame.env.find(sym)
+                    if not containing:
+                        raise LispError('Name "%s" undefined' % (sym.name,),
+                                        code.positions[opc])
+                    containing.set(sym, value)
+                    frame.push(nil)
+                elif op == MAKE_CLOSURE:
+                    template = code.consts[arg]
+                    assert isinstance(template, LispLambda)
+                    frame.push(self.make_closure(template, frame.env))
+                elif op == LET:
+                    block = code.lets[arg]
+                    values = frame_values(block.scope,
+                                          frame.pop_args(block.argc))
+                    callee = VMFrame(block.scope, values, frame.env,
+                                     block.code)
+                    if block.tail:
+                        callee.caller = frame.caller
+                    else:
+                        self.push_frame(callee, frame, pc, code.positions[opc])
+                    code = block.code
+                    frame = callee
+                    pc = 0
+                elif op == RAISE:
+                    message = code.consts[arg]
+                    assert isinstance(message, LispString)
+                    raise LispError(message.val_str, code.positions[opc])
+                else:
+                    raise LispError("Bad opcode %d" % (op,),
+                                    code.positions[opc])
+        except StackOverflow:
+            self.depth = base_depth
+            raise LispError("Stack overflow", code.positions[opc])
+        except LispError:
+            # The frames between here and base_depth are abandoned.
+            self.depth = base_depth
+            raise